@@ -0,0 +1,106 @@
+# System modules
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+
+# External modules
+import cv2
+import numpy as np
+
+# Custom
+from ForgeryDetector.core.preprocessing.archive import ChunkArchive, INDEX_DTYPE
+
+
+class ChunkArchiveTests(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'archive')
+
+        rng = np.random.default_rng(0)
+        self.chunks = [rng.integers(0, 256, shape, dtype=np.uint8) for shape in [(10, 20), (7, 3), (31, 17)]]
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def write(self):
+        archive = ChunkArchive(self.path, 'w')
+        for index, chunk in enumerate(self.chunks):
+            self.assertEqual(archive.add(chunk, file=f'{index}.png'), index)
+
+            # What was just added can be read right away
+            np.testing.assert_array_equal(archive[index], chunk)
+        archive.close()
+
+    def assertChunks(self, archive, chunks):
+        self.assertEqual(len(archive), len(chunks))
+        for chunk, expected in zip(archive, chunks):
+            np.testing.assert_array_equal(chunk, expected)
+
+    def test_round_trip(self):
+        self.write()
+        archive = ChunkArchive(self.path)
+
+        self.assertChunks(archive, self.chunks)
+        self.assertEqual(archive.find(file='1.png'), [1])
+        self.assertEqual(archive.shapes().tolist(), [[10, 20], [7, 3], [31, 17]])
+
+        # Only the path is pickled, the copy maps the same file
+        copy = pickle.loads(pickle.dumps(archive))
+        self.assertChunks(copy, self.chunks)
+
+        with self.assertRaises(ValueError):
+            archive.add(self.chunks[0])
+
+    def test_color_chunks_and_boxes(self):
+        archive = ChunkArchive(self.path, 'w')
+        color = cv2.cvtColor(self.chunks[0], cv2.COLOR_GRAY2BGR)
+        self.assertEqual(archive.add_many([((1, 2, 20, 10), color)], file='figure.png'), [0])
+        archive.close()
+
+        archive = ChunkArchive(self.path)
+        np.testing.assert_array_equal(archive[0], self.chunks[0])
+        self.assertEqual(archive.metadata, [{'box': [1, 2, 20, 10], 'file': 'figure.png'}])
+
+    def test_truncated_data(self):
+        self.write()
+
+        # The last chunk lost part of its pixels
+        with open(os.path.join(self.path, 'chunks.bin'), 'r+b') as file:
+            file.truncate(os.path.getsize(file.name) - 5)
+
+        self.assertChunks(ChunkArchive(self.path), self.chunks[:2])
+
+        # Appending starts where the last complete chunk ended
+        archive = ChunkArchive(self.path, 'a')
+        self.assertEqual(archive.add(self.chunks[2], file='again.png'), 2)
+        archive.close()
+
+        archive = ChunkArchive(self.path)
+        self.assertChunks(archive, self.chunks)
+        self.assertEqual(archive.find(file='again.png'), [2])
+
+    def test_truncated_index_and_metadata(self):
+        self.write()
+
+        # Half an index entry and a metadata line without its newline
+        with open(os.path.join(self.path, 'index.bin'), 'r+b') as file:
+            file.truncate(2 * INDEX_DTYPE.itemsize + INDEX_DTYPE.itemsize // 2)
+        self.assertChunks(ChunkArchive(self.path), self.chunks[:2])
+
+        with open(os.path.join(self.path, 'metadata.jsonl'), 'r+b') as file:
+            file.truncate(os.path.getsize(file.name) - 30)
+        self.assertChunks(ChunkArchive(self.path), self.chunks[:1])
+
+        archive = ChunkArchive(self.path, 'a')
+        archive.add(self.chunks[1], file='1.png')
+        archive.close()
+
+        archive = ChunkArchive(self.path)
+        self.assertChunks(archive, self.chunks[:2])
+        self.assertEqual(archive.metadata, [{'file': '0.png'}, {'file': '1.png'}])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,596 @@
+# System modules
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+
+# External modules
+import cv2
+import numpy as np
+
+# Custom
+from ForgeryDetector.core.classifying.match import ImageMatcher, TRANSFORMS
+from ForgeryDetector.core.classifying.detect import CopyMoveDetector
+from ForgeryDetector.core.preprocessing.crop import ImageCropper
+from ForgeryDetector.core.preprocessing.synthetic import BlotGenerator
+
+# Runs are written here, named after the time they were started
+BENCHMARK_RESULTS_PATH = r'Tests\Benchmark results'
+
+# The figure widths and corpus sizes that every benchmark is run with
+SIZES = [256, 512, 1024]
+CORPUS_SIZES = [10, 50]
+
+# The template matching methods and the score a best match needs to be reported.
+# The unnormalized scores depend on the template, so their best match is always reported.
+MATCH_METHODS = {'TM_SQDIFF': (cv2.TM_SQDIFF, None),
+                 'TM_SQDIFF_NORMED': (cv2.TM_SQDIFF_NORMED, 0.05),
+                 'TM_CCORR': (cv2.TM_CCORR, None),
+                 'TM_CCORR_NORMED': (cv2.TM_CCORR_NORMED, 0.98),
+                 'TM_CCOEFF': (cv2.TM_CCOEFF, None),
+                 'TM_CCOEFF_NORMED': (cv2.TM_CCOEFF_NORMED, 0.9),
+                 'SSIM': ('ssim', 0.9)}
+
+# How far (in pixels) a found copy may be from where it was pasted
+LOCATION_TOLERANCE = 3
+
+# How much a found box has to overlap with the real one (intersection over union)
+MIN_OVERLAP = 0.5
+
+
+def latency(times):
+    """Summarizes the time every item took.
+
+    Args:
+        times (list[float]): The seconds every item took.
+
+    Returns:
+        dict: The amount of items, the total time, the throughput (items per second)
+        and the mean, median, 95th percentile and slowest latency in milliseconds.
+    """
+    times = np.asarray(times, dtype=np.float64)
+    total = float(times.sum())
+
+    return {'items': len(times),
+            'seconds': round(total, 6),
+            'throughput': round(len(times) / total, 3) if total > 0 else None,
+            'mean_ms': round(float(times.mean()) * 1000, 3),
+            'p50_ms': round(float(np.percentile(times, 50)) * 1000, 3),
+            'p95_ms': round(float(np.percentile(times, 95)) * 1000, 3),
+            'max_ms': round(float(times.max()) * 1000, 3)}
+
+
+def throughput(seconds, items):
+    """Summarizes a run whose items were not timed one by one, e.g. a batch
+    or a process pool. Only the total and the mean are known, so unlike
+    latency there are no percentiles.
+
+    Args:
+        seconds (float): How long all items took together.
+        items (int): The amount of items.
+
+    Returns:
+        dict: The amount of items, the total time, the throughput (items per second)
+        and the mean latency in milliseconds.
+    """
+    return {'items': items,
+            'seconds': round(seconds, 6),
+            'throughput': round(items / seconds, 3) if seconds > 0 else None,
+            'mean_ms': round(seconds / items * 1000, 3) if items else None}
+
+
+def overlap(first, second):
+    """Returns the intersection over union of two (x, y, w, h) boxes."""
+    w = min(first[0] + first[2], second[0] + second[2]) - max(first[0], second[0])
+    h = min(first[1] + first[3], second[1] + second[3]) - max(first[1], second[1])
+
+    if w <= 0 or h <= 0:
+        return 0.0
+
+    return w * h / (first[2] * first[3] + second[2] * second[3] - w * h)
+
+
+def scores(true_positives, found, expected):
+    """Returns the precision and recall, None where they are undefined."""
+    return {'precision': round(true_positives / found, 4) if found else None,
+            'recall': round(true_positives / expected, 4) if expected else None}
+
+
+def benchmark_matcher(figures):
+    """Searches every figure for the source region of each of its copies
+    with every template matching method, once with the score maps
+    find_matches uses (cv2.matchTemplate, or ssim_map for SSIM) and once
+    with the shared FFT (match_many). Both engines are scored on their own
+    maps. The best match outside the source region counts as found if it
+    is where the copy was pasted; mirrored and rescaled copies are reported
+    separately since template matching is not expected to find them.
+
+    Every flip and rotation of the source regions is matched as well, once
+    with eight cv2.matchTemplate calls and once with match_transforms, which
+    is where mirrored copies should be found.
+
+    Args:
+        figures (list[SyntheticFigure]): The figures.
+
+    Returns:
+        list[dict]: The results of every method and engine.
+    """
+    matcher = ImageMatcher()
+    grays = [cv2.cvtColor(figure.image, cv2.COLOR_BGR2GRAY) for figure in figures]
+    results = []
+
+    for name, (method, threshold) in MATCH_METHODS.items():
+        times = {'cv2': [], 'fft': []}
+        best = {'cv2': [], 'fft': []}
+
+        for gray, figure in zip(grays, figures):
+            templates = [gray[y:y + h, x:x + w] for x, y, w, h in (copy.source for copy in figure.copies)]
+            if not templates:
+                continue
+
+            start = time.perf_counter()
+            if method == 'ssim':
+                cv2_maps = [matcher.ssim_map(gray, template) for template in templates]
+            else:
+                cv2_maps = [cv2.matchTemplate(gray, template, method) for template in templates]
+            times['cv2'].append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            fft_maps = matcher.match_many(gray, templates, method)
+            times['fft'].append(time.perf_counter() - start)
+
+            # Only the best match of every map is kept, the maps of all figures would not fit in memory
+            for engine, score_maps in [('cv2', cv2_maps), ('fft', fft_maps)]:
+                best[engine] += [(copy, *_best_outside(score_map, copy.source, method))
+                                 for copy, score_map in zip(figure.copies, score_maps)]
+
+        for engine in ['cv2', 'fft']:
+            results.append({'benchmark': 'matcher', 'engine': engine, 'method': name, 'latency': latency(times[engine]),
+                            **_match_accuracy(best[engine], method, threshold)})
+
+    # Every flip and rotation of every source region, timed per region
+    times = {'cv2': [], 'fft': []}
+    best = {'cv2': [], 'fft': []}
+    for gray, figure in zip(grays, figures):
+        for copy in figure.copies:
+            x, y, w, h = copy.source
+            template = gray[y:y + h, x:x + w]
+
+            start = time.perf_counter()
+            cv2_maps = {transform: cv2.matchTemplate(gray, _transformed(template, transform), cv2.TM_CCOEFF_NORMED)
+                        for transform in TRANSFORMS}
+            times['cv2'].append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            fft_maps = matcher.match_transforms(gray, template)
+            times['fft'].append(time.perf_counter() - start)
+
+            for engine, score_maps in [('cv2', cv2_maps), ('fft', fft_maps)]:
+                best[engine].append((copy, *_best_transform(score_maps, copy.source)))
+
+    for engine in ['cv2', 'fft']:
+        results.append({'benchmark': 'matcher', 'engine': engine, 'method': 'transforms', 'latency': latency(times[engine]),
+                        **_match_accuracy(best[engine], cv2.TM_CCOEFF_NORMED, MATCH_METHODS['TM_CCOEFF_NORMED'][1])})
+
+    # All panels of a figure against each other
+    for metric in ['mse', 'ssim']:
+        times = []
+        for figure in figures:
+            chunks = [gray[y:y + h, x:x + w] for gray in [cv2.cvtColor(figure.image, cv2.COLOR_BGR2GRAY)]
+                      for x, y, w, h in figure.panels]
+
+            start = time.perf_counter()
+            matcher.similarity_matrix(chunks, metric)
+            times.append(time.perf_counter() - start)
+
+        results.append({'benchmark': 'matcher', 'engine': 'similarity_matrix', 'method': metric, 'latency': latency(times)})
+
+    return results
+
+
+def benchmark_detector(figures):
+    """Runs both copy-move detectors on every figure. A detected region is
+    correct if its source and target boxes overlap with those of a copy
+    (in either order).
+
+    Args:
+        figures (list[SyntheticFigure]): The figures.
+
+    Returns:
+        list[dict]: The results of both detectors.
+    """
+    detector = CopyMoveDetector()
+    results = []
+
+    for name, detect in [('blocks', detector.detect_blocks), ('keypoints', detector.detect_keypoints)]:
+        times = []
+        found = 0
+        correct = 0
+        hits = {}
+        totals = {}
+
+        for figure in figures:
+            start = time.perf_counter()
+            regions = detect(figure.image)
+            times.append(time.perf_counter() - start)
+
+            found += len(regions)
+            matched = set()
+
+            for region in regions:
+                for index, copy in enumerate(figure.copies):
+                    if _same_copy(region, copy):
+                        matched.add(index)
+                        correct += 1
+                        break
+
+            for index, copy in enumerate(figure.copies):
+                totals[copy.transform] = totals.get(copy.transform, 0) + 1
+                if index in matched:
+                    hits[copy.transform] = hits.get(copy.transform, 0) + 1
+
+        # A copy can be found by several regions, so the recall counts the copies instead
+        accuracy = {'precision': scores(correct, found, None)['precision'],
+                    'recall': scores(sum(hits.values()), None, sum(totals.values()))['recall']}
+        accuracy['recall_by_transform'] = {transform: round(hits.get(transform, 0) / total, 4) for transform, total in totals.items()}
+
+        results.append({'benchmark': 'detector', 'engine': name, 'latency': latency(times), **accuracy})
+
+    return results
+
+
+def benchmark_cropper(figures):
+    """Crops the panels of every figure. A panel is found if a crop overlaps
+    with it enough.
+
+    Args:
+        figures (list[SyntheticFigure]): The figures.
+
+    Returns:
+        list[dict]: The results of the cropper.
+    """
+    cropper = ImageCropper()
+    times = []
+    found = 0
+    correct = 0
+    expected = 0
+
+    for figure in figures:
+        start = time.perf_counter()
+        crops = cropper.crop_panels(figure.image)
+        times.append(time.perf_counter() - start)
+
+        found += len(crops)
+        expected += len(figure.panels)
+        correct += sum(any(overlap(box, panel) >= MIN_OVERLAP for panel in figure.panels) for box, _ in crops)
+
+    return [{'benchmark': 'cropper', 'engine': 'crop_panels', 'latency': latency(times), **scores(correct, found, expected)}]
+
+
+def benchmark_classifier(generator, size, count, folder, model=None, batch_size=None):
+    """Filters a corpus of synthetic blots and as many other images. Moving
+    the blots is left out so the corpus is not changed.
+
+    Args:
+        generator (BlotGenerator): Makes the corpus.
+        size (int): The width and height of the images.
+        count (int): The amount of blots (and of other images).
+        folder (str): A folder to write the corpus to.
+        model (str, optional): The model to use. Defaults to None (the classifier's default).
+        batch_size (int, optional): The batch size of filter. Defaults to None (32).
+
+    Returns:
+        list[dict]: The results of the classifier, or why it was skipped.
+    """
+    if batch_size is None:
+        batch_size = 32
+
+    from ForgeryDetector.core.classifying.classify import ImageClassifier, WESTERN_RECOGNIZE_MODEL_PATH
+
+    if model is None:
+        model = WESTERN_RECOGNIZE_MODEL_PATH
+
+    if not os.path.exists(model):
+        return [{'benchmark': 'classifier', 'engine': 'filter', 'skipped': f'model \'{model}\' not found'}]
+
+    generator.corpus(folder, count, negatives=count, truth_path=f'{folder}.json', width=size)
+    classifier = ImageClassifier(model)
+
+    # Loading the model is measured on its own
+    start = time.perf_counter()
+    classifier.model
+    load_time = time.perf_counter() - start
+
+    moved = []
+    classifier.move = lambda first, second, delete: moved.append(os.path.basename(first))
+
+    start = time.perf_counter()
+    classifier.filter(folder, delete=False, batch_size=batch_size)
+    seconds = time.perf_counter() - start
+
+    correct = sum(name.startswith('blot_') for name in moved)
+    return [{'benchmark': 'classifier', 'engine': 'filter', 'batch_size': batch_size, 'load_seconds': round(load_time, 3),
+             'latency': throughput(seconds, 2 * count), **scores(correct, len(moved), count)}]
+
+
+def benchmark_pdf(generator, size, count, folder):
+    """Extracts the figures of synthetic PDFs, both one PDF after the other
+    (extract_images) and in a process pool (extract_images_parallel).
+
+    Args:
+        generator (BlotGenerator): Makes the figures.
+        size (int): The width and height of the figures.
+        count (int): The amount of PDFs, each with three figures.
+        folder (str): A folder to write the PDFs and images to.
+
+    Returns:
+        list[dict]: The results of both extractors.
+    """
+    from ForgeryDetector.core.preprocessing.download import DownloadManager
+
+    pdfs = []
+    for index in range(count):
+        pdf_path = os.path.join(folder, f'PMC{index:07d}.pdf')
+        generator.pdf([generator.figure(size).image for _ in range(3)], pdf_path)
+        pdfs.append(pdf_path)
+
+    expected = 3 * count
+    results = []
+
+    times = []
+    found = 0
+    for pdf_path in pdfs:
+        start = time.perf_counter()
+        image_paths = DownloadManager.PubMed.extract_images(pdf_path, folder)
+        times.append(time.perf_counter() - start)
+        found += len(image_paths)
+        _remove(image_paths)
+
+    results.append({'benchmark': 'pdf', 'engine': 'extract_images', 'latency': latency(times),
+                    **scores(min(found, expected), found, expected)})
+
+    pubmed = DownloadManager.PubMed(threads=1)
+    start = time.perf_counter()
+    image_paths = pubmed.extract_images_parallel([(pdf_path, os.path.basename(pdf_path)[:-4]) for pdf_path in pdfs], folder)
+    seconds = time.perf_counter() - start
+    _remove(image_paths)
+
+    results.append({'benchmark': 'pdf', 'engine': 'extract_images_parallel', 'latency': throughput(seconds, count),
+                    **scores(min(len(image_paths), expected), len(image_paths), expected)})
+
+    return results
+
+
+def compare(previous, current):
+    """Prints how the throughput and the accuracy changed between two runs.
+
+    Args:
+        previous (dict): The older run.
+        current (dict): The newer run.
+    """
+    def key(result):
+        return tuple(result.get(field) for field in ['benchmark', 'engine', 'method', 'size', 'corpus'])
+
+    before = {key(result): result for result in previous['results']}
+
+    for result in current['results']:
+        old = before.get(key(result))
+        if old is None or 'latency' not in result or 'latency' not in old:
+            continue
+
+        name = ' '.join(str(part) for part in key(result) if part is not None)
+        speedup = (result['latency']['throughput'] or 0) / (old['latency']['throughput'] or np.inf)
+        line = f'{name:<55} {speedup:>6.2f}x'
+
+        for field in ['precision', 'recall']:
+            if result.get(field) is not None and old.get(field) is not None:
+                change = result[field] - old[field]
+                line += f'   {field} {result[field]:.3f} ({change:+.3f})'
+                if change < 0:
+                    line += ' WORSE'
+
+        print(line)
+
+
+def run(sizes=None, corpus_sizes=None, seed=None, model=None, skip=None):
+    """Runs every benchmark for every figure size and corpus size.
+
+    Args:
+        sizes (list[int], optional): The figure widths. Defaults to None (SIZES).
+        corpus_sizes (list[int], optional): The amounts of figures. Defaults to None (CORPUS_SIZES).
+        seed (int, optional): The seed of the generator, so runs use the same figures. Defaults to None (0).
+        model (str, optional): The classifier model. Defaults to None.
+        skip (list[str], optional): The benchmarks to leave out. Defaults to None.
+
+    Returns:
+        dict: The run, with information about the machine and the results.
+    """
+    if sizes is None:
+        sizes = SIZES
+
+    if corpus_sizes is None:
+        corpus_sizes = CORPUS_SIZES
+
+    if seed is None:
+        seed = 0
+
+    if skip is None:
+        skip = []
+
+    run_info = {'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'python': sys.version.split()[0],
+                'platform': platform.platform(),
+                'processor': platform.processor(),
+                'cpus': os.cpu_count(),
+                'numpy': np.__version__,
+                'opencv': cv2.__version__,
+                'seed': seed,
+                'sizes': sizes,
+                'corpus_sizes': corpus_sizes}
+    results = []
+
+    for size in sizes:
+        for count in corpus_sizes:
+            # The same seed gives the same figures for every run
+            generator = BlotGenerator(seed)
+            figures = [generator.figure(size, copies=3) for _ in range(count)]
+            folder = tempfile.mkdtemp()
+
+            try:
+                size_results = []
+                if 'matcher' not in skip:
+                    size_results += benchmark_matcher(figures)
+                if 'detector' not in skip:
+                    size_results += benchmark_detector(figures)
+                if 'cropper' not in skip:
+                    size_results += benchmark_cropper(figures)
+                if 'classifier' not in skip:
+                    size_results += benchmark_classifier(generator, size, count, os.path.join(folder, 'corpus'), model)
+                if 'pdf' not in skip:
+                    size_results += benchmark_pdf(generator, size, count, folder)
+            finally:
+                shutil.rmtree(folder, ignore_errors=True)
+
+            for result in size_results:
+                result.update(size=size, corpus=count)
+                print(_describe(result))
+
+            results += size_results
+
+    return {'run': run_info, 'results': results}
+
+
+def _match_accuracy(best, method, threshold):
+    """Scores the best matches of one engine, see benchmark_matcher.
+
+    Args:
+        best (list[tuple(SyntheticCopy, tuple(int, int), float)]): Every copy with the location
+        and score of the best match outside its source.
+        method (cv2.type or str): The method the matches were found with.
+        threshold (float): The score a match needs, None to count every best match.
+
+    Returns:
+        dict: The precision, the recall and the recall of every transform.
+    """
+    found = 0
+    hits = {}
+    totals = {}
+
+    for copy, location, score in best:
+        totals[copy.transform] = totals.get(copy.transform, 0) + 1
+
+        passed = threshold is None or (score <= threshold if method in (cv2.TM_SQDIFF, cv2.TM_SQDIFF_NORMED) else score >= threshold)
+        if not passed:
+            continue
+
+        found += 1
+        if max(abs(location[0] - copy.target[0]), abs(location[1] - copy.target[1])) <= LOCATION_TOLERANCE:
+            hits[copy.transform] = hits.get(copy.transform, 0) + 1
+
+    return {**scores(sum(hits.values()), found, sum(totals.values())),
+            'recall_by_transform': {transform: round(hits.get(transform, 0) / total, 4)
+                                    for transform, total in totals.items()}}
+
+
+def _best_outside(score_map, box, method):
+    """Returns the best location of a score map outside the given box and its score."""
+    score_map = score_map.copy()
+    x, y, w, h = box
+    worst = np.inf if method in (cv2.TM_SQDIFF, cv2.TM_SQDIFF_NORMED) else -np.inf
+
+    # Locations that overlap the template itself are not copies
+    score_map[max(0, y - h + 1):y + h, max(0, x - w + 1):x + w] = worst
+
+    if method in (cv2.TM_SQDIFF, cv2.TM_SQDIFF_NORMED):
+        index = np.argmin(score_map)
+    else:
+        index = np.argmax(score_map)
+
+    row, col = np.unravel_index(index, score_map.shape)
+    return (int(col), int(row)), float(score_map[row, col])
+
+
+def _transformed(template, transform):
+    """Turns a template the way match_transforms does, see TRANSFORMS in match.py."""
+    if transform.startswith('flip'):
+        template = template[:, ::-1]
+
+    turns = {'rot90': 1, 'rot180': 2, 'rot270': 3}.get(transform.split('_')[-1], 0)
+    return np.ascontiguousarray(np.rot90(template, turns))
+
+
+def _best_transform(score_maps, box):
+    """Returns the best location outside the given box over the score maps of
+    every transform, and its score."""
+    x, y, w, h = box
+    best = None
+
+    for transform, score_map in score_maps.items():
+        # Turning by 90 degrees swaps the sides of the template
+        turned = (x, y, h, w) if transform.endswith(('rot90', 'rot270')) else box
+        location, score = _best_outside(score_map, turned, cv2.TM_CCOEFF_NORMED)
+        if best is None or score > best[1]:
+            best = (location, score)
+
+    return best
+
+
+def _same_copy(region, copy):
+    """Returns True if a detected region describes a copy."""
+    return ((overlap(region.source, copy.source) >= MIN_OVERLAP / 2 and overlap(region.target, copy.target) >= MIN_OVERLAP / 2) or
+            (overlap(region.source, copy.target) >= MIN_OVERLAP / 2 and overlap(region.target, copy.source) >= MIN_OVERLAP / 2))
+
+
+def _remove(paths):
+    """Removes files written by a benchmark."""
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def _describe(result):
+    """Formats a result as a single line."""
+    name = ' '.join(str(result[field]) for field in ['benchmark', 'engine', 'method'] if result.get(field) is not None)
+
+    if 'skipped' in result:
+        return f'{name:<40} size {result["size"]:>5} corpus {result["corpus"]:>4}   skipped: {result["skipped"]}'
+
+    line = (f'{name:<40} size {result["size"]:>5} corpus {result["corpus"]:>4}   '
+            f'{result["latency"]["throughput"]:>9} items/s   p95 {result["latency"]["p95_ms"]:>9}ms')
+
+    for field in ['precision', 'recall']:
+        if result.get(field) is not None:
+            line += f'   {field} {result[field]:.3f}'
+
+    return line
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Offline benchmarks on synthetic blot figures.')
+    parser.add_argument('--sizes', type=int, nargs='+', help='The figure widths.')
+    parser.add_argument('--corpus', type=int, nargs='+', help='The amounts of figures.')
+    parser.add_argument('--seed', type=int, help='The seed of the figure generator.')
+    parser.add_argument('--model', help='The classifier model.')
+    parser.add_argument('--skip', nargs='+', choices=['matcher', 'detector', 'cropper', 'classifier', 'pdf'], help='Benchmarks to leave out.')
+    parser.add_argument('--output', help='Where to write the results.')
+    parser.add_argument('--compare', help='An earlier result file to compare with.')
+    args = parser.parse_args()
+
+    benchmark = run(args.sizes, args.corpus, args.seed, args.model, args.skip)
+
+    output = args.output
+    if output is None:
+        os.makedirs(BENCHMARK_RESULTS_PATH, exist_ok=True)
+        output = os.path.join(BENCHMARK_RESULTS_PATH, f'{time.strftime("%Y%m%d-%H%M%S")}.json')
+
+    with open(output, 'w') as file:
+        json.dump(benchmark, file, indent=2)
+    print(f'Results written to \'{output}\'.')
+
+    if args.compare is not None:
+        with open(args.compare) as file:
+            compare(json.load(file), benchmark)
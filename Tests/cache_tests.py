@@ -0,0 +1,61 @@
+# System modules
+import os
+import shutil
+import tempfile
+import unittest
+
+# Custom
+from ForgeryDetector.core.classifying.cache import VerdictCache
+
+
+class VerdictCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'verdicts.db')
+
+        # Two stand-in model files with different content
+        self.models = []
+        for name in ['one.h5', 'two.h5']:
+            model_path = os.path.join(self.folder, name)
+            with open(model_path, 'wb') as file:
+                file.write(name.encode())
+            self.models.append(model_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def test_models_share_a_cache(self):
+        first = VerdictCache(self.models[0], self.path)
+        first.put('image', 0.9)
+
+        second = VerdictCache(self.models[1], self.path)
+        second.put('image', 0.1)
+
+        # Opening the cache with another model leaves the verdicts of the first alone
+        self.assertEqual(first.get('image'), 0.9)
+        self.assertEqual(second.get('image'), 0.1)
+        self.assertEqual(len(first), 1)
+
+        first.close()
+        second.close()
+
+    def test_prune(self):
+        first = VerdictCache(self.models[0], self.path)
+        first.put_many([('a', 0.9), ('b', 0.8)])
+        first.close()
+
+        second = VerdictCache(self.models[1], self.path)
+        second.put('a', 0.1)
+
+        self.assertEqual(second.prune(keep=[self.models[0]]), 0)
+        self.assertEqual(second.prune(), 2)
+        self.assertEqual(second.get('a'), 0.1)
+        second.close()
+
+        first = VerdictCache(self.models[0], self.path)
+        self.assertEqual(first.get_many(['a', 'b']), {})
+        first.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+# System modules
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+# External modules
+import cv2
+import numpy as np
+from PIL import Image
+
+# Custom
+from ForgeryDetector.core.classifying.classify import ImageClassifier, MODEL_INPUT_SIZE
+
+
+class LoadTests(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def test_same_pixels_as_load_img(self):
+        classifier = ImageClassifier('model.onnx')
+        rng = np.random.default_rng(0)
+
+        for index, shape in enumerate([(300, 500), (150, 100), (97, 613)]):
+            image_file = f'{index}.png'
+            cv2.imwrite(os.path.join(self.folder, image_file), rng.integers(0, 256, shape + (3,), dtype=np.uint8))
+
+            # What keras' load_img gives with target_size
+            with Image.open(os.path.join(self.folder, image_file)) as img:
+                expected = np.asarray(img.convert('RGB').resize(MODEL_INPUT_SIZE[::-1], Image.NEAREST), dtype=np.float32) / 255.0
+
+            np.testing.assert_array_equal(classifier._load(self.folder, image_file), expected)
+
+
+class Model():
+    """Stands in for a model, giving the mean pixel value as the blot probability."""
+    def __init__(self, fail=None):
+        self.fail = fail
+        self.batches = []
+
+    def predict_on_batch(self, x):
+        if self.fail:
+            raise RuntimeError('The model failed.')
+
+        self.batches.append(len(x))
+        return x.mean(axis=(1, 2, 3))[:, None]
+
+
+class FilterTests(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+        # Bright images count as blots, dark ones don't
+        for index in range(7):
+            cv2.imwrite(os.path.join(self.folder, f'{index}.png'), np.full((40, 60, 3), 255 if index % 2 else 0, np.uint8))
+
+        with open(os.path.join(self.folder, 'corrupt.png'), 'wb') as file:
+            file.write(b'not an image')
+
+        self.classifier = ImageClassifier('model.onnx', threads=2)
+        self.classifier.model = Model()
+
+        # Moving and deleting is left out, only what filter decides is recorded
+        self.handled = []
+        self.classifier._handle_prediction = lambda folder, image_file, probability, delete: \
+            self.handled.append((image_file, round(float(probability)), delete))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def test_delete_is_passed_on(self):
+        expected = [(f'{index}.png', index % 2, False) for index in range(7)]
+
+        for batch_size in [None, 3]:
+            self.handled.clear()
+            self.classifier.filter(self.folder, delete=False, batch_size=batch_size)
+            self.assertEqual(sorted(self.handled), expected)
+
+    def test_batches(self):
+        self.classifier.filter(self.folder, batch_size=3, prefetch=1)
+
+        # The corrupt image is left out of its batch
+        self.assertEqual(self.classifier.model.batches, [3, 3, 1])
+        self.assertEqual(len(self.handled), 7)
+        self.assertTrue(all(delete for _, _, delete in self.handled))
+
+    def test_model_failure_stops_the_decoder(self):
+        self.classifier.model = Model(fail=True)
+        threads = threading.active_count()
+
+        image_files = sorted(os.listdir(self.folder)) * 20
+        with self.assertRaises(RuntimeError):
+            self.classifier._filter_batched(self.folder, image_files, True, 2, 1)
+
+        self.assertEqual(threading.active_count(), threads)
+        self.assertEqual(self.handled, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,6 @@
+import cv2
 import numpy as np
+from scipy import signal
 from scipy.signal import argrelextrema
 from ForgeryDetector.core.preprocessing.utils import ImageUtilities
 from ForgeryDetector.core.classifying.match import ImageMatcher
@@ -37,3 +39,13 @@ convolution_matrix = match.convolve(image, template)
 # minima_indices = argrelextrema(convolution_matrix, np.less)
 # print(convolution_matrix[minima_indices])
 utils.show(convolution_matrix)
+
+# ZNCC against OpenCV's normalized correlation coefficient
+reference = cv2.matchTemplate(image.astype(np.float32), template.astype(np.float32), cv2.TM_CCOEFF_NORMED)
+for engine in ['direct', 'fft']:
+    zncc = match.zncc(image, template, engine=engine)
+    print(f'ZNCC ({engine}) largest difference to TM_CCOEFF_NORMED: {np.abs(zncc - reference).max():.2e}')
+
+# The FFT correlation against scipy's direct one
+direct = signal.correlate2d(image - image.mean(), template - template.mean(), mode='full')
+print(f'Correlation largest relative difference to correlate2d: {np.abs(correlation_matrix - direct).max() / np.abs(direct).max():.2e}')
@@ -0,0 +1,63 @@
+# System modules
+import os
+import shutil
+import tempfile
+import unittest
+
+# External modules
+import cv2
+import numpy as np
+
+# Custom
+from ForgeryDetector.core.preprocessing.crop import ImageCropper
+from ForgeryDetector.core.preprocessing.synthetic import BlotGenerator
+
+
+class CropPanelsTests(unittest.TestCase):
+    def setUp(self):
+        self.cropper = ImageCropper()
+        self.figure = BlotGenerator(0).figure(panels=4)
+
+    def test_finds_the_panels(self):
+        crops = self.cropper.crop_panels(self.figure.image)
+
+        # From top to bottom, as views of the image
+        self.assertEqual([box for box, _ in crops], self.figure.panels)
+        for (x, y, w, h), crop in crops:
+            self.assertTrue(np.shares_memory(crop, self.figure.image))
+            np.testing.assert_array_equal(crop, self.figure.image[y:y + h, x:x + w])
+
+        gray = cv2.cvtColor(self.figure.image, cv2.COLOR_BGR2GRAY)
+        self.assertEqual([box for box, _ in self.cropper.crop_panels(gray)], self.figure.panels)
+
+    def test_filters(self):
+        image = np.zeros((100, 200), np.uint8)
+        image[10:20, 10:20] = 255      # 10x10
+        image[10:20, 40:100] = 255     # 60x10
+        image[40:90, 120:170] = 255    # 50x50
+
+        def boxes(**filters):
+            return [box for box, _ in self.cropper.crop_panels(image, **filters)]
+
+        self.assertEqual(boxes(), [(10, 10, 10, 10), (40, 10, 60, 10), (120, 40, 50, 50)])
+        self.assertEqual(boxes(min_area=101), [(40, 10, 60, 10), (120, 40, 50, 50)])
+        self.assertEqual(boxes(max_area=600), [(10, 10, 10, 10), (40, 10, 60, 10)])
+        self.assertEqual(boxes(min_aspect=2), [(40, 10, 60, 10)])
+        self.assertEqual(boxes(max_aspect=2), [(10, 10, 10, 10), (120, 40, 50, 50)])
+        self.assertEqual(boxes(threshold=255), [])
+
+    def test_crop_folder(self):
+        folder = tempfile.mkdtemp()
+        try:
+            cv2.imwrite(os.path.join(folder, 'figure.png'), self.figure.image)
+            with open(os.path.join(folder, 'broken.png'), 'wb') as file:
+                file.write(b'not an image')
+
+            # Images that can't be read are left out
+            self.assertEqual(self.cropper.crop_folder(folder, processes=1), {'figure.png': self.figure.panels})
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
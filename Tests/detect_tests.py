@@ -0,0 +1,76 @@
+# System modules
+import unittest
+
+# External modules
+import numpy as np
+
+# Custom
+from ForgeryDetector.core.classifying.detect import CopyMoveDetector
+from ForgeryDetector.core.preprocessing.synthetic import BlotGenerator
+
+
+def inside(box, outer):
+    """Returns True if an (x, y, w, h) box lies within another one."""
+    return (outer[0] <= box[0] and box[0] + box[2] <= outer[0] + outer[2] and
+            outer[1] <= box[1] and box[1] + box[3] <= outer[1] + outer[3])
+
+
+class DetectorTests(unittest.TestCase):
+    def setUp(self):
+        self.detector = CopyMoveDetector()
+
+    def assertFound(self, region, copy):
+        """Checks that a region lies on both ends of a copy, in either direction."""
+        boxes = [copy.source, copy.target]
+        self.assertTrue(inside(region.source, boxes[0]) and inside(region.target, boxes[1]) or
+                        inside(region.source, boxes[1]) and inside(region.target, boxes[0]), f'{region} is not {copy}')
+
+
+class DetectBlocksTests(DetectorTests):
+    def test_finds_pasted_copy(self):
+        for seed in [1, 3]:
+            figure = BlotGenerator(seed).figure(transforms=['paste'])
+            regions = self.detector.detect_blocks(figure.image)
+
+            # The pasted region outvotes the shifts between the evenly spaced lanes
+            copy, = figure.copies
+            self.assertFound(regions[0], copy)
+            self.assertGreater(regions[0].votes, 10 * regions[1].votes)
+
+    def test_flat_image(self):
+        self.assertEqual(self.detector.detect_blocks(np.full((128, 128), 200, np.uint8)), [])
+
+
+class DetectKeypointsTests(DetectorTests):
+    def test_finds_pasted_copy(self):
+        for seed, size in [(1, 256), (0, 512)]:
+            figure = BlotGenerator(seed).figure(size, transforms=['paste'])
+            regions = self.detector.detect_keypoints(figure.image)
+
+            copy, = figure.copies
+            self.assertEqual(len(regions), 1)
+            self.assertFound(regions[0], copy)
+            self.assertFalse(regions[0].mirrored)
+
+    def test_finds_mirrored_copy(self):
+        figure = BlotGenerator(1).figure(256, transforms=['flip'])
+
+        # A mirrored copy is only found when mirrored copies are looked for
+        self.assertEqual(self.detector.detect_keypoints(figure.image), [])
+        regions = self.detector.detect_keypoints(figure.image, mirrored=True)
+
+        copy, = figure.copies
+        self.assertEqual(len(regions), 1)
+        self.assertFound(regions[0], copy)
+        self.assertTrue(regions[0].mirrored)
+
+    def test_unknown_detector(self):
+        figure = BlotGenerator(1).figure(256)
+        self.assertEqual(self.detector.detect_keypoints(figure.image, 'surf'), [])
+
+    def test_flat_image(self):
+        self.assertEqual(self.detector.detect_keypoints(np.full((128, 128), 200, np.uint8)), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
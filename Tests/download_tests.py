@@ -0,0 +1,53 @@
+# System modules
+import os
+import unittest
+import urllib.parse
+
+# Custom
+from ForgeryDetector.core.preprocessing.fetch import HttpFetcher
+from ForgeryDetector.core.preprocessing.download import DownloadManager
+
+# An efetch response with three articles, the second of which has no PMC ID or DOI
+EFETCH_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'Test_data', 'PubMed', 'efetch.xml')
+
+
+class ParseLinksTests(unittest.TestCase):
+    def setUp(self):
+        self.pubmed = DownloadManager.PubMed(threads=1, fetcher=HttpFetcher())
+
+    def parse(self, article_type):
+        with open(EFETCH_PATH, 'rb') as handle:
+            return list(self.pubmed._parse_links(handle, article_type))
+
+    def test_pmc_links(self):
+        # The IDs of sub-articles are not records of their own
+        self.assertEqual(self.parse(DownloadManager.PubMed.ArticleType.PMC),
+                         [('http://www.ncbi.nlm.nih.gov/pmc/articles/PMC1000001/pdf/', 'PMC1000001'),
+                          ('http://www.ncbi.nlm.nih.gov/pmc/articles/PMC1000003/pdf/', 'PMC1000003')])
+
+    def test_doi_links(self):
+        self.assertEqual(self.parse(DownloadManager.PubMed.ArticleType.DOI),
+                         [('http://dx.doi.org/10.1000/one', '10.1000/one'),
+                          ('http://dx.doi.org/10.1000/three', '10.1000/three')])
+
+
+class EutilsTests(unittest.TestCase):
+    def test_credentials_are_sent(self):
+        urls = []
+
+        class Fetcher(HttpFetcher):
+            def fetch(self, url, dest=None):
+                urls.append(url)
+                return b'<eSearchResult/>'
+
+        pubmed = DownloadManager.PubMed(threads=1, fetcher=Fetcher())
+        pubmed.email, pubmed.api_key = 'someone@example.com', None
+        pubmed._eutils('esearch', db='pmc', term='western blot', retmax=None).close()
+
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(urls[0]).query)
+        self.assertEqual(query, {'db': ['pmc'], 'term': ['western blot'], 'tool': ['biopython'],
+                                 'email': ['someone@example.com']})
+
+
+if __name__ == '__main__':
+    unittest.main()
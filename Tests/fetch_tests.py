@@ -0,0 +1,155 @@
+# System modules
+import os
+import time
+import shutil
+import tempfile
+import unittest
+from threading import Lock, Thread
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Custom
+from ForgeryDetector.core.preprocessing.fetch import HttpFetcher
+
+# What the stand-in server sends for /file
+BODY = bytes(range(256)) * 64
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Serves /file (with Range support), /flaky/<n> (fails n times with a
+    503 before it answers), /limited (answers 429 with Retry-After once)
+    and /redirect. Keeps connections alive and counts them."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests.append((self.path, time.monotonic()))
+            seen = sum(path == self.path for path, _ in self.server.requests)
+
+        if self.path.startswith('/flaky/'):
+            if seen <= int(self.path.rsplit('/', 1)[1]):
+                return self.send_body(b'busy', 503)
+            return self.send_body(b'ok')
+
+        if self.path == '/limited':
+            if seen == 1:
+                return self.send_body(b'slow down', 429, {'Retry-After': '1'})
+            return self.send_body(b'ok')
+
+        if self.path == '/redirect':
+            return self.send_body(b'', 302, {'Location': '/file'})
+
+        if self.path == '/file':
+            start = 0
+            status = 200
+            headers = {}
+
+            if self.headers.get('Range'):
+                start = int(self.headers['Range'][len('bytes='):].split('-')[0])
+                status = 206
+                headers['Content-Range'] = f'bytes {start}-{len(BODY) - 1}/{len(BODY)}'
+
+            return self.send_body(BODY[start:], status, headers)
+
+        self.send_body(b'missing', 404)
+
+    def send_body(self, body, status=200, headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class HttpFetcherTests(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+        self.server.daemon_threads = True
+        self.server.lock = Lock()
+        self.server.connections = 0
+        self.server.requests = []
+        Thread(target=self.server.serve_forever, daemon=True).start()
+
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def fetcher(self, **kwargs):
+        fetcher = HttpFetcher(**{'rates': {}, 'backoff': 0.05, **kwargs})
+        self.addCleanup(fetcher.close)
+        return fetcher
+
+    def test_fetch_body(self):
+        self.assertEqual(self.fetcher().fetch(f'{self.url}/file'), BODY)
+
+    def test_retries_with_backoff(self):
+        start = time.monotonic()
+        self.assertEqual(self.fetcher(retries=3).fetch(f'{self.url}/flaky/2'), b'ok')
+
+        # Two failures wait 0.05 and 0.1 seconds, plus up to half of that as jitter
+        self.assertGreaterEqual(time.monotonic() - start, 0.15)
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_gives_up_after_retries(self):
+        self.assertIsNone(self.fetcher(retries=2).fetch(f'{self.url}/flaky/5'))
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_retry_after(self):
+        start = time.monotonic()
+        self.assertEqual(self.fetcher().fetch(f'{self.url}/limited'), b'ok')
+        self.assertGreaterEqual(time.monotonic() - start, 1.0)
+
+    def test_rate_limit(self):
+        # A burst of 2, then 2 requests per second
+        fetcher = self.fetcher(rates={'127.0.0.1': 2.0})
+
+        start = time.monotonic()
+        results = fetcher.fetch_many([(f'{self.url}/file', None)] * 5)
+        self.assertEqual(results, [BODY] * 5)
+        self.assertGreaterEqual(time.monotonic() - start, 1.4)
+
+    def test_keep_alive_reuses_connections(self):
+        fetcher = self.fetcher()
+        for _ in range(10):
+            self.assertEqual(fetcher.fetch(f'{self.url}/file'), BODY)
+
+        self.assertEqual(self.server.connections, 1)
+
+    def test_concurrent_connections_are_limited_per_host(self):
+        fetcher = self.fetcher(threads=8, per_host=2)
+        self.assertEqual(fetcher.fetch_many([(f'{self.url}/file', None)] * 20), [BODY] * 20)
+        self.assertLessEqual(self.server.connections, 2)
+
+    def test_redirect_and_download_to_file(self):
+        dest = os.path.join(self.folder, 'file.bin')
+        self.assertEqual(self.fetcher().fetch(f'{self.url}/redirect', dest), dest)
+
+        with open(dest, 'rb') as file:
+            self.assertEqual(file.read(), BODY)
+
+    def test_resumes_partial_download(self):
+        dest = os.path.join(self.folder, 'file.bin')
+        with open(f'{dest}.part', 'wb') as file:
+            file.write(BODY[:1000])
+
+        self.assertEqual(self.fetcher().fetch(f'{self.url}/file', dest), dest)
+        with open(dest, 'rb') as file:
+            self.assertEqual(file.read(), BODY)
+        self.assertFalse(os.path.exists(f'{dest}.part'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+# System modules
+import os
+import shutil
+import tempfile
+import unittest
+from threading import Thread
+
+# External modules
+import cv2
+import numpy as np
+
+# Custom
+from ForgeryDetector.core.classifying.hashing import HashIndex
+
+
+def flip(image_hash, bits):
+    """Flips the given bits of a hash."""
+    for bit in bits:
+        image_hash ^= 1 << bit
+    return image_hash
+
+
+class HashIndexTests(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.index = HashIndex(os.path.join(self.folder, 'hashes.db'))
+        self.base = 0xF0E1D2C3B4A59687
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def test_near_duplicates_through_segments(self):
+        # 8 bits apart: 2 in every segment, so no segment is equal but each one is within 8 // 4 bits
+        spread = flip(self.base, [0, 1, 16, 17, 32, 33, 48, 63])
+        # 8 bits apart, all in the first segment
+        bunched = flip(self.base, range(8))
+        # 9 bits apart, one too many
+        far = flip(self.base, [0, 1, 2, 16, 17, 32, 33, 48, 49])
+
+        self.index.add_many([('spread', spread), ('bunched', bunched), ('far', far), ('same', self.base)])
+
+        self.assertEqual(sorted(self.index.query(self.base, max_distance=8)), [('bunched', 8), ('same', 0), ('spread', 8)])
+        self.assertEqual(self.index.query(self.base, max_distance=4), [('same', 0)])
+
+    def test_signed_hashes(self):
+        # Hashes with the highest bit set are stored negative, numpy gives them back as int64
+        self.index.add('high', self.base)
+        self.assertEqual(self.index.query(np.int64(self.index._to_signed(self.base)), max_distance=0), [('high', 0)])
+
+    def test_images(self):
+        noise = np.random.default_rng(0).random((64, 64)) * 255
+        image = cv2.GaussianBlur(noise, (0, 0), 3).astype(np.uint8)
+
+        self.index.add('image', image)
+        self.assertEqual([key for key, _ in self.index.query(cv2.resize(image, (96, 96)))], ['image'])
+        self.assertIn('image', self.index)
+
+    def test_threads_share_the_index(self):
+        def add(thread):
+            for i in range(50):
+                self.index.add(f'{thread}:{i}', flip(self.base, [thread * 8 + i % 8]))
+                self.index.query(self.base, max_distance=2)
+
+        threads = [Thread(target=add, args=(thread,)) for thread in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(self.index), 200)
+        self.assertEqual(len(self.index.query(self.base, max_distance=1)), 200)
+
+
+if __name__ == '__main__':
+    unittest.main()
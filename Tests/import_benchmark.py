@@ -0,0 +1,65 @@
+# System modules
+import sys
+import json
+import subprocess
+
+# Every statement is timed in a fresh interpreter, since a module is only imported once per process
+STATEMENTS = ['import ForgeryDetector',
+              'from ForgeryDetector import ImageMatcher',
+              'from ForgeryDetector import ImageCropper',
+              'from ForgeryDetector import DownloadManager',
+              'from ForgeryDetector import ImageClassifier',
+              'from ForgeryDetector import Pipeline']
+
+# Modules that should only be loaded once they are actually used
+HEAVY_MODULES = ['keras', 'tensorflow', 'fitz', 'Bio.Entrez', 'bs4', 'selenium.webdriver', 'matplotlib.pyplot', 'scipy.signal']
+
+# Runs in the fresh interpreter and reports the time and the heavy modules that got loaded
+PROBE = '''
+import sys, time, json
+start = time.perf_counter()
+{statement}
+elapsed = time.perf_counter() - start
+loaded = [name for name in {heavy!r} if name in sys.modules and not type(sys.modules[name]).__name__.startswith('_Lazy')]
+print(json.dumps({{'seconds': elapsed, 'loaded': loaded}}))
+'''
+
+
+def measure(statement, repeat=None):
+    """Imports something in a fresh interpreter a few times.
+
+    Args:
+        statement (str): The import statement.
+        repeat (int, optional): How many interpreters to start. Defaults to None (5).
+
+    Returns:
+        float: The fastest import time in seconds.
+        list[str]: The heavy modules the import loaded.
+    """
+    if repeat is None:
+        repeat = 5
+
+    times = []
+    loaded = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', PROBE.format(statement=statement, heavy=HEAVY_MODULES)],
+                                capture_output=True, text=True)
+        if output.returncode != 0:
+            return None, [output.stderr.strip().splitlines()[-1]]
+
+        result = json.loads(output.stdout.strip().splitlines()[-1])
+        times.append(result['seconds'])
+        loaded = result['loaded']
+
+    return min(times), loaded
+
+
+if __name__ == '__main__':
+    # Run from the folder that contains ForgeryDetector
+    for statement in STATEMENTS:
+        seconds, loaded = measure(statement)
+
+        if seconds is None:
+            print(f'{statement:<50} failed: {loaded[0]}')
+        else:
+            print(f'{statement:<50} {round(seconds * 1000, 1):>8}ms   loaded: {", ".join(loaded) or "-"}')
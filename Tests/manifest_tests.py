@@ -0,0 +1,126 @@
+# System modules
+import os
+import shutil
+import tempfile
+import unittest
+
+# External modules
+import cv2
+import numpy as np
+
+# Custom
+from ForgeryDetector.core.manifest import JobManifest
+from ForgeryDetector.core.pipeline import Pipeline
+
+
+class FakePubMed():
+    """Stands in for DownloadManager.PubMed, every article has two images."""
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.downloaded = []
+
+    def download_article(self, url, article_id, index, path):
+        self.downloaded.append(article_id)
+        pdf = os.path.join(self.folder, f'{article_id}.pdf')
+        open(pdf, 'wb').close()
+        return pdf
+
+    def extract_images(self, pdf, img_path, store=None):
+        name = os.path.splitext(os.path.basename(pdf))[0]
+        image_paths = []
+        for index in range(2):
+            image_path = os.path.join(img_path, f'{name}_{index}.png')
+            cv2.imwrite(image_path, np.full((40, 40, 3), 200, dtype=np.uint8))
+            image_paths.append(image_path)
+        return image_paths
+
+
+class FakeClassifier():
+    """Calls every image a blot."""
+
+    def __init__(self):
+        self.classified = []
+
+    def predict(self, image_paths):
+        self.classified += [os.path.basename(image_path) for image_path in image_paths]
+        return [0.99] * len(image_paths)
+
+
+class JobManifestTests(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.manifest = JobManifest(os.path.join(self.folder, 'jobs.db'), max_attempts=2)
+
+    def tearDown(self):
+        self.manifest.close()
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def test_todo_retries_until_max_attempts(self):
+        self.manifest.mark('article', 'A', 'download', 'failed')
+        self.assertEqual(self.manifest.todo('article', ['A'], 'download'), ['A'])
+
+        self.manifest.mark('article', 'A', 'download', 'failed')
+        self.assertEqual(self.manifest.get('article', 'A')['attempts'], 2)
+        self.assertEqual(self.manifest.todo('article', ['A'], 'download'), [])
+
+    def test_todo_gives_up_on_earlier_stage(self):
+        for _ in range(5):
+            self.manifest.mark('article', 'A', 'download', 'failed')
+
+        self.manifest.mark('article', 'B', 'download', 'failed')
+        self.assertEqual(self.manifest.todo('article', ['A', 'B', 'C'], 'extract'), ['B', 'C'])
+
+    def test_todo_skips_finished_stages(self):
+        self.manifest.mark('article', 'A', 'extract')
+        self.manifest.mark('article', 'B', 'download')
+        self.assertEqual(self.manifest.todo('article', ['A', 'B'], 'extract'), ['B'])
+        self.assertEqual(self.manifest.todo('article', ['A', 'B'], 'download'), [])
+
+
+class PipelineResumeTests(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.img_path = os.path.join(self.folder, 'images')
+        self.filtered_path = os.path.join(self.folder, 'blots')
+        os.makedirs(self.img_path)
+        os.makedirs(self.filtered_path)
+
+        self.manifest = JobManifest(os.path.join(self.folder, 'jobs.db'))
+        self.pubmed = FakePubMed(self.folder)
+        self.classifier = FakeClassifier()
+
+    def tearDown(self):
+        self.manifest.close()
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def run_pipeline(self, articles):
+        pipeline = Pipeline(pubmed=self.pubmed, classifier=self.classifier, threads=2, manifest=self.manifest)
+        return list(pipeline.run(articles, pdf_path=self.folder, img_path=self.img_path, filtered_path=self.filtered_path))
+
+    def test_rerun_only_processes_new_articles(self):
+        self.assertEqual(len(self.run_pipeline([('url_a', 'A'), ('url_b', 'B')])), 4)
+        self.assertEqual(len(self.run_pipeline([('url_a', 'A'), ('url_b', 'B'), ('url_c', 'C')])), 2)
+
+        self.assertEqual(sorted(self.pubmed.downloaded), ['A', 'B', 'C'])
+        self.assertEqual(self.manifest.summary()['image']['match']['done'], 6)
+
+    def test_resume_finds_unclassified_images(self):
+        # An image that was extracted, and one that was moved to the blots just before a crash
+        for image_path in [os.path.join(self.img_path, 'A_0.png'), os.path.join(self.filtered_path, 'A_1.png')]:
+            cv2.imwrite(image_path, np.full((40, 40, 3), 200, dtype=np.uint8))
+        self.manifest.mark_many('image', ['A_0.png', 'A_1.png', 'A_2.png'], 'extract', article='A')
+
+        # A blot that was classified but not matched
+        cv2.imwrite(os.path.join(self.filtered_path, 'B_0.png'), np.full((40, 40, 3), 200, dtype=np.uint8))
+        self.manifest.mark('image', 'B_0.png', 'classify', result={'probability': 0.99, 'blot': True})
+
+        results = self.run_pipeline([])
+
+        self.assertEqual(sorted(self.classifier.classified), ['A_0.png', 'A_1.png'])
+        self.assertEqual(sorted(os.path.basename(result.figure) for result in results), ['A_0.png', 'A_1.png', 'B_0.png'])
+        self.assertEqual(self.run_pipeline([]), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,208 @@
+# System modules
+import os
+import unittest
+
+# External modules
+import cv2
+import numpy as np
+from skimage.metrics import structural_similarity
+
+# Custom
+from ForgeryDetector.core.classifying.match import ImageMatcher
+
+# A strip whose lanes at x=166 and x=322 are the same
+STRIP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'Test_data', 'Strips', 'strip_1.png')
+
+# Six chunks of the same strip, all 80x41
+CHUNKS_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'Test_data', 'Chunks')
+
+
+def blot_image(height, width, seed=None):
+    """Returns a smooth random grayscale image, which has structure at every offset."""
+    if seed is None:
+        seed = 0
+
+    noise = np.random.default_rng(seed).random((height, width)) * 255
+    return cv2.GaussianBlur(noise, (0, 0), 2).astype(np.uint8)
+
+
+class SsimMapTests(unittest.TestCase):
+    def setUp(self):
+        self.matcher = ImageMatcher()
+        self.image = blot_image(40, 50)
+
+    def test_agrees_with_skimage(self):
+        # For a 7x7 template the whole window is one SSIM window, like skimage's default
+        template = self.image[12:19, 20:27]
+        res = self.matcher.ssim_map(self.image, template)
+        self.assertEqual(res.shape, (34, 44))
+
+        for x, y in [(0, 0), (20, 12), (5, 30), (43, 33), (17, 3)]:
+            window = self.image[y:y + 7, x:x + 7]
+            expected = structural_similarity(window, template, data_range=255)
+            self.assertAlmostEqual(float(res[y, x]), expected, places=4)
+
+        self.assertAlmostEqual(float(res[12, 20]), 1.0, places=5)
+
+    def test_constant_float_image(self):
+        image = np.full((20, 20), 0.5, dtype=np.float32)
+        res = self.matcher.ssim_map(image, image[5:12, 5:12])
+        self.assertFalse(np.isnan(res).any())
+
+    def test_template_larger_than_image(self):
+        template = blot_image(50, 50)
+        self.assertIsNone(self.matcher.ssim_map(self.image[:20, :20], template))
+        self.assertEqual(self.matcher.find_matches(self.image[:20, :20], template, 'ssim'), [])
+
+        image = cv2.cvtColor(self.image[:20, :20], cv2.COLOR_GRAY2BGR)
+        for method in ['ssim', cv2.TM_CCOEFF_NORMED]:
+            self.assertIs(self.matcher.match_image(image, template, method), image)
+
+
+class MatchManyTests(unittest.TestCase):
+    def test_agrees_with_match_template(self):
+        matcher = ImageMatcher()
+        image = blot_image(70, 90, seed=4)
+        templates = [image[10:25, 30:50], image[40:52, 5:17], blot_image(9, 13, seed=5), blot_image(80, 20)]
+
+        for method in [cv2.TM_SQDIFF, cv2.TM_SQDIFF_NORMED, cv2.TM_CCORR, cv2.TM_CCORR_NORMED,
+                       cv2.TM_CCOEFF, cv2.TM_CCOEFF_NORMED]:
+            score_maps = matcher.match_many(image, templates, method)
+            peaks = matcher.match_many(image, templates, method, peaks=True)
+
+            # The last template is taller than the image
+            self.assertIsNone(score_maps[-1])
+            self.assertIsNone(peaks[-1])
+
+            for template, res, (score, location) in zip(templates[:-1], score_maps, peaks):
+                expected = cv2.matchTemplate(image, template, method)
+                scale = max(1.0, float(np.abs(expected).max()))
+                # cv2 sums in float32, which is off by up to about 2e-4 for the CCOEFF methods
+                np.testing.assert_allclose(res / scale, expected / scale, atol=1e-3)
+
+                min_val, max_val, min_loc, max_loc = cv2.minMaxLoc(expected)
+                best = min_loc if method in [cv2.TM_SQDIFF, cv2.TM_SQDIFF_NORMED] else max_loc
+                self.assertEqual(location, best)
+                self.assertAlmostEqual(score / scale, float(expected[best[::-1]]) / scale, places=3)
+
+
+class MatchCropsTests(unittest.TestCase):
+    def test_finds_copied_crop(self):
+        image = blot_image(80, 120)
+        image[40:70, 70:110] = image[5:35, 10:50]
+        crops = [((10, 5, 40, 30), image[5:35, 10:50]), ((70, 10, 30, 20), image[10:30, 70:100])]
+
+        # The copy is found, the crops themselves are not
+        matches = ImageMatcher().match_crops(cv2.cvtColor(image, cv2.COLOR_GRAY2BGR), crops)
+        self.assertEqual([(index, x, y) for index, x, y, _ in matches], [(0, 70, 40)])
+        self.assertAlmostEqual(matches[0][3], 1.0, places=4)
+
+    def test_agrees_with_find_matches(self):
+        matcher = ImageMatcher()
+        image = blot_image(60, 90, seed=1)
+        image[30:50, 50:80] = image[2:22, 4:34]
+        crops = [((4, 2, 30, 20), image[2:22, 4:34]), ((40, 5, 12, 12), image[5:17, 40:52])]
+
+        for method, threshold in [(cv2.TM_CCOEFF_NORMED, 0.5), (cv2.TM_SQDIFF_NORMED, 0.2), ('ssim', 0.3)]:
+            expected = []
+            for index, ((x, y, w, h), crop_image) in enumerate(crops):
+                expected += [(index, mx, my) for mx, my, _ in matcher.find_matches(image, crop_image, method, threshold)
+                             if abs(mx - x) >= w or abs(my - y) >= h]
+
+            matches = matcher.match_crops(image, crops, method, threshold)
+            self.assertEqual(sorted((index, x, y) for index, x, y, _ in matches), sorted(expected))
+
+
+class SimilarityMatrixTests(unittest.TestCase):
+    def setUp(self):
+        self.matcher = ImageMatcher()
+        self.chunks = [cv2.imread(os.path.join(CHUNKS_PATH, f'strip1_chunk{index}.png')) for index in range(1, 7)]
+        self.gray = [cv2.cvtColor(chunk, cv2.COLOR_BGR2GRAY) for chunk in self.chunks]
+
+    def test_agrees_with_pairwise_scores(self):
+        mse = self.matcher.similarity_matrix(self.chunks, 'mse', block_size=4)
+        ssim = self.matcher.similarity_matrix(self.chunks, 'ssim', block_size=4)
+
+        for i in range(6):
+            for j in range(6):
+                expected = np.square(self.gray[i].astype(np.float64) - self.gray[j]).mean()
+                self.assertAlmostEqual(mse[i, j], expected, places=6)
+                self.assertAlmostEqual(ssim[i, j], structural_similarity(self.gray[i], self.gray[j]), places=6)
+
+    def test_resizes_to_the_median_size(self):
+        chunks = self.gray[:2] + [cv2.resize(self.gray[2], (120, 60))]
+        matrix = self.matcher.similarity_matrix(chunks, 'ssim')
+
+        expected = structural_similarity(self.gray[0], cv2.resize(chunks[2], (80, 41), interpolation=cv2.INTER_AREA))
+        self.assertAlmostEqual(matrix[0, 2], expected, places=6)
+        np.testing.assert_array_equal(matrix, matrix.T)
+
+    def test_prefilter(self):
+        full = self.matcher.similarity_matrix(self.chunks, 'mse')
+        filtered = self.matcher.similarity_matrix(self.chunks, 'mse', prefilter=10)
+
+        # Pairs the thumbnails rule out are NaN, the others keep their score
+        kept = ~np.isnan(filtered)
+        self.assertTrue(kept.diagonal().all())
+        self.assertTrue(6 < kept.sum() < 36)
+        np.testing.assert_array_equal(filtered[kept], full[kept])
+
+    def test_unknown_metric(self):
+        self.assertIsNone(self.matcher.similarity_matrix(self.chunks, 'psnr'))
+
+
+class ProfileSimilarityTests(unittest.TestCase):
+    def setUp(self):
+        self.matcher = ImageMatcher()
+
+    def test_agrees_with_pearson(self):
+        profiles = np.random.default_rng(2).random((5, 32)).astype(np.float32)
+        scores = self.matcher.profile_similarity(profiles, max_shift=3)
+
+        # The best Pearson correlation of the overlapping samples over all shifts
+        for i in range(5):
+            for j in range(5):
+                expected = max(np.corrcoef(profiles[i, max(shift, 0):32 + min(shift, 0)],
+                                           profiles[j, max(-shift, 0):32 - max(shift, 0)])[0, 1]
+                               for shift in range(-3, 4))
+                self.assertAlmostEqual(float(scores[i, j]), expected, places=5)
+
+    def test_shifted_copy_and_flat_profile(self):
+        profile = np.random.default_rng(3).random(40)
+        profiles = np.stack([profile, np.roll(profile, 4), np.ones(40)])
+        profiles[1, :4] = 0
+
+        scores = self.matcher.profile_similarity(profiles, max_shift=5)
+        self.assertAlmostEqual(float(scores[0, 1]), 1.0, places=5)
+        self.assertEqual(float(scores[0, 2]), 0.0)
+
+        scores = self.matcher.profile_similarity(profiles, max_shift=2)
+        self.assertLess(float(scores[0, 1]), 0.9)
+
+        with self.assertRaises(ValueError):
+            self.matcher.profile_similarity(profiles, profiles[:, :20])
+
+
+class MatchLanesTests(unittest.TestCase):
+    def setUp(self):
+        self.matcher = ImageMatcher()
+        self.strip = cv2.imread(STRIP_PATH, cv2.IMREAD_GRAYSCALE)
+
+    def test_finds_the_copied_lane(self):
+        matches = self.matcher.match_lanes([self.strip])
+
+        self.assertEqual([(first, second) for _, _, first, second in matches],
+                         [((0, (166, 0, 66, 42)), (0, (322, 0, 67, 42)))])
+        self.assertGreater(matches[0][0], 0.99)
+
+    def test_across_chunks(self):
+        # The chunks come from a generator, which is read into a list first
+        chunks = (chunk for chunk in [self.strip[:, :240], self.strip[:, 240:]])
+        matches = self.matcher.match_lanes(chunks)
+
+        self.assertEqual([(first[0], second[0]) for _, _, first, second in matches], [(0, 1)])
+        self.assertEqual(matches[0][3][1][0], 322 - 240)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+# System modules
+import os
+import time
+import shutil
+import tempfile
+import unittest
+from threading import Lock, Thread
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Custom
+from ForgeryDetector.core.manifest import JobManifest
+from ForgeryDetector.core.preprocessing.fetch import HttpFetcher
+from ForgeryDetector.core.preprocessing.download import DownloadManager, PUBPEER_IMG_PATH
+
+# The publications of the stand-in site, BROKEN always fails
+PUBLICATIONS = ['P0', 'P1', 'P2', 'P3', 'BROKEN', 'P4']
+
+
+def page(base, publication):
+    """The HTML of a publication: two images on the image host and a logo that is not."""
+    images = ''.join(f'<img src="{base}/images/{publication}_{index}.png">' for index in range(2))
+    return f'<html><body><img src="{base}/logo.png">{images}</body></html>'.encode()
+
+
+class StandInSite(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        base = f'http://127.0.0.1:{self.server.server_address[1]}'
+
+        if self.path == '/publications/BROKEN':
+            body, status = b'error', 500
+        elif self.path.startswith('/publications/'):
+            body, status = page(base, self.path.rsplit('/', 1)[1]), 200
+        elif self.path.startswith('/images/'):
+            body, status = self.path.encode(), 200
+        else:
+            body, status = b'missing', 404
+
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakeDriver():
+    """Stands in for a browser, loading the pages of the stand-in site."""
+
+    def __init__(self, base, active):
+        self.base = base
+        self.active = active
+        self.page_source = ''
+
+    def get(self, url):
+        with self.active['lock']:
+            self.active['now'] += 1
+            self.active['most'] = max(self.active['most'], self.active['now'])
+
+        try:
+            time.sleep(0.05)
+            if url.endswith('BROKEN'):
+                raise TimeoutError('The page did not load.')
+            self.page_source = page(self.base, url.rsplit('/', 1)[1]).decode()
+        finally:
+            with self.active['lock']:
+                self.active['now'] -= 1
+
+
+class PubPeerScrapeTests(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StandInSite)
+        self.server.daemon_threads = True
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base = f'http://127.0.0.1:{self.server.server_address[1]}'
+
+        # The images are saved relative to the working directory
+        self.cwd = os.getcwd()
+        self.folder = tempfile.mkdtemp()
+        os.chdir(self.folder)
+        os.makedirs(PUBPEER_IMG_PATH)
+
+        fetcher = HttpFetcher(rates={}, retries=1, backoff=0.01)
+        self.pubpeer = DownloadManager.PubPeer(threads=4, headless=True, fetcher=fetcher, site=self.base,
+                                               image_site=f'{self.base}/images')
+        self.articles = [f'{self.base}/publications/{publication}' for publication in PUBLICATIONS]
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.server.shutdown()
+        self.server.server_close()
+        self.pubpeer.fetcher.close()
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def test_http_scrape_survives_a_broken_page(self):
+        manifest = JobManifest(os.path.join(self.folder, 'jobs.db'))
+        self.pubpeer.download(self.articles, mode='http', manifest=manifest)
+
+        saved = sorted(os.listdir(PUBPEER_IMG_PATH))
+        self.assertEqual(saved, sorted(f'Pubpeer_{publication}_{index}.jpg' for publication in PUBLICATIONS
+                                       if publication != 'BROKEN' for index in [1, 2]))
+
+        self.assertEqual(manifest.get('article', f'{self.base}/publications/BROKEN')['state'], 'failed')
+        self.assertEqual(manifest.get('article', f'{self.base}/publications/P0')['result'], 2)
+
+        # Only the broken publication is visited again
+        self.assertEqual(manifest.todo('article', self.articles, 'extract'), [f'{self.base}/publications/BROKEN'])
+        manifest.close()
+
+    def test_browsers_visit_concurrently_and_skip_errors(self):
+        active = {'lock': Lock(), 'now': 0, 'most': 0}
+        self.pubpeer.drivers = [FakeDriver(self.base, active) for _ in range(3)]
+        self.pubpeer._wait_ready = lambda driver: None
+
+        soups = self.pubpeer._soupify(self.articles, 'browser', 3)
+
+        self.assertIsNone(soups[PUBLICATIONS.index('BROKEN')])
+        self.assertEqual([len(soup.find_all('img')) for soup in soups if soup is not None], [3] * 5)
+        self.assertGreater(active['most'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
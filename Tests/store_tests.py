@@ -0,0 +1,66 @@
+# System modules
+import os
+import shutil
+import tempfile
+import unittest
+
+# Custom
+from ForgeryDetector.core.preprocessing.store import ImageStore
+
+
+class ImageStoreTests(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.store = ImageStore(os.path.join(self.folder, 'store'))
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def blob_files(self):
+        return [name for _, _, names in os.walk(self.store.blob_path) for name in names]
+
+    def test_identical_content_is_stored_once(self):
+        first_hash, first_path, first_new = self.store.put(b'image', 'PNG', 'pubmed', 'PMC1', 1, 10)
+        second_hash, second_path, second_new = self.store.put(b'image', '.png', 'pubpeer', url='https://example.com/a.png')
+
+        self.assertEqual((first_hash, first_path), (second_hash, second_path))
+        self.assertEqual((first_new, second_new), (True, False))
+        self.assertEqual(len(self.store), 1)
+        self.assertEqual(self.blob_files(), [os.path.basename(first_path)])
+
+        # Both places the image was found are kept, the same place only once
+        self.store.put(b'image', 'png', 'pubmed', 'PMC1', 1, 10)
+        self.assertEqual(sorted(self.store.sources(first_hash), key=str),
+                         [('pubmed', 'PMC1', 1, 10, None), ('pubpeer', None, None, None, 'https://example.com/a.png')])
+        self.assertEqual(self.store.blobs('pubpeer'), [first_hash])
+
+    def test_stores_sharing_a_root(self):
+        other = ImageStore(self.store.root)
+
+        _, _, first_new = self.store.put(b'image', 'png', 'pubmed', 'PMC1')
+        _, _, second_new = other.put(b'image', 'png', 'pubmed', 'PMC2')
+        other.close()
+
+        self.assertEqual((first_new, second_new), (True, False))
+        self.assertEqual(len(self.store), 1)
+        self.assertEqual(len(self.blob_files()), 1)
+
+    def test_put_file_and_export(self):
+        image_path = os.path.join(self.folder, 'figure.jpg')
+        with open(image_path, 'wb') as file:
+            file.write(b'jpeg')
+
+        blob_hash, blob_path, new = self.store.put_file(image_path, 'pubmed', 'PMC1')
+        self.assertTrue(new)
+        self.assertIn(blob_hash, self.store)
+        self.assertEqual(self.store.path(blob_hash), blob_path)
+
+        export_path = self.store.export(blob_hash, self.folder)
+        self.assertEqual(os.path.basename(export_path), f'{blob_hash}.jpg')
+        with open(export_path, 'rb') as file:
+            self.assertEqual(file.read(), b'jpeg')
+
+
+if __name__ == '__main__':
+    unittest.main()
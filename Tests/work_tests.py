@@ -0,0 +1,142 @@
+# System modules
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+# Custom
+from ForgeryDetector.core.work import SqliteQueue, Worker, WorkQueue
+
+
+class SqliteQueueTests(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.queue = SqliteQueue(os.path.join(self.folder, 'work.db'), max_attempts=3, retry_delay=0.1)
+
+    def tearDown(self):
+        self.queue.close()
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def test_expired_lease_is_leased_again(self):
+        job_id = self.queue.put('echo', {'value': 1})
+        self.assertEqual([job.id for job in self.queue.lease('stale', lease_seconds=0.05)], [job_id])
+
+        # The job is not handed out again while the lease holds
+        self.assertEqual(self.queue.lease('other'), [])
+
+        time.sleep(0.1)
+        jobs = self.queue.lease('other')
+        self.assertEqual([job.id for job in jobs], [job_id])
+        self.assertEqual(jobs[0].attempts, 2)
+
+    def test_stale_worker_cannot_complete(self):
+        job_id = self.queue.put('echo', {'value': 1})
+        self.queue.lease('stale', lease_seconds=0.05)
+        time.sleep(0.1)
+        self.queue.lease('other')
+
+        self.assertFalse(self.queue.complete(job_id, 'stale', 'late'))
+        self.assertFalse(self.queue.fail(job_id, 'stale', 'late'))
+        self.assertTrue(self.queue.complete(job_id, 'other', 'on time'))
+        self.assertEqual(self.queue.results('echo'), [(job_id, {'value': 1}, 'on time')])
+
+    def test_expired_lease_gives_up(self):
+        queue = SqliteQueue(self.queue.path, max_attempts=1)
+        job_id = queue.put('echo', {'value': 1})
+        queue.lease('stale', lease_seconds=0.05)
+        time.sleep(0.1)
+
+        self.assertEqual(queue.lease('other'), [])
+        self.assertEqual(queue.results(state='failed'), [(job_id, {'value': 1}, 'The lease ran out too often.')])
+        queue.close()
+
+    def test_failed_job_waits_for_retry(self):
+        job_id = self.queue.put('echo', {'value': 1})
+        self.queue.lease('worker')
+        self.queue.fail(job_id, 'worker', 'flaky')
+
+        self.assertEqual(self.queue.lease('worker'), [])
+        self.assertGreater(self.queue.next_ready(), 0)
+
+        time.sleep(0.15)
+        self.assertEqual([job.id for job in self.queue.lease('worker')], [job_id])
+
+    def test_next_ready_is_none_when_finished(self):
+        job_id = self.queue.put('echo', {'value': 1})
+        self.assertLessEqual(self.queue.next_ready(), 0)
+        self.assertIsNone(self.queue.next_ready(tasks=['other']))
+
+        self.queue.lease('worker')
+        self.queue.complete(job_id, 'worker')
+        self.assertIsNone(self.queue.next_ready())
+
+
+class WorkerTests(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.queue = SqliteQueue(os.path.join(self.folder, 'work.db'), max_attempts=3, retry_delay=0.1)
+
+    def tearDown(self):
+        self.queue.close()
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def test_worker_waits_for_retries(self):
+        calls = []
+
+        def flaky(payload):
+            calls.append(payload)
+            if len(calls) == 1:
+                raise ConnectionError('flaky')
+            return payload['value']
+
+        self.queue.put('flaky', {'value': 1})
+        ran = Worker(self.queue, {'flaky': flaky}, poll=0.05).run()
+
+        self.assertEqual(ran, 2)
+        self.assertEqual(self.queue.counts()['done'], 1)
+        self.assertTrue(self.queue.wait(timeout=1))
+
+    def test_worker_gives_up(self):
+        def broken(payload):
+            raise ValueError('broken')
+
+        self.queue.put('broken', {'value': 1})
+        ran = Worker(self.queue, {'broken': broken}, poll=0.05).run()
+
+        self.assertEqual(ran, 3)
+        self.assertEqual(self.queue.counts()['failed'], 1)
+
+    def test_batch_leases_are_extended(self):
+        stolen = []
+
+        def slow(payload):
+            time.sleep(0.2)
+
+            # By now the batch was leased longer ago than lease_seconds
+            if payload['value'] == 2:
+                stolen.extend(self.queue.lease('thief', count=3))
+            return payload['value']
+
+        self.queue.put_many('slow', [{'value': 1}, {'value': 2}, {'value': 3}])
+        worker = Worker(self.queue, {'slow': slow}, name='batch', lease_seconds=0.3, batch=3, poll=0.05)
+
+        self.assertEqual(worker.run(), 3)
+        self.assertEqual(stolen, [])
+        self.assertEqual([result for _, _, result in self.queue.results('slow')], [1, 2, 3])
+
+    def test_queue_has_to_be_a_work_queue(self):
+        class Incomplete(WorkQueue):
+            def put_many(self, task, payloads, shard=None):
+                return []
+
+        # A backend that leaves out methods of the interface can't be created
+        with self.assertRaises(TypeError):
+            Incomplete()
+
+        self.assertIsInstance(self.queue, WorkQueue)
+        with self.assertRaises(ValueError):
+            Worker(self.folder)
+
+if __name__ == '__main__':
+    unittest.main()
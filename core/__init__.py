@@ -1,5 +1,44 @@
-from ForgeryDetector.core.classifying.classify import ImageClassifier
-from ForgeryDetector.core.classifying.match import ImageMatcher
-from ForgeryDetector.core.preprocessing.crop import ImageCropper
-from ForgeryDetector.core.preprocessing.download import DownloadManager
-from ForgeryDetector.core.preprocessing.utils import ImageUtilities
\ No newline at end of file
+from importlib import import_module
+
+# The classes are only imported once they are used, so that importing the
+# package does not load TensorFlow, PyMuPDF or Selenium up front.
+_EXPORTS = {
+    'ImageClassifier': 'ForgeryDetector.core.classifying.classify',
+    'VerdictCache': 'ForgeryDetector.core.classifying.cache',
+    'ModelExporter': 'ForgeryDetector.core.classifying.export',
+    'ImageMatcher': 'ForgeryDetector.core.classifying.match',
+    'HashIndex': 'ForgeryDetector.core.classifying.hashing',
+    'ImageHasher': 'ForgeryDetector.core.classifying.hashing',
+    'CopyMoveDetector': 'ForgeryDetector.core.classifying.detect',
+    'ChunkArchive': 'ForgeryDetector.core.preprocessing.archive',
+    'ImageCropper': 'ForgeryDetector.core.preprocessing.crop',
+    'LaneProfiler': 'ForgeryDetector.core.preprocessing.lanes',
+    'DownloadManager': 'ForgeryDetector.core.preprocessing.download',
+    'HttpFetcher': 'ForgeryDetector.core.preprocessing.fetch',
+    'ImageStore': 'ForgeryDetector.core.preprocessing.store',
+    'BlotGenerator': 'ForgeryDetector.core.preprocessing.synthetic',
+    'ImageUtilities': 'ForgeryDetector.core.preprocessing.utils',
+    'Pipeline': 'ForgeryDetector.core.pipeline',
+    'JobManifest': 'ForgeryDetector.core.manifest',
+    'WorkQueue': 'ForgeryDetector.core.work',
+    'SqliteQueue': 'ForgeryDetector.core.work',
+    'Worker': 'ForgeryDetector.core.work',
+    'Metrics': 'ForgeryDetector.core.metrics',
+    'JsonSink': 'ForgeryDetector.core.metrics',
+    'PrometheusSink': 'ForgeryDetector.core.metrics',
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name):
+    if name in _EXPORTS:
+        value = getattr(import_module(_EXPORTS[name]), name)
+        globals()[name] = value
+        return value
+
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
\ No newline at end of file
@@ -1,2 +1,28 @@
-from ForgeryDetector.core.classifying.classify import ImageClassifier
-from ForgeryDetector.core.classifying.match import ImageMatcher
\ No newline at end of file
+from importlib import import_module
+
+# The classes are only imported once they are used, so that importing the
+# package does not load TensorFlow, PyMuPDF or Selenium up front.
+_EXPORTS = {
+    'ImageClassifier': 'ForgeryDetector.core.classifying.classify',
+    'VerdictCache': 'ForgeryDetector.core.classifying.cache',
+    'ModelExporter': 'ForgeryDetector.core.classifying.export',
+    'ImageMatcher': 'ForgeryDetector.core.classifying.match',
+    'HashIndex': 'ForgeryDetector.core.classifying.hashing',
+    'ImageHasher': 'ForgeryDetector.core.classifying.hashing',
+    'CopyMoveDetector': 'ForgeryDetector.core.classifying.detect',
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name):
+    if name in _EXPORTS:
+        value = getattr(import_module(_EXPORTS[name]), name)
+        globals()[name] = value
+        return value
+
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
\ No newline at end of file
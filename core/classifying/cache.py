@@ -0,0 +1,136 @@
+# System modules
+import os
+import sqlite3
+import hashlib
+from threading import Lock
+
+# The default location of the cache
+VERDICT_CACHE_PATH = r'Data\Blot data\verdicts.db'
+
+
+class VerdictCache():
+    """Remembers the blot probability the classifier gave each image. The
+    images are identified by the hash of their content and the verdicts by
+    the hash of the model file, so renamed or re-downloaded images are
+    still found, and a cache can be shared by several models without them
+    seeing each other's verdicts. Verdicts of models that are no longer
+    used are only removed by prune.
+    """
+
+    def __init__(self, model_path, path=None):
+        if path is None:
+            path = VERDICT_CACHE_PATH
+
+        self.path = path
+        self.fingerprint = self.content_hash(model_path)
+
+        # The classifier uses the cache from several threads
+        self.lock = Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+
+        with self.lock, self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS verdicts '
+                                    '(hash TEXT, model TEXT, probability REAL, PRIMARY KEY (hash, model))')
+
+    def __len__(self):
+        """Returns the amount of verdicts of this model."""
+        with self.lock:
+            return self.connection.execute('SELECT COUNT(*) FROM verdicts WHERE model = ?', (self.fingerprint,)).fetchone()[0]
+
+    def close(self):
+        """Closes the connection to the cache."""
+        self.connection.close()
+
+    def get(self, image_hash):
+        """Looks up the verdict of an image.
+
+        Args:
+            image_hash (str): The content hash of the image.
+
+        Returns:
+            float: The blot probability, or None if the image has not been classified yet.
+        """
+        return self.get_many([image_hash]).get(image_hash)
+
+    def get_many(self, image_hashes):
+        """Looks up the verdicts of several images.
+
+        Args:
+            image_hashes (list[str]): The content hashes of the images.
+
+        Returns:
+            dict[str, float]: The blot probability of every image that has been classified before.
+        """
+        verdicts = {}
+        image_hashes = list(image_hashes)
+
+        with self.lock:
+            # SQLite limits the amount of parameters per query
+            for start in range(0, len(image_hashes), 500):
+                part = image_hashes[start:start + 500]
+                rows = self.connection.execute(f'SELECT hash, probability FROM verdicts WHERE model = ? '
+                                               f'AND hash IN ({", ".join("?" * len(part))})', [self.fingerprint, *part])
+                verdicts.update(rows)
+
+        return verdicts
+
+    def put(self, image_hash, probability):
+        """Stores the verdict of an image.
+
+        Args:
+            image_hash (str): The content hash of the image.
+            probability (float): The blot probability the model gave the image.
+        """
+        self.put_many([(image_hash, probability)])
+
+    def put_many(self, verdicts):
+        """Stores the verdicts of several images in one transaction.
+
+        Args:
+            verdicts (iterable[tuple(str, float)]): The (content hash, blot probability) pairs.
+        """
+        with self.lock, self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO verdicts VALUES (?, ?, ?)',
+                                        [(image_hash, self.fingerprint, float(probability)) for image_hash, probability in verdicts])
+
+    def prune(self, keep=None):
+        """Removes the verdicts of every model except this one and the ones to keep,
+        e.g. after a model has been retrained.
+
+        Args:
+            keep (list[str], optional): The model files, or their content hashes, whose verdicts
+            are kept as well. Defaults to None.
+
+        Returns:
+            int: The amount of verdicts that were removed.
+        """
+        if keep is None:
+            keep = []
+
+        fingerprints = {self.fingerprint}
+        for model in keep:
+            fingerprints.add(self.content_hash(model) if os.path.isfile(model) else model)
+
+        with self.lock, self.connection:
+            cursor = self.connection.execute(f'DELETE FROM verdicts WHERE model NOT IN ({", ".join("?" * len(fingerprints))})',
+                                             list(fingerprints))
+
+        return cursor.rowcount
+
+    @staticmethod
+    def content_hash(path):
+        """Returns the SHA-256 hash of the content of a file.
+
+        Args:
+            path (str): The path of the file.
+
+        Returns:
+            str: The hexadecimal hash.
+        """
+        sha = hashlib.sha256()
+
+        with open(path, 'rb') as file:
+            for block in iter(lambda: file.read(1 << 20), b''):
+                sha.update(block)
+
+        return sha.hexdigest()
@@ -1,13 +1,19 @@
 # System modules
 import os
+from queue import Empty, Full, Queue
 from shutil import copy
+from threading import Event, Lock, Thread
 from multiprocessing.pool import ThreadPool
 
 # External modules
+import cv2
 import numpy as np
 from enum import Enum
-from keras.models import load_model
-from keras.preprocessing import image
+
+# Custom
+from ForgeryDetector.core import metrics
+from ForgeryDetector.core.classifying.cache import VerdictCache
+from ForgeryDetector.core.classifying.runtime import load_model
 
 # Model path
 WESTERN_RECOGNIZE_MODEL_PATH = r'Data\Models\western_ResNet.h5'
@@ -19,6 +25,10 @@ PUBPEER_IMAGE_PATH = r'Data\Blot data\Pubpeer'
 # The default location for saving the filtered blots
 FILTERED_BLOT_PATH = r'Data\Blot data\Filtered blots'
 
+# The input size of the model and the probability needed to count as a blot
+MODEL_INPUT_SIZE = (224, 224)
+BLOT_THRESHOLD = 0.90
+
 # Disable annoying TensorFlow messages
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
 
@@ -28,7 +38,7 @@ class ImageClassifier():
         PubMed = PUBMED_IMAGE_PATH
         PubPeer = PUBPEER_IMAGE_PATH
 
-    def __init__(self, model=None, threads=None):
+    def __init__(self, model=None, threads=None, cache=None, backend=None, manifest=None):
         if model is None:
             model = WESTERN_RECOGNIZE_MODEL_PATH
 
@@ -37,19 +47,58 @@ class ImageClassifier():
         else:
             self.threads = threads
 
-        print('Loading pre-trained model.')
-        self.model = load_model(model)
-        print('The model has been successfully loaded.')
+        # The cache can be given as a path, as a VerdictCache, or as True for the default path
+        if cache is None or cache is False:
+            self.cache = None
+        elif isinstance(cache, VerdictCache):
+            self.cache = cache
+        elif cache is True:
+            self.cache = VerdictCache(model)
+        else:
+            self.cache = VerdictCache(model, cache)
+
+        # Keras (and with it TensorFlow) is only loaded once the model is first needed.
+        # The backend is 'keras', 'tflite' or 'onnx', by default it follows the file extension.
+        self.model_path = model
+        self.backend = backend
+        self._model = None
+        self._model_lock = Lock()
+
+        # If given, filter skips the images the manifest has seen classified and records the others
+        self.manifest = manifest
+
+    @property
+    def model(self):
+        """The model, which is loaded the first time it is used."""
+        if self._model is None:
+            with self._model_lock:
+                if self._model is None:
+                    print('Loading pre-trained model.')
+                    self._model = load_model(self.model_path, self.backend)
+                    print('The model has been successfully loaded.')
 
-    def filter(self, img_folder_path, filtered_path=None, delete=None):
+        return self._model
+
+    @model.setter
+    def model(self, model):
+        self._model = model
+
+    def filter(self, img_folder_path, filtered_path=None, delete=None, batch_size=None, prefetch=None):
         """Filters through images and removes the images
         that are not reminiscent of western, southern or nothern blots.
         This method acts as a wrapper for _filter so as to enable
         multiproccesing.
 
+        If a batch size is given the images are instead decoded in a
+        background stage, stacked into batches and sent through the
+        model one batch at a time (see _filter_batched).
+
         Args:
             img_folder_path (str): Path of the folder to look in.
             delete (bool, optional): If true non-electrophoresis images are deleted. Defaults to None.
+            batch_size (int, optional): How many images to predict at once. Defaults to None,
+            which keeps the one image per prediction mode.
+            prefetch (int, optional): How many decoded batches may wait for the model. Defaults to None.
         """
         if delete is None:
             delete = True
@@ -64,9 +113,21 @@ class ImageClassifier():
         # sorted to match the way they are sorted in the folder itself.
         image_files = [(img_folder_path, img_path) for img_path in sorted(os.listdir(img_folder_path))]
 
+        # Images that were classified before a run stopped are not classified again
+        if self.manifest is not None:
+            todo = set(self.manifest.todo('image', [image_file for _, image_file in image_files], 'classify'))
+            image_files = [(folder, image_file) for folder, image_file in image_files if image_file in todo]
+
+        if batch_size is not None:
+            try:
+                self._filter_batched(img_folder_path, [image_file for _, image_file in image_files], delete, batch_size, prefetch)
+            except Exception as e:
+                print(f'Exception occurred: {e}')
+            return
+
         try:
             with ThreadPool(self.threads) as tp:
-                tp.starmap(self._filter, image_files)
+                tp.starmap(self._filter, [(folder, image_file, delete) for folder, image_file in image_files])
         except Exception as e:
             print(f'Exception occurred: {e}')
 
@@ -84,20 +145,297 @@ class ImageClassifier():
         if image_file == 'PDFs':
             return
 
+        # Images that have been classified before don't have to go through the model
+        if self.cache is not None:
+            image_hash = self.cache.content_hash(os.path.join(img_folder_path, image_file))
+            probability = self.cache.get(image_hash)
+            self._count_cache(probability is not None, probability is None)
+
+            if probability is not None:
+                self._handle_prediction(img_folder_path, image_file, probability, delete)
+                return
+
         # Loop through images, load them and use the model to recognize
+        with metrics.timer('classifier_decode_seconds'):
+            x = np.expand_dims(self._load(img_folder_path, image_file), axis=0)
+        probability = self._predict(x)[0]
+
+        if self.cache is not None:
+            self.cache.put(image_hash, probability)
+
+        self._handle_prediction(img_folder_path, image_file, probability, delete)
+
+    def predict(self, image_paths):
+        """Predicts the probability of each image being a blot.
+
+        Args:
+            image_paths (list[str]): Paths of the images to classify.
+
+        Returns:
+            numpy.ndarray: The blot probability of every image.
+        """
+        if self.cache is None:
+            with metrics.timer('classifier_decode_seconds'):
+                x = np.stack([self._load(*os.path.split(image_path)) for image_path in image_paths])
+            return self._predict(x)
+
+        image_hashes = [self.cache.content_hash(image_path) for image_path in image_paths]
+        cached = self.cache.get_many(image_hashes)
+        missing = [index for index, image_hash in enumerate(image_hashes) if image_hash not in cached]
+        self._count_cache(len(image_hashes) - len(missing), len(missing))
+
+        probabilities = np.array([cached.get(image_hash, 0.0) for image_hash in image_hashes])
+        if missing:
+            with metrics.timer('classifier_decode_seconds'):
+                x = np.stack([self._load(*os.path.split(image_paths[index])) for index in missing])
+            probabilities[missing] = self._predict(x)
+            self.cache.put_many([(image_hashes[index], probabilities[index]) for index in missing])
+
+        return probabilities
+
+    def predict_archive(self, archive, indexes=None, batch_size=None):
+        """Predicts the probability of each chunk of a ChunkArchive being a
+        blot. The chunks are read straight from the mapped archive, so
+        nothing is listed or decoded. The archive only holds grayscale, which
+        is repeated over the three color channels of the model.
+
+        Args:
+            archive (ChunkArchive): The archive.
+            indexes (list[int], optional): The chunks to classify. Defaults to None (all of them).
+            batch_size (int, optional): How many chunks to predict at once. Defaults to None (32).
+
+        Returns:
+            numpy.ndarray: The blot probability of every chunk.
+        """
+        if indexes is None:
+            indexes = range(len(archive))
+
+        if batch_size is None:
+            batch_size = 32
+
+        probabilities = [np.empty(0, dtype=np.float32)]
+        for start in range(0, len(indexes), batch_size):
+            with metrics.timer('classifier_decode_seconds'):
+                x = np.stack([self._prepare(archive[index]) for index in indexes[start:start + batch_size]])
+            probabilities.append(self._predict(x))
+
+        return np.concatenate(probabilities)
+
+    def _filter_batched(self, img_folder_path, image_files, delete, batch_size, prefetch=None):
+        """Runs the model on batches of images instead of single images.
+        A background thread decodes and stacks the images while the model
+        is busy with the previous batch. The queue between the two is
+        bounded so that decoding can never run far ahead of the model.
+
+        Args:
+            img_folder_path (str): Path of the folder to look in.
+            image_files (list[str]): The file names to classify.
+            delete (bool): If true non-electrophoresis images are deleted.
+            batch_size (int): How many images to predict at once.
+            prefetch (int, optional): How many decoded batches may be queued. Defaults to None.
+        """
+        if prefetch is None:
+            prefetch = 2
+
+        if batch_size <= 0:
+            print('batch_size can not be 0 or below.')
+            return
+
+        image_files = [image_file for image_file in image_files if image_file != 'PDFs']
+        batches = Queue(maxsize=prefetch)
+        errors = []
+
+        # Set when the model stage fails, so the decoder stops instead of waiting on the full queue
+        stop = Event()
+
+        decoder = Thread(target=self._decode_batches, args=(img_folder_path, image_files, batch_size, batches, errors, stop),
+                         daemon=True)
+        decoder.start()
+
+        try:
+            while True:
+                batch = batches.get()
+                metrics.gauge('queue_depth', batches.qsize(), queue='classifier_batches')
+
+                # None marks the end of the decoding stage
+                if batch is None:
+                    break
+
+                # Batches of cached verdicts come without images
+                names, image_hashes, x, probabilities = batch
+                if x is not None:
+                    probabilities = self._predict(x)
+
+                    if self.cache is not None:
+                        self.cache.put_many(zip(image_hashes, probabilities))
+
+                for image_file, probability in zip(names, probabilities):
+                    self._handle_prediction(img_folder_path, image_file, probability, delete)
+        finally:
+            stop.set()
+
+            # Whatever was decoded ahead is thrown away, which also frees a decoder that is putting a batch
+            while decoder.is_alive():
+                try:
+                    batches.get(timeout=0.1)
+                except Empty:
+                    pass
+
+            decoder.join()
+
+        if errors:
+            raise errors[0]
+
+    def _decode_batches(self, img_folder_path, image_files, batch_size, batches, errors, stop):
+        """Decodes images into stacked batches and puts them on the queue.
+        This is a private function only to be used as the decoding stage of
+        _filter_batched.
+
+        Args:
+            img_folder_path (str): Path of the folder to look in.
+            image_files (list[str]): The file names to decode.
+            batch_size (int): How many images to put in each batch.
+            batches (queue.Queue): The queue the batches are put on.
+            errors (list[Exception]): Collects an exception that stopped decoding.
+            stop (threading.Event): Set when the batches are no longer wanted.
+        """
+        def put(batch):
+            while not stop.is_set():
+                try:
+                    batches.put(batch, timeout=0.1)
+                    return
+                except Full:
+                    pass
+
+        try:
+            with ThreadPool(self.threads) as tp:
+                for start in range(0, len(image_files), batch_size):
+                    if stop.is_set():
+                        break
+
+                    names = image_files[start:start + batch_size]
+                    image_hashes = [None] * len(names)
+
+                    # Pass the cached verdicts on without decoding those images
+                    if self.cache is not None:
+                        image_hashes = tp.map(self.cache.content_hash, [os.path.join(img_folder_path, name) for name in names])
+                        cached = self.cache.get_many(image_hashes)
+
+                        hits = [(name, image_hash) for name, image_hash in zip(names, image_hashes) if image_hash in cached]
+                        self._count_cache(len(hits), len(names) - len(hits))
+                        if hits:
+                            put(([name for name, _ in hits], None, None, [cached[image_hash] for _, image_hash in hits]))
+
+                        misses = [(name, image_hash) for name, image_hash in zip(names, image_hashes) if image_hash not in cached]
+                        names, image_hashes = [name for name, _ in misses], [image_hash for _, image_hash in misses]
+
+                    with metrics.timer('classifier_decode_seconds'):
+                        decoded = tp.starmap(self._try_load, [(img_folder_path, image_file) for image_file in names])
+
+                    # Skip images that could not be decoded
+                    kept = [index for index, x in enumerate(decoded) if x is not None]
+                    if not kept:
+                        continue
+
+                    put(([names[index] for index in kept], [image_hashes[index] for index in kept],
+                         np.stack([decoded[index] for index in kept]), None))
+        except Exception as e:
+            errors.append(e)
+        finally:
+            put(None)
+
+    def _predict(self, x):
+        """Runs the model on a batch of images.
+
+        Args:
+            x (numpy.ndarray): The (N, 224, 224, 3) images.
+
+        Returns:
+            numpy.ndarray: The blot probability of every image.
+        """
+        with metrics.timer('classifier_predict_seconds', backend=self.backend or 'auto'):
+            probabilities = np.asarray(self.model.predict_on_batch(x))[:, 0]
+
+        metrics.count('classifier_predicted_total', len(x))
+        metrics.count('classifier_batches_total')
+        return probabilities
+
+    @staticmethod
+    def _count_cache(hits, misses):
+        """Counts the cache hits and misses."""
+        metrics.count('classifier_cache_hits_total', int(hits))
+        metrics.count('classifier_cache_misses_total', int(misses))
+
+    def _try_load(self, img_folder_path, image_file):
+        """Same as _load, but returns None for images that can't be decoded."""
+        try:
+            return self._load(img_folder_path, image_file)
+        except Exception as e:
+            print(f'Could not load \'{image_file}\': {e}')
+            return None
+
+    def _load(self, img_folder_path, image_file):
+        """Loads an image and converts it to the input the model expects.
+        Every backend decodes with OpenCV, so exported models see the same
+        pixels as the Keras model and their workers never import TensorFlow.
+
+        Args:
+            img_folder_path (str): Path of the folder the image is in.
+            image_file (str): The file name of the image.
+
+        Returns:
+            numpy.ndarray: A (224, 224, 3) float32 array scaled to [0, 1].
+        """
+        # Like keras' load_img (PIL), the EXIF orientation is ignored
+        img = cv2.imread(os.path.join(img_folder_path, image_file), cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION)
+        if img is None:
+            raise ValueError('The image could not be decoded.')
+
+        # INTER_NEAREST_EXACT picks the same pixels as PIL's nearest neighbour,
+        # which load_img used when the Keras model was trained
+        img = cv2.resize(img, MODEL_INPUT_SIZE[::-1], interpolation=cv2.INTER_NEAREST_EXACT)
+        return cv2.cvtColor(img, cv2.COLOR_BGR2RGB).astype(np.float32) / 255.0
+
+    @staticmethod
+    def _prepare(chunk):
+        """Converts a grayscale chunk to the input the model expects, resized
+        the same way _load resizes images.
+
+        Args:
+            chunk (numpy.ndarray): The (height, width) uint8 chunk.
+
+        Returns:
+            numpy.ndarray: A (224, 224, 3) float32 array scaled to [0, 1].
+        """
+        resized = cv2.resize(chunk, MODEL_INPUT_SIZE[::-1], interpolation=cv2.INTER_NEAREST_EXACT)
+        return np.repeat(resized[:, :, None], 3, axis=2).astype(np.float32) / 255.0
+
+    def _handle_prediction(self, img_folder_path, image_file, probability, delete):
+        """Moves the image to the filtered blots if the model is sure enough
+        that it is a blot, otherwise the image is (optionally) deleted.
+
+        Args:
+            img_folder_path (str): Path of the folder the image is in.
+            image_file (str): The file name of the image.
+            probability (float): The probability of the image being a blot.
+            delete (bool): If true non-electrophoresis images are deleted.
+        """
         name, ext = os.path.splitext(image_file)
-        img = image.load_img(img_folder_path + '/' + image_file, target_size=(224, 224))
-        x = image.img_to_array(img) / 255.0
-        x = np.expand_dims(x, axis=0)
-        features = self.model.predict(x)
+        metrics.count('classifier_images_total', verdict='blot' if probability >= BLOT_THRESHOLD else 'other')
 
-        if features[0][0] >= 0.90:
-            print(f'Found a match for \'{image_file.lower()}\' ({round(features[0][0]*100)}% sure)')
+        if probability >= BLOT_THRESHOLD:
+            print(f'Found a match for \'{image_file.lower()}\' ({round(probability*100)}% sure)')
             self.move(fr'{img_folder_path}\{name}{ext}', fr'{FILTERED_BLOT_PATH}\{name}{ext}', delete)
         else:
             if delete:
                 os.remove(fr'{img_folder_path}\{image_file}')
 
+        # Only recorded once the image has been moved, so a crash before that classifies it again. Pipeline's
+        # resume also looks for unclassified images among the blots, in case the crash came after the move.
+        if self.manifest is not None:
+            self.manifest.mark('image', image_file, 'classify',
+                               result={'probability': float(probability), 'blot': bool(probability >= BLOT_THRESHOLD)})
+
     def move(self, first, second, delete):
         """Moved the file at 'first' (path) to 'second' (path)
 
@@ -0,0 +1,385 @@
+# System modules
+from collections import namedtuple
+
+# External modules
+import cv2
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# Custom
+from ForgeryDetector.core.preprocessing.utils import ImageUtilities
+
+# A duplicated region given by the shift between the copies, the amount of
+# blocks (or keypoints) that voted for it, the bounding boxes (x, y, w, h)
+# of the source and the target and whether the target is a mirrored copy.
+CopyMoveRegion = namedtuple('CopyMoveRegion', ['shift', 'votes', 'source', 'target', 'mirrored'], defaults=[False])
+
+
+class CopyMoveDetector():
+    def __init__(self, block_size=None, stride=None):
+        if block_size is None:
+            self.block_size = 16
+        else:
+            self.block_size = block_size
+
+        if stride is None:
+            self.stride = 2
+        else:
+            self.stride = stride
+
+    def detect_blocks(self, image, coefficients=None, quantization=None, tolerance=None,
+                      min_variance=None, min_shift=None, min_votes=None, neighbours=None):
+        """Finds copy-moved regions within a single image. Every overlapping
+        block is described by its lowest DCT frequencies. The blocks are
+        sorted lexicographically by their features so that near-identical
+        blocks end up next to each other, and every pair of such blocks
+        votes for the shift between them. Shifts with enough votes are
+        reported as duplicated regions.
+
+        Args:
+            image (numpy.ndarray): The image to search for duplicated regions.
+            coefficients (int, optional): The features are the coefficients x coefficients
+            lowest DCT frequencies. Defaults to None (4).
+            quantization (float, optional): The step the features are rounded to before sorting. Defaults to None (16).
+            tolerance (float, optional): The largest root mean square difference between the features of
+            two matching blocks. Defaults to None (3).
+            min_variance (float, optional): Blocks with a lower pixel variance are skipped, since flat
+            background matches everywhere. Defaults to None (25).
+            min_shift (int, optional): The shortest shift that counts as a copy. Defaults to None (the block size).
+            min_votes (int, optional): The votes a shift needs to be reported. Defaults to None (10).
+            neighbours (int, optional): How many of the following blocks in sorted order each block
+            is compared with. Defaults to None (5).
+
+        Returns:
+            list[CopyMoveRegion]: The duplicated regions, most votes first.
+        """
+        if coefficients is None:
+            coefficients = 4
+
+        if quantization is None:
+            quantization = 16.0
+
+        if tolerance is None:
+            tolerance = 3.0
+
+        if min_variance is None:
+            min_variance = 25.0
+
+        if min_shift is None:
+            min_shift = self.block_size
+
+        if min_votes is None:
+            min_votes = 10
+
+        if neighbours is None:
+            neighbours = 5
+
+        gray = ImageUtilities.to_gray(image).astype(np.float32)
+        features, positions = self._block_features(gray, coefficients, min_variance)
+
+        if len(features) < 2:
+            return []
+
+        # Sort lexicographically by the quantized features, the first feature being the most significant.
+        # Ties are broken by the exact mean of the blocks so that identical blocks end up next to each other.
+        quantized = np.round(features / quantization)
+        order = np.lexsort(np.concatenate([features.T[:1], quantized.T[::-1]]))
+        features, positions = features[order], positions[order]
+
+        first = []
+        second = []
+        for n in range(1, neighbours + 1):
+            distance = np.sqrt(np.square(features[:-n] - features[n:]).mean(axis=1))
+            shift = positions[n:] - positions[:-n]
+            candidates = (distance <= tolerance) & (np.abs(shift).max(axis=1) >= min_shift)
+
+            indices = np.nonzero(candidates)[0]
+            first.append(indices)
+            second.append(indices + n)
+
+        first = np.concatenate(first)
+        second = np.concatenate(second)
+
+        return self._vote(positions[first], positions[second], min_votes, self.block_size, self.block_size)
+
+    def detect_keypoints(self, image, detector=None, features=None, ratio=None,
+                         min_distance=None, min_matches=None, max_regions=None, mirrored=None):
+        """Finds copy-moved regions within a single image using keypoints.
+        The keypoints are detected once and matched against themselves
+        through an approximate nearest neighbour index, so the cost grows
+        with the amount of keypoints rather than the amount of pixels.
+        The matches are grouped into regions by repeatedly fitting a
+        similarity transform with RANSAC, which also finds rotated and
+        rescaled copies.
+
+        A match does not tell which of its keypoints is the source, so every
+        match goes into the fit both ways and RANSAC picks the direction that
+        agrees with the other matches of the copy. Mirrored copies can't be
+        described by a similarity transform, and ORB and SIFT descriptors
+        change when a patch is mirrored. With mirrored=True the keypoints are
+        also matched against those of the mirrored image, and those matches
+        are fitted separately.
+
+        Args:
+            image (numpy.ndarray): The image to search for duplicated regions.
+            detector (str, optional): Either 'orb' or 'sift'. Defaults to None ('orb').
+            features (int, optional): The maximum amount of keypoints. Defaults to None (5000).
+            ratio (float, optional): A match is kept if it is this much closer than the next
+            nearest neighbour. Defaults to None (0.6).
+            min_distance (int, optional): Matched keypoints closer than this are ignored. Defaults to None (the block size).
+            min_matches (int, optional): The matches a region needs to be reported. Defaults to None (6).
+            max_regions (int, optional): The maximum amount of regions to report. Defaults to None (10).
+            mirrored (bool, optional): Also look for copies that were mirrored left to right. Defaults to None (False).
+
+        Returns:
+            list[CopyMoveRegion]: The duplicated regions, most votes first. The shift is the mean
+            displacement of the matched keypoints, pointing right (or down) like the shifts of
+            detect_blocks.
+        """
+        if detector is None:
+            detector = 'orb'
+
+        if features is None:
+            features = 5000
+
+        if ratio is None:
+            ratio = 0.6
+
+        if min_distance is None:
+            min_distance = self.block_size
+
+        if min_matches is None:
+            min_matches = 6
+
+        if max_regions is None:
+            max_regions = 10
+
+        if mirrored is None:
+            mirrored = False
+
+        gray = ImageUtilities.to_gray(image)
+
+        if detector == 'sift':
+            create = lambda: cv2.SIFT_create(nfeatures=features)
+            index_params = {'algorithm': 1, 'trees': 5}                                   # FLANN KD-tree
+        elif detector == 'orb':
+            create = lambda: cv2.ORB_create(nfeatures=features)
+            index_params = {'algorithm': 6, 'table_number': 6, 'key_size': 12, 'multi_probe_level': 1}  # FLANN LSH
+        else:
+            print(f'Unknown detector \'{detector}\'. Expected \'orb\' or \'sift\'.')
+            return []
+
+        keypoints, descriptors = create().detectAndCompute(gray, None)
+        if descriptors is None or len(keypoints) < 3:
+            return []
+
+        matcher = cv2.FlannBasedMatcher(index_params, {'checks': 50})
+        points = np.float32([keypoint.pt for keypoint in keypoints])
+
+        # Both keypoints of a match usually find each other, which is one match
+        pairs = self._keypoint_pairs(matcher, descriptors, descriptors, points, points, ratio, min_distance)
+        pairs = np.unique(np.sort(pairs, axis=1), axis=0).reshape(-1, 2)
+        regions = self._fit_regions(points[pairs[:, 0]], points[pairs[:, 1]], min_matches, max_regions)
+
+        if mirrored:
+            # The mirrored image has keypoints of its own, which are mapped back to where they are in the image
+            mirror_keypoints, mirror_descriptors = create().detectAndCompute(cv2.flip(gray, 1), None)
+
+            if mirror_descriptors is not None and len(mirror_keypoints) >= 3:
+                mirror_points = np.float32([keypoint.pt for keypoint in mirror_keypoints])
+                unmirrored = mirror_points * (-1, 1) + (gray.shape[1] - 1, 0)
+
+                pairs = self._keypoint_pairs(matcher, descriptors, mirror_descriptors, points, unmirrored, ratio, min_distance)
+
+                # Every mirrored match is also found from its other end, by different keypoints, so only
+                # the matches starting on the left are kept to count each of them once
+                pairs = pairs[points[pairs[:, 0], 0] <= unmirrored[pairs[:, 1], 0]]
+                regions += self._fit_regions(points[pairs[:, 0]], unmirrored[pairs[:, 1]], min_matches,
+                                             max_regions - len(regions), gray.shape[1])
+
+        return sorted(regions, key=lambda region: -region.votes)[:max_regions]
+
+    @staticmethod
+    def _keypoint_pairs(matcher, descriptors, train_descriptors, points, train_points, ratio, min_distance):
+        """Matches keypoints with the ratio test. Neighbours closer to the
+        keypoint than min_distance are left out before the test; that is the
+        keypoint itself when it is matched against its own image, and
+        patches that are mirror images of themselves otherwise.
+
+        Args:
+            matcher (cv2.FlannBasedMatcher): The matcher.
+            descriptors (numpy.ndarray): The descriptors of the keypoints.
+            train_descriptors (numpy.ndarray): The descriptors to match them against.
+            points (numpy.ndarray): The (x, y) positions of the keypoints.
+            train_points (numpy.ndarray): The (x, y) positions of the keypoints matched against.
+            ratio (float): How much closer the best match has to be than the second best.
+            min_distance (float): How far apart matched keypoints have to be.
+
+        Returns:
+            numpy.ndarray: The (N, 2) indexes of the matched keypoints.
+        """
+        pairs = set()
+
+        for neighbours in matcher.knnMatch(descriptors, train_descriptors, k=3):
+            neighbours = [match for match in neighbours
+                          if np.linalg.norm(points[match.queryIdx] - train_points[match.trainIdx]) >= min_distance]
+            if len(neighbours) < 2 or neighbours[0].distance >= ratio * neighbours[1].distance:
+                continue
+
+            pairs.add((neighbours[0].queryIdx, neighbours[0].trainIdx))
+
+        return np.array(sorted(pairs), dtype=int).reshape(-1, 2)
+
+    def _fit_regions(self, first, second, min_matches, max_regions, mirror_width=None):
+        """Groups matched keypoints into regions by repeatedly fitting a
+        similarity transform with RANSAC and taking out its inliers.
+
+        Every match goes in both ways, since it is not known which keypoint
+        is the source. A copy is described by one transform and the matches
+        going the other way by its inverse, so the inliers of a fit all point
+        the same way. Both ways of an inlier are taken out before the next fit.
+
+        Args:
+            first (numpy.ndarray): The (N, 2) positions of one keypoint of every match.
+            second (numpy.ndarray): The (N, 2) positions of the other keypoint.
+            min_matches (int): The matches a region needs.
+            max_regions (int): The maximum amount of regions.
+            mirror_width (int, optional): The width of the image if the matches are between
+            mirrored patches. Defaults to None.
+
+        Returns:
+            list[CopyMoveRegion]: The regions.
+        """
+        source = np.concatenate([first, second]).astype(np.float32)
+        target = np.concatenate([second, first]).astype(np.float32)
+        match_ids = np.concatenate([np.arange(len(first)), np.arange(len(first))])
+
+        # A mirrored copy is a similarity transform away from the mirror image of its source
+        fitted = target if mirror_width is None else target * (-1, 1) + (mirror_width - 1, 0)
+
+        regions = []
+        while len(np.unique(match_ids)) >= min_matches and len(regions) < max_regions:
+            _, inliers = cv2.estimateAffinePartial2D(source, fitted, method=cv2.RANSAC, ransacReprojThreshold=3.0)
+            if inliers is None:
+                break
+
+            inliers = inliers.ravel().astype(bool)
+            if inliers.sum() < min_matches:
+                break
+
+            region_source, region_target = source[inliers], target[inliers]
+            shift = (region_target - region_source).mean(axis=0)
+
+            # Point the region the same way as the shifts of detect_blocks
+            if shift[0] < 0 or (shift[0] == 0 and shift[1] < 0):
+                region_source, region_target, shift = region_target, region_source, -shift
+
+            regions.append(CopyMoveRegion((int(round(shift[0])), int(round(shift[1]))), int(inliers.sum()),
+                                          self._bounding_box(region_source.astype(int), 1, 1),
+                                          self._bounding_box(region_target.astype(int), 1, 1),
+                                          mirror_width is not None))
+
+            remaining = ~np.isin(match_ids, match_ids[inliers])
+            source, target, fitted, match_ids = source[remaining], target[remaining], fitted[remaining], match_ids[remaining]
+
+        return regions
+
+    def _block_features(self, gray, coefficients, min_variance):
+        """Computes the low frequency DCT features of all overlapping blocks.
+        The 2D DCT is separable, so the coefficients are computed by first
+        filtering the rows and then the columns of the image with the DCT
+        basis instead of transforming every block on its own.
+
+        Args:
+            gray (numpy.ndarray): The grayscale image.
+            coefficients (int): How many frequencies to keep along each axis.
+            min_variance (float): Blocks with a lower pixel variance are left out.
+
+        Returns:
+            numpy.ndarray: The (N, coefficients²) features of the kept blocks.
+            numpy.ndarray: The (N, 2) (x, y) positions of the kept blocks.
+        """
+        b = self.block_size
+        basis = self._dct_basis(b, coefficients)
+
+        # Filter the rows: (H, W', k)
+        rows = sliding_window_view(gray, b, axis=1)[:, ::self.stride] @ basis.T
+
+        # Local variance of every block to leave out flat background
+        mean = cv2.boxFilter(gray, -1, (b, b), anchor=(0, 0), borderType=cv2.BORDER_CONSTANT)
+        mean_sq = cv2.boxFilter(gray * gray, -1, (b, b), anchor=(0, 0), borderType=cv2.BORDER_CONSTANT)
+        variance = (mean_sq - mean * mean)[:gray.shape[0] - b + 1:self.stride, :gray.shape[1] - b + 1:self.stride]
+
+        features = []
+        positions = []
+
+        # Filter the columns in bands of block rows to keep the memory use flat
+        block_rows = np.arange(0, gray.shape[0] - b + 1, self.stride)
+        band = max(1, 2 ** 22 // (rows.shape[1] * b * coefficients))
+
+        for start in range(0, len(block_rows), band):
+            ys = block_rows[start:start + band]
+            windows = np.stack([rows[y:y + b] for y in ys])                     # (band, b, W', k)
+            band_features = np.einsum('ui,nixv->nxuv', basis, windows)          # (band, W', k, k)
+
+            keep = variance[start:start + len(ys)] >= min_variance
+            ny, nx = np.nonzero(keep)
+            features.append(band_features[ny, nx].reshape(len(ny), coefficients * coefficients))
+            positions.append(np.stack([nx * self.stride, ys[ny]], axis=1))
+
+        return np.concatenate(features), np.concatenate(positions)
+
+    @staticmethod
+    def _dct_basis(size, coefficients):
+        """Returns the first rows of the orthonormal DCT-II matrix."""
+        u = np.arange(coefficients)[:, None]
+        i = np.arange(size)[None, :]
+        basis = np.cos(np.pi * (2 * i + 1) * u / (2 * size)) * np.sqrt(2 / size)
+        basis[0] /= np.sqrt(2)
+        return basis.astype(np.float32)
+
+    @staticmethod
+    def _vote(source, target, min_votes, width, height):
+        """Lets every matched pair vote for the shift between them and turns
+        the shifts with enough votes into regions.
+
+        Args:
+            source (numpy.ndarray): The (N, 2) (x, y) positions of the first half of every pair.
+            target (numpy.ndarray): The (N, 2) (x, y) positions of the second half of every pair.
+            min_votes (int): The votes a shift needs to be reported.
+            width (int): The width of the matched areas.
+            height (int): The height of the matched areas.
+
+        Returns:
+            list[CopyMoveRegion]: The duplicated regions, most votes first.
+        """
+        if len(source) == 0:
+            return []
+
+        # A shift and its opposite describe the same copy, so point every shift the same way
+        shift = target - source
+        flip = (shift[:, 0] < 0) | ((shift[:, 0] == 0) & (shift[:, 1] < 0))
+        source, target = np.where(flip[:, None], target, source), np.where(flip[:, None], source, target)
+        shift = target - source
+
+        shifts, inverse, votes = np.unique(shift, axis=0, return_inverse=True, return_counts=True)
+        inverse = inverse.reshape(-1)
+
+        regions = []
+        for index in np.argsort(-votes):
+            if votes[index] < min_votes:
+                break
+
+            members = inverse == index
+            regions.append(CopyMoveRegion((int(shifts[index][0]), int(shifts[index][1])), int(votes[index]),
+                                          CopyMoveDetector._bounding_box(source[members], width, height),
+                                          CopyMoveDetector._bounding_box(target[members], width, height)))
+
+        return regions
+
+    @staticmethod
+    def _bounding_box(positions, width, height):
+        """Returns the bounding box (x, y, w, h) of areas at the given positions."""
+        x, y = positions.min(axis=0)
+        w, h = positions.max(axis=0) - (x, y)
+        return int(x), int(y), int(w + width), int(h + height)
@@ -0,0 +1,193 @@
+# System modules
+import os
+
+# External modules
+import numpy as np
+
+# Custom
+from ForgeryDetector.core.classifying.classify import ImageClassifier, BLOT_THRESHOLD, MODEL_INPUT_SIZE, WESTERN_RECOGNIZE_MODEL_PATH
+
+# The supported quantizations of the exported models
+QUANTIZATIONS = (None, 'float16', 'int8')
+
+
+class ModelExporter():
+    """Converts the Keras classifier to TensorFlow Lite or ONNX, so that the
+    CPU workers can classify images with a small runtime instead of the
+    whole of TensorFlow (see ImageClassifier's backend). The weights can be
+    quantized to float16, or to int8 using a set of calibration images.
+    """
+
+    def __init__(self, model=None):
+        if model is None:
+            model = WESTERN_RECOGNIZE_MODEL_PATH
+
+        self.model_path = model
+        self.classifier = ImageClassifier(model, backend='keras')
+
+    def to_tflite(self, export_path=None, quantization=None, calibration_images=None, calibration_size=None):
+        """Exports the model to TensorFlow Lite.
+
+        Args:
+            export_path (str, optional): Where to save the model. Defaults to None, which saves it
+            next to the Keras model, e.g. 'western_ResNet.int8.tflite'.
+            quantization (str, optional): Either 'float16' or 'int8'. Defaults to None (no quantization).
+            calibration_images (list[str] or str, optional): The images (or a folder of images) int8
+            quantization is calibrated on. Defaults to None.
+            calibration_size (int, optional): The maximum amount of calibration images. Defaults to None (100).
+
+        Returns:
+            str: The path of the exported model, or None if it could not be exported.
+        """
+        if not self._check(quantization, calibration_images):
+            return None
+
+        import tensorflow as tf
+
+        if export_path is None:
+            export_path = self._export_path('tflite', quantization)
+
+        converter = tf.lite.TFLiteConverter.from_keras_model(self.classifier.model)
+
+        if quantization == 'float16':
+            converter.optimizations = [tf.lite.Optimize.DEFAULT]
+            converter.target_spec.supported_types = [tf.float16]
+        elif quantization == 'int8':
+            # The input and output stay float32 so the model is used like any other
+            converter.optimizations = [tf.lite.Optimize.DEFAULT]
+            converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+            converter.representative_dataset = lambda: ([x] for x in self._calibration(calibration_images, calibration_size))
+
+        with open(export_path, 'wb') as file:
+            file.write(converter.convert())
+
+        print(f'Exported the model to \'{export_path}\'.')
+        return export_path
+
+    def to_onnx(self, export_path=None, quantization=None, calibration_images=None, calibration_size=None, opset=None):
+        """Exports the model to ONNX. See to_tflite for the arguments.
+
+        Args:
+            opset (int, optional): The ONNX opset to export to. Defaults to None (13).
+
+        Returns:
+            str: The path of the exported model, or None if it could not be exported.
+        """
+        if opset is None:
+            opset = 13
+
+        if not self._check(quantization, calibration_images):
+            return None
+
+        import onnx
+        import tf2onnx
+        import tensorflow as tf
+
+        if export_path is None:
+            export_path = self._export_path('onnx', quantization)
+
+        # The batch dimension is left open so any batch size can be predicted
+        signature = (tf.TensorSpec((None, *MODEL_INPUT_SIZE, 3), tf.float32, name='input'),)
+        model, _ = tf2onnx.convert.from_keras(self.classifier.model, input_signature=signature, opset=opset)
+
+        if quantization == 'float16':
+            from onnxconverter_common import float16
+            model = float16.convert_float_to_float16(model, keep_io_types=True)
+        elif quantization == 'int8':
+            from onnxruntime.quantization import CalibrationDataReader, QuantType, quantize_static
+
+            calibration = self._calibration(calibration_images, calibration_size)
+
+            class Reader(CalibrationDataReader):
+                def get_next(self):
+                    x = next(calibration, None)
+                    return None if x is None else {'input': x}
+
+            # Quantization works on files, so the float model is saved first
+            float_path = f'{export_path}.float'
+            onnx.save(model, float_path)
+            quantize_static(float_path, export_path, Reader(), activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8)
+            os.remove(float_path)
+            model = None
+
+        if model is not None:
+            onnx.save(model, export_path)
+
+        print(f'Exported the model to \'{export_path}\'.')
+        return export_path
+
+    def compare(self, model, image_paths, backend=None, batch_size=None):
+        """Checks whether an exported model gives the same verdicts as the
+        Keras model it was exported from.
+
+        Args:
+            model (str): The path of the exported model.
+            image_paths (list[str]): The images to compare the models on.
+            backend (str, optional): The backend of the exported model. Defaults to None (from the extension).
+            batch_size (int, optional): How many images to predict at once. Defaults to None (32).
+
+        Returns:
+            dict: The amount of images, the largest and the mean absolute difference
+            between the probabilities, the fraction of images both models give the same
+            verdict and the images they disagree on.
+        """
+        if batch_size is None:
+            batch_size = 32
+
+        exported = ImageClassifier(model, backend=backend)
+        reference = []
+        candidate = []
+
+        # Both models get the same decoded batch, so only the models can make a difference
+        for start in range(0, len(image_paths), batch_size):
+            x = np.stack([self.classifier._load(*os.path.split(image_path)) for image_path in image_paths[start:start + batch_size]])
+            reference.append(self.classifier._predict(x))
+            candidate.append(exported._predict(x))
+
+        reference = np.concatenate(reference)
+        candidate = np.concatenate(candidate)
+        difference = np.abs(reference - candidate)
+        disagree = (reference >= BLOT_THRESHOLD) != (candidate >= BLOT_THRESHOLD)
+
+        return {'images': len(reference),
+                'max_difference': float(difference.max()),
+                'mean_difference': float(difference.mean()),
+                'agreement': float(1 - disagree.mean()),
+                'disagreements': [image_paths[index] for index in np.nonzero(disagree)[0]]}
+
+    def _check(self, quantization, calibration_images):
+        """Checks the export arguments and prints what is wrong with them."""
+        if quantization not in QUANTIZATIONS:
+            print(f'Unknown quantization \'{quantization}\'. Expected \'float16\' or \'int8\'.')
+            return False
+
+        if quantization == 'int8' and not calibration_images:
+            print('int8 quantization needs calibration images.')
+            return False
+
+        return True
+
+    def _export_path(self, ext, quantization):
+        """Returns the default path of an exported model."""
+        name = os.path.splitext(self.model_path)[0]
+
+        if quantization is None:
+            return f'{name}.{ext}'
+
+        return f'{name}.{quantization}.{ext}'
+
+    def _calibration(self, calibration_images, calibration_size):
+        """Yields the calibration images one at a time as (1, 224, 224, 3) batches.
+
+        Args:
+            calibration_images (list[str] or str): The images, or a folder of images.
+            calibration_size (int): The maximum amount of images.
+        """
+        if calibration_size is None:
+            calibration_size = 100
+
+        if isinstance(calibration_images, str):
+            calibration_images = [os.path.join(calibration_images, image_file) for image_file in os.listdir(calibration_images)]
+
+        for image_path in calibration_images[:calibration_size]:
+            yield np.expand_dims(self.classifier._load(*os.path.split(image_path)), axis=0)
@@ -0,0 +1,283 @@
+# System modules
+import numbers
+import os
+import sqlite3
+from itertools import combinations
+from threading import Lock
+
+# External modules
+import cv2
+import numpy as np
+
+# Custom
+from ForgeryDetector.core.preprocessing.crop import ImageCropper
+from ForgeryDetector.core.preprocessing.utils import ImageUtilities
+
+# The default location of the index and of the blots that are indexed
+HASH_INDEX_PATH = r'Data\Blot data\hash_index.db'
+FILTERED_BLOT_PATH = r'Data\Blot data\Filtered blots'
+
+# The hashes are 64 bits long and split into 4 segments of 16 bits
+HASH_BITS = 64
+SEGMENTS = 4
+SEGMENT_BITS = HASH_BITS // SEGMENTS
+
+# The most segment values that are looked up in one query, well below the parameter limit of SQLite
+QUERY_PARAMETERS = 500
+
+
+class ImageHasher():
+    def __init__(self, method=None):
+        if method is None:
+            self.method = 'phash'
+        else:
+            self.method = method
+
+    def hash(self, image):
+        """Hashes an image with the method the hasher was created with.
+
+        Args:
+            image (numpy.ndarray): The image to hash.
+
+        Returns:
+            int: The 64 bit hash of the image.
+        """
+        if self.method == 'dhash':
+            return self.dhash(image)
+
+        return self.phash(image)
+
+    @staticmethod
+    def phash(image):
+        """Computes the perceptual hash of an image. The image is shrunk to
+        32x32 and the lowest 8x8 frequencies of its DCT are compared to
+        their median.
+
+        Args:
+            image (numpy.ndarray): The image to hash.
+
+        Returns:
+            int: The 64 bit hash of the image.
+        """
+        small = cv2.resize(ImageUtilities.to_gray(image), (32, 32), interpolation=cv2.INTER_AREA)
+        frequencies = cv2.dct(small.astype(np.float32))[:8, :8].flatten()
+
+        # The DC term is left out of the median since it only holds the brightness
+        return ImageHasher._to_int(frequencies > np.median(frequencies[1:]))
+
+    @staticmethod
+    def dhash(image):
+        """Computes the difference hash of an image. The image is shrunk to
+        9x8 and every pixel is compared to its right neighbour.
+
+        Args:
+            image (numpy.ndarray): The image to hash.
+
+        Returns:
+            int: The 64 bit hash of the image.
+        """
+        small = cv2.resize(ImageUtilities.to_gray(image), (9, 8), interpolation=cv2.INTER_AREA)
+        return ImageHasher._to_int((small[:, 1:] > small[:, :-1]).flatten())
+
+    @staticmethod
+    def distance(hash_one, hash_two):
+        """Returns the hamming distance between two hashes."""
+        return bin(hash_one ^ hash_two).count('1')
+
+    @staticmethod
+    def _to_int(bits):
+        """Packs an array of 64 booleans into an integer."""
+        return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+class HashIndex():
+    """A persistent index of image hashes that finds near-duplicates without
+    scanning every hash. Each hash is split into 4 segments of 16 bits. Two
+    hashes that differ in at most d bits have at least one segment that
+    differs in at most d // 4 bits, so only hashes with a segment close to
+    one of the query's segments have to be compared. Each segment is an
+    indexed column in SQLite, which makes those lookups logarithmic.
+
+    The files indexed by add_folder are kept in a table of their own, so
+    that only their crops are returned by query.
+    """
+
+    def __init__(self, path=None, hasher=None):
+        if path is None:
+            path = HASH_INDEX_PATH
+
+        if hasher is None:
+            hasher = ImageHasher()
+
+        self.path = path
+        self.hasher = hasher
+
+        # The connection is shared between threads, so every use of it holds the lock
+        self.lock = Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+
+        with self.lock, self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS hashes (key TEXT PRIMARY KEY, hash INTEGER, '
+                                    + ', '.join(f's{i} INTEGER' for i in range(SEGMENTS)) + ')')
+            for i in range(SEGMENTS):
+                self.connection.execute(f'CREATE INDEX IF NOT EXISTS segment_{i} ON hashes (s{i})')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS files (name TEXT PRIMARY KEY)')
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute('SELECT COUNT(*) FROM hashes').fetchone()[0]
+
+    def __contains__(self, key):
+        with self.lock:
+            return self.connection.execute('SELECT 1 FROM hashes WHERE key = ?', (key,)).fetchone() is not None
+
+    def close(self):
+        """Closes the connection to the index."""
+        with self.lock:
+            self.connection.close()
+
+    def add(self, key, image):
+        """Adds an image (or an already computed hash) to the index. Adding
+        a key that is already in the index replaces its hash.
+
+        Args:
+            key (str): The name under which the image is stored, e.g. its path and crop box.
+            image (numpy.ndarray or int): The image or its hash.
+        """
+        self.add_many([(key, image)])
+
+    def add_many(self, items):
+        """Adds several images (or hashes) to the index in one transaction.
+
+        Args:
+            items (iterable[tuple(str, numpy.ndarray or int)]): The (key, image) pairs to add.
+        """
+        rows = []
+        for key, image in items:
+            image_hash = self._hash(image)
+            rows.append((key, self._to_signed(image_hash), *self._segments(image_hash)))
+
+        with self.lock, self.connection:
+            self.connection.executemany(f'INSERT OR REPLACE INTO hashes VALUES ({", ".join("?" * (SEGMENTS + 2))})', rows)
+
+    def query(self, image, max_distance=None):
+        """Finds the images in the index that are near-duplicates of the given image.
+
+        Args:
+            image (numpy.ndarray or int): The image or its hash.
+            max_distance (int, optional): The maximum hamming distance of a near-duplicate. Defaults to None (8).
+
+        Returns:
+            list[tuple(str, int)]: The key and hamming distance of every near-duplicate, closest first.
+        """
+        if max_distance is None:
+            max_distance = 8
+
+        image_hash = self._hash(image)
+
+        # At least one segment differs in at most this many bits
+        radius = max_distance // SEGMENTS
+
+        # A hash can share several segments with the query, so the candidates are collected by key
+        candidates = {}
+        with self.lock:
+            for i, segment in enumerate(self._segments(image_hash)):
+                variants = self._variants(segment, radius)
+                for start in range(0, len(variants), QUERY_PARAMETERS):
+                    part = variants[start:start + QUERY_PARAMETERS]
+                    rows = self.connection.execute(f'SELECT key, hash FROM hashes WHERE s{i} IN ({", ".join("?" * len(part))})', part)
+                    candidates.update(rows)
+
+        matches = []
+        for key, candidate in candidates.items():
+            distance = ImageHasher.distance(image_hash, self._to_unsigned(candidate))
+            if distance <= max_distance:
+                matches.append((key, distance))
+
+        return sorted(matches, key=lambda match: match[1])
+
+    def add_folder(self, folder=None, cropper=None, min_area=None):
+        """Crops every image in a folder and adds the crops to the index.
+        Images that have already been indexed are skipped, so the folder
+        can be indexed again after new blots have been added to it.
+
+        Args:
+            folder (str, optional): The folder with the images. Defaults to None (the filtered blots).
+            cropper (ImageCropper, optional): The cropper to use. Defaults to None.
+            min_area (int, optional): Crops with a smaller bounding box are not indexed. Defaults to None.
+
+        Returns:
+            int: The amount of crops that were added.
+        """
+        if folder is None:
+            folder = FILTERED_BLOT_PATH
+
+        if cropper is None:
+            cropper = ImageCropper(folder)
+
+        if min_area is None:
+            min_area = 100
+
+        with self.lock:
+            indexed = {name for name, in self.connection.execute('SELECT name FROM files')}
+
+        added = 0
+        for image_file in sorted(os.listdir(folder)):
+            if image_file in indexed:
+                continue
+
+            image = cv2.imread(os.path.join(folder, image_file))
+            if image is None:
+                continue
+
+            items = []
+            conts, _ = cropper.find_contours(image)
+            if conts:
+                for (x, y, w, h), crop in cropper.get_crops(image, conts, min_area):
+                    items.append((f'{image_file}:{x},{y},{w},{h}', crop))
+
+            self.add_many(items)
+            # Files without crops are marked as well, so they are not cropped again
+            with self.lock, self.connection:
+                self.connection.execute('INSERT OR IGNORE INTO files VALUES (?)', (image_file,))
+            added += len(items)
+
+        return added
+
+    def _hash(self, image):
+        """Returns the hash of an image, or the hash itself if it was already
+        computed. Hashes stored as signed 64 bit integers, e.g. numpy.int64, are
+        turned back into unsigned ones."""
+        if isinstance(image, numbers.Integral):
+            return self._to_unsigned(int(image))
+
+        return self.hasher.hash(image)
+
+    @staticmethod
+    def _segments(image_hash):
+        """Splits a hash into its segments."""
+        mask = (1 << SEGMENT_BITS) - 1
+        return [(image_hash >> (SEGMENT_BITS * i)) & mask for i in range(SEGMENTS)]
+
+    @staticmethod
+    def _variants(segment, radius):
+        """Returns every segment value that differs in at most radius bits."""
+        variants = [segment]
+        for flips in range(1, radius + 1):
+            for bits in combinations(range(SEGMENT_BITS), flips):
+                variant = segment
+                for bit in bits:
+                    variant ^= 1 << bit
+                variants.append(variant)
+
+        return variants
+
+    @staticmethod
+    def _to_signed(image_hash):
+        """SQLite only stores signed 64 bit integers."""
+        return image_hash - (1 << HASH_BITS) if image_hash >= 1 << (HASH_BITS - 1) else image_hash
+
+    @staticmethod
+    def _to_unsigned(image_hash):
+        """Reverses _to_signed."""
+        return image_hash + (1 << HASH_BITS) if image_hash < 0 else image_hash
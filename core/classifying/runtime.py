@@ -0,0 +1,142 @@
+# System modules
+import os
+from threading import Lock
+
+# External modules
+import numpy as np
+
+# The backend that is used for each model file extension
+BACKENDS = {'.h5': 'keras', '.keras': 'keras', '.tflite': 'tflite', '.onnx': 'onnx'}
+
+
+def load_model(model_path, backend=None, threads=None):
+    """Loads a classifier model with the runtime it was exported for. Every
+    backend has the predict and predict_on_batch methods of a Keras model,
+    so the classifier does not have to know which one it is using.
+
+    Args:
+        model_path (str): The path of the model.
+        backend (str, optional): Either 'keras', 'tflite' or 'onnx'. Defaults to None,
+        which picks the backend from the file extension.
+        threads (int, optional): How many threads the runtime may use per prediction. Defaults to None.
+
+    Returns:
+        The model.
+    """
+    backend = resolve_backend(model_path, backend)
+
+    if backend == 'keras':
+        from keras.models import load_model as load_keras_model
+        return load_keras_model(model_path)
+    elif backend == 'tflite':
+        return TFLiteModel(model_path, threads)
+    elif backend == 'onnx':
+        return OnnxModel(model_path, threads)
+
+    raise ValueError(f'Unknown backend \'{backend}\'. Expected \'keras\', \'tflite\' or \'onnx\'.')
+
+
+def resolve_backend(model_path, backend=None):
+    """Returns the backend a model is loaded with, see load_model.
+
+    Args:
+        model_path (str): The path of the model.
+        backend (str, optional): The backend that was asked for. Defaults to None (from the file extension).
+
+    Returns:
+        str: Either 'keras', 'tflite' or 'onnx'.
+    """
+    if backend is None:
+        backend = BACKENDS.get(os.path.splitext(model_path)[1].lower(), 'keras')
+
+    return backend
+
+
+class TFLiteModel():
+    """Runs a model exported to TensorFlow Lite. The small tflite_runtime
+    package is used when it is installed, otherwise the interpreter that
+    comes with TensorFlow.
+    """
+
+    def __init__(self, model_path, threads=None):
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            from tensorflow.lite import Interpreter
+
+        self.model_path = model_path
+        self.interpreter = Interpreter(model_path=model_path, num_threads=threads)
+        self.interpreter.allocate_tensors()
+
+        self.input = self.interpreter.get_input_details()[0]
+        self.output = self.interpreter.get_output_details()[0]
+        self.batch_size = int(self.input['shape'][0])
+
+        # An interpreter can only run one prediction at a time
+        self.lock = Lock()
+
+    def predict_on_batch(self, x):
+        """Predicts a batch of images.
+
+        Args:
+            x (numpy.ndarray): The (N, 224, 224, 3) float32 images.
+
+        Returns:
+            numpy.ndarray: The (N, 1) blot probabilities.
+        """
+        with self.lock:
+            # The input tensor is resized when the batch size changes
+            if len(x) != self.batch_size:
+                self.interpreter.resize_tensor_input(self.input['index'], [len(x), *x.shape[1:]])
+                self.interpreter.allocate_tensors()
+                self.input = self.interpreter.get_input_details()[0]
+                self.output = self.interpreter.get_output_details()[0]
+                self.batch_size = len(x)
+
+            self.interpreter.set_tensor(self.input['index'], self._quantize(x, self.input))
+            self.interpreter.invoke()
+            y = self.interpreter.get_tensor(self.output['index'])
+
+        return self._dequantize(y, self.output)
+
+    predict = predict_on_batch
+
+    @staticmethod
+    def _quantize(x, details):
+        """Converts float input to the type of a (fully integer) quantized input tensor."""
+        if details['dtype'] == np.float32:
+            return x.astype(np.float32, copy=False)
+
+        scale, zero_point = details['quantization']
+        info = np.iinfo(details['dtype'])
+        return np.clip(np.round(x / scale + zero_point), info.min, info.max).astype(details['dtype'])
+
+    @staticmethod
+    def _dequantize(y, details):
+        """Converts the output of a quantized output tensor back to float."""
+        if details['dtype'] == np.float32:
+            return y
+
+        scale, zero_point = details['quantization']
+        return (y.astype(np.float32) - zero_point) * scale
+
+
+class OnnxModel():
+    """Runs a model exported to ONNX with ONNX Runtime on the CPU."""
+
+    def __init__(self, model_path, threads=None):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        if threads is not None:
+            options.intra_op_num_threads = threads
+
+        self.model_path = model_path
+        self.session = onnxruntime.InferenceSession(model_path, options, providers=['CPUExecutionProvider'])
+        self.input = self.session.get_inputs()[0].name
+
+    def predict_on_batch(self, x):
+        """Predicts a batch of images. See TFLiteModel.predict_on_batch."""
+        return self.session.run(None, {self.input: x.astype(np.float32, copy=False)})[0]
+
+    predict = predict_on_batch
@@ -0,0 +1,33 @@
+# System modules
+import sys
+import importlib.util
+
+
+def lazy_import(name):
+    """Returns a module that is only really imported once one of its
+    attributes is used. This keeps heavy dependencies (PyMuPDF, Selenium,
+    Biopython, ...) from being loaded by scripts that never use them.
+
+    A missing module still raises ModuleNotFoundError right away, like a
+    normal import would.
+
+    Args:
+        name (str): The full name of the module, e.g. 'Bio.Entrez'.
+
+    Returns:
+        module: The (not yet loaded) module.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError(f'No module named \'{name}\'', name=name)
+
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+
+    return module
@@ -0,0 +1,199 @@
+# System modules
+import json
+import time
+import sqlite3
+from threading import Lock
+
+# The default location of the manifest
+JOB_MANIFEST_PATH = r'Data\Blot data\jobs.db'
+
+# The stages articles and images go through, in order
+STAGES = ('download', 'extract', 'classify', 'crop', 'match')
+
+
+class JobManifest():
+    """Records how far every article and image has come, so a run that
+    stopped partway (a crash, a network outage, a closed laptop) continues
+    where it stopped instead of starting over, and a repeated search only
+    processes the articles that are new since the last run.
+
+    Every job is an article (keyed by its ID or URL) or an image (keyed by
+    its file name, which stays the same when a blot is moved) together with
+    the last stage it reached and whether that stage is done or failed.
+    Stages are only recorded once their output is on disk, so a job is
+    never marked done before its work has been saved.
+    """
+
+    def __init__(self, path=None, max_attempts=None):
+        if path is None:
+            path = JOB_MANIFEST_PATH
+
+        if max_attempts is None:
+            self.max_attempts = 3
+        else:
+            self.max_attempts = max_attempts
+
+        self.path = path
+
+        # The downloaders and pipeline stages mark jobs from several threads
+        self.lock = Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+
+        with self.lock, self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS jobs '
+                                    '(kind TEXT, key TEXT, source TEXT, article TEXT, stage TEXT, state TEXT, '
+                                    'attempts INTEGER, result TEXT, error TEXT, updated REAL, PRIMARY KEY (kind, key))')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS jobs_stage ON jobs (kind, stage, state)')
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute('SELECT COUNT(*) FROM jobs').fetchone()[0]
+
+    def close(self):
+        """Closes the connection to the manifest."""
+        self.connection.close()
+
+    def mark(self, kind, key, stage, state=None, source=None, article=None, result=None, error=None):
+        """Records that a job has finished (or failed) a stage.
+
+        Args:
+            kind (str): Either 'article' or 'image'.
+            key (str): The article ID or URL, or the file name of the image.
+            stage (str): The stage, see STAGES.
+            state (str, optional): Either 'done' or 'failed'. Defaults to None ('done').
+            source (str, optional): Where the job comes from, e.g. 'pubmed'. Defaults to None,
+            which keeps what was recorded before.
+            article (str, optional): The article an image belongs to. Defaults to None.
+            result (optional): What the stage produced, e.g. the blot probability. Has to be JSON serializable.
+            Defaults to None.
+            error (str, optional): Why the stage failed. Defaults to None.
+        """
+        self.mark_many(kind, [(key, result)], stage, state, source, article, error)
+
+    def mark_many(self, kind, jobs, stage, state=None, source=None, article=None, error=None):
+        """Records that several jobs have finished (or failed) a stage in one
+        transaction. See mark for the arguments.
+
+        Args:
+            jobs (iterable[str or tuple(str, object)]): The keys, or the (key, result) pairs.
+        """
+        if state is None:
+            state = 'done'
+
+        if stage not in STAGES:
+            raise ValueError(f'Unknown stage \'{stage}\'. Expected one of {", ".join(STAGES)}.')
+
+        now = time.time()
+        rows = []
+        for job in jobs:
+            key, result = job if isinstance(job, tuple) else (job, None)
+            rows.append((kind, key, source, article, stage, state, int(state == 'failed'),
+                         None if result is None else json.dumps(result), error, now))
+
+        with self.lock, self.connection:
+            # Failing the same stage again counts as another attempt, anything else starts over
+            self.connection.executemany('INSERT INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) '
+                                        'ON CONFLICT (kind, key) DO UPDATE SET '
+                                        'source = IFNULL(excluded.source, source), article = IFNULL(excluded.article, article), '
+                                        'attempts = CASE WHEN excluded.state = \'failed\' AND stage = excluded.stage '
+                                        'AND state = \'failed\' THEN attempts + 1 ELSE excluded.attempts END, '
+                                        'stage = excluded.stage, state = excluded.state, result = excluded.result, '
+                                        'error = excluded.error, updated = excluded.updated', rows)
+
+    def get(self, kind, key):
+        """Looks up a job.
+
+        Args:
+            kind (str): Either 'article' or 'image'.
+            key (str): The key of the job.
+
+        Returns:
+            dict: The source, article, stage, state, attempts, result and error of the job,
+            or None if it has not been recorded.
+        """
+        with self.lock:
+            row = self.connection.execute('SELECT source, article, stage, state, attempts, result, error FROM jobs '
+                                          'WHERE kind = ? AND key = ?', (kind, key)).fetchone()
+        if row is None:
+            return None
+
+        source, article, stage, state, attempts, result, error = row
+        return {'source': source, 'article': article, 'stage': stage, 'state': state, 'attempts': attempts,
+                'result': None if result is None else json.loads(result), 'error': error}
+
+    def todo(self, kind, keys, stage):
+        """Returns the jobs that still have to go through a stage: the ones
+        that are new, that have not reached the stage yet, or that failed it
+        fewer than max_attempts times. A job that failed an earlier stage
+        max_attempts times is given up on as well, e.g. an article whose
+        link is dead is not downloaded again to extract it.
+
+        Args:
+            kind (str): Either 'article' or 'image'.
+            keys (iterable[str]): The keys of the jobs.
+            stage (str): The stage, see STAGES.
+
+        Returns:
+            list[str]: The keys that still have to go through the stage, in the given order.
+        """
+        keys = list(keys)
+        finished = set()
+
+        with self.lock:
+            # SQLite limits the amount of parameters per query
+            for start in range(0, len(keys), 500):
+                part = keys[start:start + 500]
+                rows = self.connection.execute(f'SELECT key, stage, state, attempts FROM jobs WHERE kind = ? '
+                                               f'AND key IN ({", ".join("?" * len(part))})', [kind, *part])
+
+                for key, reached, state, attempts in rows:
+                    if STAGES.index(reached) > STAGES.index(stage):
+                        finished.add(key)
+                    elif reached == stage and state == 'done':
+                        finished.add(key)
+                    elif state == 'failed' and attempts >= self.max_attempts:
+                        finished.add(key)
+
+        return [key for key in keys if key not in finished]
+
+    def keys(self, kind, stage=None, state=None, source=None):
+        """Returns the jobs that are at a stage, e.g. the images that were
+        extracted but not classified yet.
+
+        Args:
+            kind (str): Either 'article' or 'image'.
+            stage (str, optional): The last stage of the jobs. Defaults to None (any).
+            state (str, optional): The state of that stage. Defaults to None (any).
+            source (str, optional): Only jobs from this source. Defaults to None.
+
+        Returns:
+            list[tuple(str, object)]: The key and the result of every job.
+        """
+        query = 'SELECT key, result FROM jobs WHERE kind = ?'
+        parameters = [kind]
+
+        for column, value in [('stage', stage), ('state', state), ('source', source)]:
+            if value is not None:
+                query += f' AND {column} = ?'
+                parameters.append(value)
+
+        with self.lock:
+            rows = self.connection.execute(query, parameters).fetchall()
+
+        return [(key, None if result is None else json.loads(result)) for key, result in rows]
+
+    def summary(self):
+        """Counts the jobs by kind, stage and state.
+
+        Returns:
+            dict[str, dict[str, dict[str, int]]]: The amount of jobs, e.g. summary['image']['classify']['done'].
+        """
+        counts = {}
+
+        with self.lock:
+            rows = self.connection.execute('SELECT kind, stage, state, COUNT(*) FROM jobs GROUP BY kind, stage, state').fetchall()
+
+        for kind, stage, state, amount in rows:
+            counts.setdefault(kind, {}).setdefault(stage, {})[state] = amount
+
+        return counts
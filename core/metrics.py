@@ -0,0 +1,351 @@
+# System modules
+import os
+import sys
+import json
+import time
+import threading
+from bisect import bisect_left
+from functools import wraps
+
+# The bucket bounds (in seconds) of the latency histograms
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Every metric name gets this prefix in the Prometheus dump
+NAMESPACE = 'forgery_detector'
+
+# The registry that is recorded into, None while metrics are disabled
+_metrics = None
+
+
+class Metrics():
+    """Collects counters, gauges and latency histograms. Every metric is
+    identified by its name and its labels, e.g. the bytes downloaded per
+    host. Timed spans are also handed to the sinks as they finish, so they
+    can be logged as traces.
+
+    Metrics recorded inside worker processes (e.g. the PDF extraction pool)
+    stay in those processes and are not collected.
+    """
+
+    def __init__(self, sinks=None, buckets=None):
+        if sinks is None:
+            self.sinks = []
+        else:
+            self.sinks = list(sinks)
+
+        if buckets is None:
+            self.buckets = LATENCY_BUCKETS
+        else:
+            self.buckets = tuple(sorted(buckets))
+
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def count(self, name, value=None, **labels):
+        """Adds to a counter.
+
+        Args:
+            name (str): The name of the counter, e.g. 'http_bytes_total'.
+            value (float, optional): How much to add. Defaults to None (1).
+            **labels: The labels of the counter, e.g. host='www.ncbi.nlm.nih.gov'.
+        """
+        if value is None:
+            value = 1
+
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name, value, **labels):
+        """Sets a gauge, e.g. the amount of items waiting in a queue. See count for the arguments."""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = value
+
+    def observe(self, name, value, **labels):
+        """Adds a value (usually seconds) to a histogram. See count for the arguments."""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                # The last bucket counts the values above every bound
+                histogram = self.histograms[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+
+            histogram[0][bisect_left(self.buckets, value)] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def span(self, name, start, seconds, error=None, **labels):
+        """Records a finished span in its histogram and hands it to the sinks.
+
+        Args:
+            name (str): The name of the histogram, e.g. 'classifier_predict_seconds'.
+            start (float): When the span started, as a Unix timestamp.
+            seconds (float): How long the span took.
+            error (str, optional): The exception that ended the span. Defaults to None.
+            **labels: The labels of the histogram.
+        """
+        self.observe(name, seconds, **labels)
+
+        if self.sinks:
+            record = {'type': 'span', 'name': name, 'start': round(start, 6), 'seconds': round(seconds, 6),
+                      'thread': threading.current_thread().name, 'labels': labels}
+            if error is not None:
+                record['error'] = error
+
+            for sink in self.sinks:
+                sink.emit(record)
+
+    def snapshot(self):
+        """Returns the current value of every metric.
+
+        Returns:
+            dict: The counters, gauges and histograms, each as a list of dicts with
+            the name, the labels and the value(s).
+        """
+        with self.lock:
+            counters = [{'name': name, 'labels': dict(labels), 'value': value} for (name, labels), value in self.counters.items()]
+            gauges = [{'name': name, 'labels': dict(labels), 'value': value} for (name, labels), value in self.gauges.items()]
+            histograms = [{'name': name, 'labels': dict(labels), 'buckets': list(zip([*self.buckets, 'inf'], counts)),
+                           'sum': total, 'count': amount}
+                          for (name, labels), (counts, total, amount) in self.histograms.items()]
+
+        return {'counters': counters, 'gauges': gauges, 'histograms': histograms}
+
+    def prometheus(self):
+        """Returns every metric in the Prometheus text exposition format.
+
+        Returns:
+            str: The metrics.
+        """
+        snapshot = self.snapshot()
+        lines = []
+        typed = set()
+
+        def header(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {name} {kind}')
+
+        for kind in ['counters', 'gauges']:
+            for metric in sorted(snapshot[kind], key=lambda metric: metric['name']):
+                name = f'{NAMESPACE}_{metric["name"]}'
+                header(name, 'counter' if kind == 'counters' else 'gauge')
+                lines.append(f'{name}{_labels(metric["labels"])} {metric["value"]}')
+
+        for metric in sorted(snapshot['histograms'], key=lambda metric: metric['name']):
+            name = f'{NAMESPACE}_{metric["name"]}'
+            header(name, 'histogram')
+
+            # The buckets of the exposition format are cumulative
+            cumulative = 0
+            for bound, amount in metric['buckets']:
+                cumulative += amount
+                le = '+Inf' if bound == 'inf' else repr(bound)
+                lines.append(f'{name}_bucket{_labels({**metric["labels"], "le": le})} {cumulative}')
+
+            lines.append(f'{name}_sum{_labels(metric["labels"])} {metric["sum"]}')
+            lines.append(f'{name}_count{_labels(metric["labels"])} {metric["count"]}')
+
+        return '\n'.join(lines) + '\n'
+
+    def flush(self):
+        """Lets every sink write out the current metrics."""
+        for sink in self.sinks:
+            sink.write(self)
+
+    def reset(self):
+        """Forgets every metric."""
+        with self.lock:
+            self.counters = {}
+            self.gauges = {}
+            self.histograms = {}
+
+
+class JsonSink():
+    """Writes every span as one line of JSON, and the metrics as a single
+    line when they are flushed. The lines can be read by any log shipper.
+    """
+
+    def __init__(self, path=None):
+        # The log goes to stderr unless a file is given
+        if path is None:
+            self.file = sys.stderr
+        else:
+            self.file = open(path, 'a')
+
+        self.lock = threading.Lock()
+
+    def emit(self, record):
+        """Writes a record as a line of JSON.
+
+        Args:
+            record (dict): The record, e.g. a span.
+        """
+        line = json.dumps({'time': round(time.time(), 6), **record}, default=str)
+        with self.lock:
+            self.file.write(line + '\n')
+            self.file.flush()
+
+    def write(self, metrics):
+        """Writes the current metrics as a line of JSON.
+
+        Args:
+            metrics (Metrics): The metrics.
+        """
+        self.emit({'type': 'metrics', **metrics.snapshot()})
+
+    def close(self):
+        """Closes the log file."""
+        if self.file is not sys.stderr:
+            self.file.close()
+
+
+class PrometheusSink():
+    """Writes the metrics in the Prometheus text format to a file every time
+    they are flushed, e.g. for the textfile collector of the node exporter.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def emit(self, record):
+        """Spans only end up in the histograms, so nothing is written here."""
+        pass
+
+    def write(self, metrics):
+        """Writes the current metrics to the file.
+
+        Args:
+            metrics (Metrics): The metrics.
+        """
+        # Write to a temporary file first so that a scrape never sees half a file
+        with open(f'{self.path}.part', 'w') as file:
+            file.write(metrics.prometheus())
+        os.replace(f'{self.path}.part', self.path)
+
+
+class _Timer():
+    """Times a block of code as a span."""
+
+    __slots__ = ('metrics', 'name', 'labels', 'start', 'started')
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.time()
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        error = None if exc_type is None else exc_type.__name__
+        self.metrics.span(self.name, self.start, time.perf_counter() - self.started, error, **self.labels)
+        return False
+
+
+class _NullTimer():
+    """Stands in for a timer while metrics are disabled."""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+def enable(sinks=None, buckets=None):
+    """Starts recording metrics. Until this is called every call below
+    returns right away, so the instrumentation costs next to nothing.
+
+    Args:
+        sinks (list, optional): Where spans and metrics are written, e.g. JsonSink and PrometheusSink. Defaults to None.
+        buckets (list[float], optional): The bounds of the latency histograms. Defaults to None (LATENCY_BUCKETS).
+
+    Returns:
+        Metrics: The registry the metrics are recorded in.
+    """
+    global _metrics
+    _metrics = Metrics(sinks, buckets)
+    return _metrics
+
+
+def disable():
+    """Stops recording metrics.
+
+    Returns:
+        Metrics: The registry that was recorded in, or None if metrics were not enabled.
+    """
+    global _metrics
+    metrics, _metrics = _metrics, None
+    return metrics
+
+
+def current():
+    """Returns the registry metrics are recorded in, None while metrics are disabled."""
+    return _metrics
+
+
+def count(name, value=None, **labels):
+    """Adds to a counter if metrics are enabled. See Metrics.count."""
+    if _metrics is not None:
+        _metrics.count(name, value, **labels)
+
+
+def gauge(name, value, **labels):
+    """Sets a gauge if metrics are enabled. See Metrics.gauge."""
+    if _metrics is not None:
+        _metrics.gauge(name, value, **labels)
+
+
+def observe(name, value, **labels):
+    """Adds a value to a histogram if metrics are enabled. See Metrics.observe."""
+    if _metrics is not None:
+        _metrics.observe(name, value, **labels)
+
+
+def timer(name, **labels):
+    """Returns a context manager that times its block as a span.
+
+    Args:
+        name (str): The name of the histogram, e.g. 'matcher_seconds'.
+        **labels: The labels of the histogram.
+    """
+    if _metrics is None:
+        return _NULL_TIMER
+
+    return _Timer(_metrics, name, labels)
+
+
+def timed(name, **labels):
+    """Decorator that times every call of a function as a span. See timer."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if _metrics is None:
+                return func(*args, **kwargs)
+
+            with _Timer(_metrics, name, labels):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def _labels(labels):
+    """Formats labels the way Prometheus expects them."""
+    if not labels:
+        return ''
+
+    escaped = {key: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for key, value in labels.items()}
+    return '{' + ','.join(f'{key}="{value}"' for key, value in sorted(escaped.items())) + '}'
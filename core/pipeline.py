@@ -0,0 +1,436 @@
+# System modules
+import os
+from queue import Empty, Full, Queue
+from threading import Event, Lock, Thread
+from collections import namedtuple
+
+# External modules
+import cv2
+
+# Custom
+from ForgeryDetector.core import metrics
+from ForgeryDetector.core.classifying.classify import ImageClassifier, BLOT_THRESHOLD, FILTERED_BLOT_PATH
+from ForgeryDetector.core.classifying.match import ImageMatcher
+from ForgeryDetector.core.preprocessing.crop import ImageCropper
+from ForgeryDetector.core.preprocessing.download import DownloadManager, PUBMED_IMG_PATH, PUBMED_TEMP_PDF_PATH
+
+# Marks the end of the items flowing through a queue
+_DONE = object()
+
+# What the pipeline yields for every figure that has been matched
+PipelineResult = namedtuple('PipelineResult', ['figure', 'probability', 'boxes', 'matches'])
+
+
+class Pipeline():
+    """Connects downloading, PDF extraction, classification, cropping and
+    matching as concurrent stages. The stages are joined by bounded queues,
+    so a slow stage makes the stages before it wait instead of piling up
+    PDFs and images on disk or in memory.
+    """
+
+    def __init__(self, pubmed=None, classifier=None, cropper=None, matcher=None,
+                 threads=None, queue_size=None, batch_size=None, store=None, manifest=None):
+        if pubmed is None:
+            pubmed = DownloadManager.PubMed(threads=threads or 8)
+
+        if classifier is None:
+            classifier = ImageClassifier()
+
+        if cropper is None:
+            cropper = ImageCropper()
+
+        if matcher is None:
+            matcher = ImageMatcher()
+
+        if threads is None:
+            self.threads = 8
+        else:
+            self.threads = threads
+
+        if queue_size is None:
+            self.queue_size = 16
+        else:
+            self.queue_size = queue_size
+
+        if batch_size is None:
+            self.batch_size = 32
+        else:
+            self.batch_size = batch_size
+
+        self.pubmed = pubmed
+        self.classifier = classifier
+        self.cropper = cropper
+        self.matcher = matcher
+
+        # If given, images already in the store are not classified or matched again
+        self.store = store
+
+        # If given, every article and image is recorded as it passes a stage, and a run
+        # picks up the articles and images an earlier run did not finish
+        self.manifest = manifest
+
+    def run(self, articles, pdf_path=None, img_path=None, filtered_path=None,
+            keep_blots=None, min_area=None, threshold=None):
+        """Runs the pipeline on a list of PubMed articles. The results are
+        yielded as soon as a figure has been matched, while the other
+        articles are still being downloaded.
+
+        Args:
+            articles (tuple(list[tuple(str, str)], ArticleType) or iterable[tuple(str, str)]): The
+            (url, article ID) pairs of the articles, as returned by PubMed.get_links. A generator
+            such as PubMed.iter_links is consumed lazily, so downloading starts after its first page.
+            pdf_path (str, optional): Where to temporarily save the PDFs. Defaults to None.
+            img_path (str, optional): Where to temporarily save the extracted images. Defaults to None.
+            filtered_path (str, optional): Where to move the images classified as blots. Defaults to None.
+            keep_blots (bool, optional): If False the blots are deleted once they have been matched. Defaults to None.
+            min_area (int, optional): Crops with a smaller bounding box are not matched. Defaults to None.
+            threshold (float, optional): The TM_CCOEFF_NORMED score needed for a match. Defaults to None.
+
+        Yields:
+            PipelineResult: The figure path, its blot probability, the crop boxes and the matches
+            given as (crop index, x, y, score). With a manifest, figures that were matched in an
+            earlier run are not yielded again; their results are in the manifest.
+        """
+        if pdf_path is None:
+            pdf_path = PUBMED_TEMP_PDF_PATH
+
+        if img_path is None:
+            img_path = PUBMED_IMG_PATH
+
+        if filtered_path is None:
+            filtered_path = FILTERED_BLOT_PATH
+
+        if keep_blots is None:
+            keep_blots = True
+
+        if min_area is None:
+            min_area = 100
+
+        if threshold is None:
+            threshold = 0.95
+
+        if isinstance(articles, tuple):
+            articles = articles[0]
+
+        articles_queue = Queue(maxsize=self.queue_size)
+        pdf_queue = Queue(maxsize=self.queue_size)
+        image_queue = Queue(maxsize=self.queue_size)
+        blot_queue = Queue(maxsize=self.queue_size)
+        crop_queue = Queue(maxsize=self.queue_size)
+        results = Queue(maxsize=self.queue_size)
+
+        # Set once the consumer stops iterating, so the stages stop instead of blocking on full queues
+        stop = Event()
+
+        def download(item):
+            index, (url, article_id) = item
+            pdf = self.pubmed.download_article(url, article_id, index, pdf_path)
+            self._mark('article', article_id, 'download', 'done' if pdf is not None else 'failed', source='pubmed')
+            return [] if pdf is None else [(pdf, article_id)]
+
+        def extract(item):
+            pdf, article_id = item
+            try:
+                image_paths = self.pubmed.extract_images(pdf, img_path, self.store)
+            except Exception as e:
+                self._mark('article', article_id, 'extract', 'failed', source='pubmed', error=str(e))
+                raise
+            finally:
+                # The PDF is not needed once its images have been extracted
+                if os.path.exists(pdf):
+                    os.remove(pdf)
+
+            if self.manifest is not None:
+                self.manifest.mark_many('image', [os.path.basename(image_path) for image_path in image_paths], 'extract',
+                                        source='pubmed', article=article_id)
+            self._mark('article', article_id, 'extract', source='pubmed', result=len(image_paths))
+            return image_paths
+
+        def crop(item):
+            figure, probability = item
+            image = cv2.imread(figure)
+            if image is None:
+                return []
+
+            crops = self.cropper.crop_panels(image, min_area)
+            self._mark('image', os.path.basename(figure), 'crop',
+                       result={'probability': probability, 'boxes': [box for box, _ in crops]})
+            return [(figure, probability, cv2.cvtColor(image, cv2.COLOR_BGR2GRAY), crops)]
+
+        def match(item):
+            figure, probability, gray, crops = item
+            matches = self.matcher.match_crops(gray, crops, threshold=threshold)
+
+            boxes = [box for box, _ in crops]
+            self._mark('image', os.path.basename(figure), 'match',
+                       result={'probability': probability, 'boxes': boxes, 'matches': matches})
+
+            if not keep_blots:
+                os.remove(figure)
+
+            return [PipelineResult(figure, probability, boxes, matches)]
+
+        # What an earlier run left unclassified or unmatched goes first
+        resume = None
+        if self.manifest is not None:
+            resume = self._resume(img_path, filtered_path)
+            articles = self._unfinished(articles)
+
+        # The model is only run from one thread, which batches whatever is waiting
+        classifier = Thread(target=self._classify_stage, args=(image_queue, blot_queue, filtered_path, resume, stop),
+                            daemon=True)
+        classifier.start()
+
+        workers = [classifier]
+        workers += self._start_stage(download, articles_queue, pdf_queue, self.threads, stop)
+        workers += self._start_stage(extract, pdf_queue, image_queue, self.threads, stop)
+        workers += self._start_stage(crop, blot_queue, crop_queue, self.threads, stop)
+        workers += self._start_stage(match, crop_queue, results, self.threads, stop)
+
+        feeder = Thread(target=self._feed, args=(enumerate(articles, start=1), articles_queue, stop), daemon=True)
+        feeder.start()
+
+        try:
+            while True:
+                result = results.get()
+                if result is _DONE:
+                    break
+                yield result
+        finally:
+            # Also runs when the consumer abandons the generator, which leaves the workers to exit on their own
+            stop.set()
+
+        feeder.join()
+        for worker in workers:
+            worker.join()
+
+    def _mark(self, kind, key, stage, state=None, source=None, result=None, error=None):
+        """Records a job in the manifest, if there is one. See JobManifest.mark."""
+        if self.manifest is not None:
+            self.manifest.mark(kind, key, stage, state, source, result=result, error=error)
+
+    def _unfinished(self, articles):
+        """Yields the (url, article ID) pairs whose images have not been
+        extracted yet, leaving generators such as PubMed.iter_links lazy.
+
+        Args:
+            articles (iterable[tuple(str, str)]): The (url, article ID) pairs.
+        """
+        for url, article_id in articles:
+            if self.manifest.todo('article', [article_id], 'extract'):
+                yield url, article_id
+
+    def _resume(self, img_path, filtered_path):
+        """Finds the images an earlier run extracted but did not classify,
+        and the blots it did not match. Images that are no longer on disk
+        are left out.
+
+        An image is moved before its classification is recorded, so a crash
+        in between leaves an unclassified image among the blots. Those are
+        classified again from where they are.
+
+        Args:
+            img_path (str): Where the extracted images are.
+            filtered_path (str): Where the blots are.
+
+        Returns:
+            list[str]: The paths of the images to classify.
+            list[tuple(str, float)]: The paths and blot probabilities of the blots to crop and match.
+        """
+        image_paths = []
+        for key, _ in self.manifest.keys('image', 'extract', 'done'):
+            for folder in [img_path, filtered_path]:
+                if os.path.exists(os.path.join(folder, key)):
+                    image_paths.append(os.path.join(folder, key))
+                    break
+
+        blots = []
+        for stage in ['classify', 'crop']:
+            for key, result in self.manifest.keys('image', stage, 'done'):
+                blot_path = os.path.join(filtered_path, key)
+                if result.get('probability', 0) >= BLOT_THRESHOLD and os.path.exists(blot_path):
+                    blots.append((blot_path, result['probability']))
+
+        if image_paths or blots:
+            print(f'Resuming {len(image_paths)} unclassified images and {len(blots)} unmatched blots.')
+
+        return image_paths, blots
+
+    @staticmethod
+    def _put(queue, item, stop):
+        """Puts an item on a bounded queue, unless the pipeline is stopped while waiting.
+
+        Returns:
+            bool: Whether the item was put on the queue.
+        """
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+
+        return False
+
+    @staticmethod
+    def _get(queue, stop):
+        """Takes an item from a queue, or returns the end marker once the pipeline is stopped."""
+        while not stop.is_set():
+            try:
+                return queue.get(timeout=0.1)
+            except Empty:
+                pass
+
+        return _DONE
+
+    def _feed(self, items, queue, stop):
+        """Puts the items on the first queue of the pipeline.
+
+        Args:
+            items (iterable): The items to put on the queue.
+            queue (queue.Queue): The queue of the first stage.
+            stop (threading.Event): Set when the pipeline is stopped.
+        """
+        try:
+            for item in items:
+                if not self._put(queue, item, stop):
+                    break
+        finally:
+            self._put(queue, _DONE, stop)
+
+    def _start_stage(self, func, inbox, outbox, workers, stop):
+        """Starts the workers of a stage. Every worker takes items from the
+        inbox and puts whatever func returns for the item on the outbox. The
+        last worker to finish passes the end marker on to the next stage.
+
+        Args:
+            func (function): Takes an item and returns a list of items for the next stage.
+            inbox (queue.Queue): The queue to take items from.
+            outbox (queue.Queue): The queue to put items on.
+            workers (int): The amount of worker threads.
+            stop (threading.Event): Set when the pipeline is stopped, after which the workers exit.
+
+        Returns:
+            list[threading.Thread]: The started workers.
+        """
+        remaining = [workers]
+        lock = Lock()
+
+        def work():
+            while not stop.is_set():
+                item = self._get(inbox, stop)
+                metrics.gauge('queue_depth', inbox.qsize(), queue=func.__name__)
+
+                if item is _DONE:
+                    # Let the other workers of this stage see the end marker too
+                    self._put(inbox, _DONE, stop)
+                    break
+
+                try:
+                    with metrics.timer('pipeline_stage_seconds', stage=func.__name__):
+                        outputs = func(item)
+
+                    for output in outputs:
+                        if not self._put(outbox, output, stop):
+                            break
+                except Exception as e:
+                    print(f'Exception occurred during {func.__name__}: {e}')
+                    metrics.count('pipeline_errors_total', stage=func.__name__)
+
+            with lock:
+                remaining[0] -= 1
+                if remaining[0] == 0:
+                    self._put(outbox, _DONE, stop)
+
+        threads = [Thread(target=work, daemon=True) for _ in range(workers)]
+        for thread in threads:
+            thread.start()
+
+        return threads
+
+    def _classify_stage(self, inbox, outbox, filtered_path, resume=None, stop=None):
+        """Classifies the extracted images. Whatever images are waiting when
+        the model becomes free are classified together as one batch.
+
+        Args:
+            inbox (queue.Queue): The queue with image paths.
+            outbox (queue.Queue): The queue for (blot path, probability) pairs.
+            filtered_path (str): Where to move the images classified as blots.
+            resume (tuple(list[str], list[tuple(str, float)]), optional): The images and blots an
+            earlier run left behind, see _resume. Defaults to None.
+            stop (threading.Event, optional): Set when the pipeline is stopped. Defaults to None.
+        """
+        if stop is None:
+            stop = Event()
+
+        try:
+            # They go through this thread so they are on their way before the end marker
+            if resume is not None:
+                image_paths, blots = resume
+                for blot in blots:
+                    self._put(outbox, blot, stop)
+
+                for start in range(0, len(image_paths), self.batch_size):
+                    self._classify_batch(image_paths[start:start + self.batch_size], outbox, filtered_path, stop)
+
+            done = False
+
+            while not done and not stop.is_set():
+                batch = [self._get(inbox, stop)]
+                while len(batch) < self.batch_size and not inbox.empty():
+                    batch.append(inbox.get())
+                metrics.gauge('queue_depth', inbox.qsize(), queue='classify')
+
+                if _DONE in batch:
+                    done = True
+                    batch = [image_path for image_path in batch if image_path is not _DONE]
+
+                if batch:
+                    self._classify_batch(batch, outbox, filtered_path, stop)
+        finally:
+            # Without the end marker the stages after this one, and run, would wait forever
+            self._put(outbox, _DONE, stop)
+
+    def _classify_batch(self, batch, outbox, filtered_path, stop):
+        """Classifies a batch of images, moves the blots and hands them on.
+        An image that can't be handled is skipped; if the whole batch can't
+        be classified its images are deleted so they don't pile up.
+
+        Args:
+            batch (list[str]): The image paths.
+            outbox (queue.Queue): The queue for (blot path, probability) pairs.
+            filtered_path (str): Where to move the images classified as blots.
+            stop (threading.Event): Set when the pipeline is stopped.
+        """
+        try:
+            probabilities = self.classifier.predict(batch)
+        except Exception as e:
+            print(f'Exception occurred during classification: {e}')
+            metrics.count('pipeline_errors_total', len(batch), stage='classify')
+
+            for image_path in batch:
+                try:
+                    if os.path.exists(image_path):
+                        os.remove(image_path)
+                    self._mark('image', os.path.basename(image_path), 'classify', 'failed', error=str(e))
+                except Exception as error:
+                    print(f'Could not remove \'{image_path}\': {error}')
+            return
+
+        for image_path, probability in zip(batch, probabilities):
+            try:
+                if probability >= BLOT_THRESHOLD:
+                    blot_path = os.path.join(filtered_path, os.path.basename(image_path))
+                    os.replace(image_path, blot_path)
+                else:
+                    os.remove(image_path)
+
+                self._mark('image', os.path.basename(image_path), 'classify',
+                           result={'probability': float(probability), 'blot': bool(probability >= BLOT_THRESHOLD)})
+            except Exception as e:
+                print(f'Exception occurred while handling \'{image_path}\': {e}')
+                metrics.count('pipeline_errors_total', stage='classify')
+                continue
+
+            if probability >= BLOT_THRESHOLD:
+                self._put(outbox, (blot_path, float(probability)), stop)
@@ -1,3 +1,29 @@
-from ForgeryDetector.core.preprocessing.crop import ImageCropper
-from ForgeryDetector.core.preprocessing.download import DownloadManager
-from ForgeryDetector.core.preprocessing.utils import ImageUtilities
\ No newline at end of file
+from importlib import import_module
+
+# The classes are only imported once they are used, so that importing the
+# package does not load TensorFlow, PyMuPDF or Selenium up front.
+_EXPORTS = {
+    'ChunkArchive': 'ForgeryDetector.core.preprocessing.archive',
+    'ImageCropper': 'ForgeryDetector.core.preprocessing.crop',
+    'LaneProfiler': 'ForgeryDetector.core.preprocessing.lanes',
+    'DownloadManager': 'ForgeryDetector.core.preprocessing.download',
+    'HttpFetcher': 'ForgeryDetector.core.preprocessing.fetch',
+    'ImageStore': 'ForgeryDetector.core.preprocessing.store',
+    'BlotGenerator': 'ForgeryDetector.core.preprocessing.synthetic',
+    'ImageUtilities': 'ForgeryDetector.core.preprocessing.utils',
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name):
+    if name in _EXPORTS:
+        value = getattr(import_module(_EXPORTS[name]), name)
+        globals()[name] = value
+        return value
+
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
\ No newline at end of file
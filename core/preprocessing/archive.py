@@ -0,0 +1,235 @@
+# System modules
+import os
+import json
+from threading import Lock
+
+# External modules
+import cv2
+import numpy as np
+
+# The default location of the archive
+CHUNK_ARCHIVE_PATH = r'Data\Blot data\Chunk archive'
+
+# The offset of every chunk in the data file and its shape
+INDEX_DTYPE = np.dtype([('offset', '<u8'), ('height', '<u4'), ('width', '<u4')])
+
+# The image files add_folder packs
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff')
+
+
+class ChunkArchive():
+    """Packs grayscale chunks into a single file so they can be read without
+    listing folders or decoding images. The pixels of every chunk are stored
+    one after the other in 'chunks.bin', which is memory-mapped, so a chunk
+    is read as a NumPy view into the page cache without copying. Next to it
+    'index.bin' holds the offset and shape of every chunk and 'metadata.jsonl'
+    one JSON line per chunk, e.g. the file and box it was cropped from.
+
+    All three files are only ever appended to, in that order, so a crash
+    while adding can at most lose the chunk that was being written.
+
+    The archive is a sequence of chunks, so it can be handed to everything
+    that takes a list of chunks, e.g. ImageMatcher.similarity_matrix. When it
+    is sent to another process only its path is pickled and the process maps
+    the same file.
+    """
+
+    def __init__(self, path=None, mode=None):
+        if path is None:
+            path = CHUNK_ARCHIVE_PATH
+
+        if mode is None:
+            mode = 'r'
+
+        if mode not in ['r', 'a', 'w']:
+            raise ValueError(f'Unknown mode \'{mode}\'. Expected \'r\', \'a\' or \'w\'.')
+
+        self.path = path
+        self.mode = mode
+        self.data_path = os.path.join(path, 'chunks.bin')
+        self.index_path = os.path.join(path, 'index.bin')
+        self.metadata_path = os.path.join(path, 'metadata.jsonl')
+
+        if mode == 'r':
+            self.files = None
+        else:
+            os.makedirs(path, exist_ok=True)
+            file_mode = 'wb' if mode == 'w' else 'ab'
+            self.files = [open(self.data_path, file_mode), open(self.index_path, file_mode), open(self.metadata_path, file_mode)]
+
+        self.lock = Lock()
+        self._load()
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        """Returns a chunk as a read-only (height, width) uint8 view into the archive."""
+        offset, height, width = (int(value) for value in self.index[index])
+        if offset + height * width > len(self.data):
+            self._map()
+
+        return self.data[offset:offset + height * width].reshape(height, width)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def __getstate__(self):
+        # Pickling the mapped data would copy every chunk, so only the path is sent
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'], 'r')
+
+    def close(self):
+        """Closes the files of an archive that was opened for writing."""
+        if self.files is not None:
+            for file in self.files:
+                file.close()
+            self.files = None
+
+    def add(self, chunk, **metadata):
+        """Appends a chunk to the archive. Colored chunks are converted to grayscale.
+
+        Args:
+            chunk (numpy.ndarray): The chunk.
+            **metadata: What to remember about the chunk, e.g. file='img_1.png'. Has to be JSON serializable.
+
+        Returns:
+            int: The index of the chunk.
+        """
+        if self.files is None:
+            raise ValueError('The archive was opened for reading only.')
+
+        if len(chunk.shape) == 3:
+            chunk = cv2.cvtColor(chunk, cv2.COLOR_BGR2GRAY)
+
+        chunk = np.ascontiguousarray(chunk, dtype=np.uint8)
+        data_file, index_file, metadata_file = self.files
+
+        with self.lock:
+            entry = np.array([(self.size, chunk.shape[0], chunk.shape[1])], dtype=INDEX_DTYPE)
+
+            # The data is written before the index, so an index entry never points past the data
+            data_file.write(chunk.tobytes())
+            data_file.flush()
+            index_file.write(entry.tobytes())
+            index_file.flush()
+            metadata_file.write((json.dumps(metadata) + '\n').encode('utf-8'))
+            metadata_file.flush()
+
+            # The index in memory grows by doubling so adding stays cheap
+            if self.count == len(self._entries):
+                self._entries = np.concatenate([self._entries, np.empty(max(1024, self.count), dtype=INDEX_DTYPE)])
+
+            self._entries[self.count] = entry[0]
+            self.count += 1
+            self.size += chunk.size
+            self.metadata.append(metadata)
+
+            return self.count - 1
+
+    def add_many(self, chunks, **metadata):
+        """Appends several chunks that share their metadata, e.g. the crops of one figure.
+
+        Args:
+            chunks (list[tuple(tuple(int, int, int, int), numpy.ndarray)]): The boxes and chunks,
+            as returned by ImageCropper.crop_panels.
+            **metadata: The metadata of every chunk, to which its box is added.
+
+        Returns:
+            list[int]: The indexes of the chunks.
+        """
+        return [self.add(chunk, box=[int(value) for value in box], **metadata) for box, chunk in chunks]
+
+    def add_folder(self, folder):
+        """Packs the images of a folder, e.g. the cropped blots. The file name
+        of every image is kept in its metadata.
+
+        Args:
+            folder (str): The folder with the images.
+
+        Returns:
+            int: The amount of chunks that were added.
+        """
+        added = 0
+
+        for image_file in sorted(os.listdir(folder)):
+            if os.path.splitext(image_file)[1].lower() not in IMAGE_EXTENSIONS:
+                continue
+
+            chunk = cv2.imread(os.path.join(folder, image_file), cv2.IMREAD_GRAYSCALE)
+            if chunk is None:
+                print(f'Could not read \'{image_file}\'.')
+                continue
+
+            self.add(chunk, file=image_file)
+            added += 1
+
+        return added
+
+    def find(self, **metadata):
+        """Returns the indexes of the chunks whose metadata has the given values.
+
+        Args:
+            **metadata: The values to look for, e.g. file='img_1.png'.
+
+        Returns:
+            list[int]: The indexes of the chunks.
+        """
+        return [index for index, values in enumerate(self.metadata)
+                if all(values.get(key) == value for key, value in metadata.items())]
+
+    @property
+    def index(self):
+        """The (offset, height, width) of every chunk as a structured array."""
+        return self._entries[:self.count]
+
+    def shapes(self):
+        """Returns the (height, width) of every chunk as an (N, 2) array."""
+        return np.stack([self.index['height'], self.index['width']], axis=1)
+
+    def _load(self):
+        """Reads the index and the metadata and maps the data."""
+        index = np.empty(0, dtype=INDEX_DTYPE)
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'rb') as file:
+                raw = file.read()
+            index = np.frombuffer(raw[:len(raw) - len(raw) % INDEX_DTYPE.itemsize], dtype=INDEX_DTYPE).copy()
+
+        lines = []
+        if os.path.exists(self.metadata_path):
+            with open(self.metadata_path, 'rb') as file:
+                lines = file.readlines()
+
+        # A line without its newline was not written completely
+        metadata = [json.loads(line) for line in lines if line.endswith(b'\n')]
+        data_size = os.path.getsize(self.data_path) if os.path.exists(self.data_path) else 0
+
+        # Only the chunks whose data, index entry and metadata were all written count
+        ends = index['offset'] + index['height'].astype(np.uint64) * index['width']
+        complete = min(int(np.searchsorted(ends > data_size, True)), len(metadata))
+
+        self._entries = index[:complete]
+        self.count = complete
+        self.metadata = metadata[:complete]
+        self.size = int(ends[complete - 1]) if complete else 0
+
+        # Appending after a crash has to start where the last complete chunk ended. This
+        # happens before the data is mapped, since Windows can't truncate a mapped file.
+        if self.mode == 'a':
+            self.files[0].truncate(self.size)
+            self.files[1].truncate(complete * INDEX_DTYPE.itemsize)
+
+            if len(lines) != complete:
+                self.files[2].truncate(sum(len(line) for line in lines[:complete]))
+
+        self._map()
+
+    def _map(self):
+        """Maps the data file, again if it has grown since it was last mapped."""
+        if os.path.exists(self.data_path) and os.path.getsize(self.data_path) > 0:
+            self.data = np.memmap(self.data_path, dtype=np.uint8, mode='r').view(np.ndarray)
+        else:
+            self.data = np.empty(0, dtype=np.uint8)
@@ -1,6 +1,14 @@
+# System modules
+import os
+from multiprocessing import Pool
+
+# External modules
 import cv2
 from imutils import contours
 
+# Custom
+from ForgeryDetector.core import metrics
+
 # Preprocessing constants
 FILTERED_BLOTS_PATH = r'Data\Blot data\Filtered blots'
 CROPPED_BLOTS_PATH = r'Data\Blot data\Cropped blots'
@@ -10,8 +18,8 @@ class ImageCropper():
     def __init__(self, data_dir=None):
         if data_dir is None:
             self.data_dir = FILTERED_BLOTS_PATH
-
-        self.data_dir = data_dir
+        else:
+            self.data_dir = data_dir
 
     def crop_image(self, image, conts, path=None):
         """Crops the contours found within an image into separate entities.
@@ -24,15 +32,152 @@ class ImageCropper():
         if path is None:
             path = CROPPED_BLOTS_PATH
 
+        self.save_crops(self.get_crops(image, conts), path)
+
+    def save_crops(self, crops, path=None, name=None, ext=None):
+        """Saves crops to a folder.
+
+        Args:
+            crops (list[tuple(tuple(int, int, int, int), numpy.ndarray)]): The boxes and crops,
+            as returned by get_crops or crop_panels.
+            path (str, optional): Where to save the images. Defaults to None.
+            name (str, optional): The start of the file names. Defaults to None ('img').
+            ext (str, optional): The file extension. Defaults to None ('jpg').
+
+        Returns:
+            list[str]: The paths of the saved crops.
+        """
+        if path is None:
+            path = CROPPED_BLOTS_PATH
+
+        if name is None:
+            name = 'img'
+
+        if ext is None:
+            ext = 'jpg'
+
+        crop_paths = []
+        for index, (_, crop) in enumerate(crops, start=1):
+            # Save image to path
+            crop_path = fr'{path}\{name}_{index}.{ext}'
+            cv2.imwrite(crop_path, crop)
+            crop_paths.append(crop_path)
+
+        return crop_paths
+
+    @metrics.timed('cropper_seconds', function='crop_panels')
+    def crop_panels(self, image, min_area=None, max_area=None, min_aspect=None, max_aspect=None, threshold=None):
+        """Finds the panels of an image in a single pass and returns them
+        without copying or saving anything. The image is thresholded like in
+        find_contours and every connected component becomes a panel.
+
+        Args:
+            image (numpy.ndarray): The image to be cropped.
+            min_area (int, optional): Panels with a smaller bounding box are skipped. Defaults to None (100).
+            max_area (int, optional): Panels with a larger bounding box are skipped. Defaults to None.
+            min_aspect (float, optional): Panels with a smaller width / height are skipped. Defaults to None.
+            max_aspect (float, optional): Panels with a larger width / height are skipped. Defaults to None.
+            threshold (int, optional): The intensity above which a pixel belongs to a panel. Defaults to None (127).
+
+        Returns:
+            list[tuple(tuple(int, int, int, int), numpy.ndarray)]: The bounding box (x, y, w, h) of
+            every panel and a view of the image inside it, from top to bottom.
+        """
+        if min_area is None:
+            min_area = 100
+
+        if threshold is None:
+            threshold = 127
+
+        gray_img = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if len(image.shape) == 3 else image
+        _, binary = cv2.threshold(gray_img, threshold, 255, cv2.THRESH_BINARY)
+
+        # Label 0 is the background
+        _, _, stats, _ = cv2.connectedComponentsWithStats(binary, connectivity=8)
+        boxes = []
+
+        for x, y, w, h, _ in stats[1:]:
+            area = w * h
+            aspect = w / h
+
+            if area < min_area or (max_area is not None and area > max_area):
+                continue
+            if (min_aspect is not None and aspect < min_aspect) or (max_aspect is not None and aspect > max_aspect):
+                continue
+
+            boxes.append((int(x), int(y), int(w), int(h)))
+
+        # Sort such that crops are happening from top to bottom
+        boxes.sort(key=lambda box: (box[1], box[0]))
+        metrics.count('cropper_panels_total', len(boxes))
+
+        # Slicing gives views into the image, so nothing is copied
+        return [(box, image[box[1]:box[1] + box[3], box[0]:box[0] + box[2]]) for box in boxes]
+
+    @metrics.timed('cropper_seconds', function='crop_folder')
+    def crop_folder(self, folder=None, path=None, processes=None, archive=None, **filters):
+        """Crops every image in a folder in a process pool.
+
+        Args:
+            folder (str, optional): The folder with the images. Defaults to None (the data directory).
+            path (str, optional): If given the crops are saved in this folder. Defaults to None.
+            processes (int, optional): The amount of processes. Defaults to None (the amount of CPUs).
+            archive (ChunkArchive, optional): If given the crops are added to this archive, with the
+            file and box they were cropped from. Defaults to None.
+            **filters: The area, aspect and threshold arguments of crop_panels.
+
+        Returns:
+            dict[str, list[tuple(int, int, int, int)]]: The boxes of the panels of every image.
+        """
+        if folder is None:
+            folder = self.data_dir
+
+        tasks = [(os.path.join(folder, image_file), path, filters, archive is not None) for image_file in sorted(os.listdir(folder))]
+
+        panels = {}
+        with Pool(processes) as pool:
+            # The results arrive in the order of the files, and the crops of a file are added
+            # to the archive (from this process only) before the next one is received
+            for (image_path, *_), crops in zip(tasks, pool.imap(_crop_file, tasks)):
+                if crops is None:
+                    continue
+
+                if archive is not None:
+                    archive.add_many(crops, file=os.path.basename(image_path))
+                    crops = [box for box, _ in crops]
+
+                panels[os.path.basename(image_path)] = crops
+
+        return panels
+
+    @metrics.timed('cropper_seconds', function='get_crops')
+    def get_crops(self, image, conts, min_area=None):
+        """Crops the contours found within an image without saving them.
+
+        Args:
+            image (numpy.ndarray): The image to be cropped.
+            conts (list[numpy.ndarray]): The contours of interest that will be cropped.
+            min_area (int, optional): Bounding boxes smaller than this are skipped. Defaults to None.
+
+        Returns:
+            list[tuple(tuple(int, int, int, int), numpy.ndarray)]: The bounding box (x, y, w, h)
+            and the cropped image of every contour, from top to bottom.
+        """
+        if min_area is None:
+            min_area = 0
+
         # Sort contours such that crops are happening from top to bottom
         (conts, _) = contours.sort_contours(conts, method="top-bottom")
+        crops = []
 
-        for index, cont in enumerate(conts, start=1):
+        for cont in conts:
             # Get bounding box
             x, y, w, h = cv2.boundingRect(cont)
 
-            # Save image to path
-            cv2.imwrite(fr'{path}\img_{index}.jpg', image[y:y + h, x:x + w])
+            if w * h >= min_area:
+                crops.append(((x, y, w, h), image[y:y + h, x:x + w]))
+
+        return crops
 
     def find_contours(self, image):
         """Finds the contours of an image.
@@ -71,3 +216,33 @@ class ImageCropper():
             contourid = -1  # Flag to draw all contours
 
         return cv2.drawContours(img, contours, contourid, (0, 255, 0), 2)
+
+
+def _crop_file(args):
+    """Crops a single file. This lives outside of the class so that it can
+    be sent to the processes of crop_folder.
+
+    Args:
+        args (tuple(str, str, dict, bool)): The image path, the folder to save the crops in (or None),
+        the arguments for crop_panels and whether to return the crops themselves.
+
+    Returns:
+        list[tuple(int, int, int, int)]: The boxes of the panels, or the boxes and crops if they are
+        returned. None if the image can't be read.
+    """
+    image_path, path, filters, keep = args
+    image = cv2.imread(image_path)
+
+    if image is None:
+        return None
+
+    cropper = ImageCropper()
+    crops = cropper.crop_panels(image, **filters)
+
+    if path is not None:
+        cropper.save_crops(crops, path, os.path.splitext(os.path.basename(image_path))[0], 'png')
+
+    if keep:
+        return crops
+
+    return [box for box, _ in crops]
@@ -1,44 +1,71 @@
 # System modules
+import io
+import os
 import re
-import time as timer
-from urllib.error import HTTPError
-import urllib.request
+import urllib.parse
 from enum import Enum
-from shutil import rmtree
+from xml.etree.ElementTree import iterparse
 from os import getenv, mkdir, path
+from multiprocessing import Pool
 from multiprocessing.pool import ThreadPool
+from queue import Queue
 
 # External modules
-import fitz  # PyMuPDF module
-from Bio import Entrez
-from bs4 import SoupStrainer
-from bs4 import BeautifulSoup
 from dotenv import load_dotenv
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
+
+# Custom
+from ForgeryDetector.core.preprocessing.fetch import HttpFetcher, HOST_RATES
+from ForgeryDetector.core.preprocessing.store import ImageStore
+from ForgeryDetector.core.lazy import lazy_import
+from ForgeryDetector.core import metrics
+
+# PyMuPDF and Biopython are only loaded once they are used. Selenium and
+# BeautifulSoup are imported by the PubPeer methods that need them.
+fitz = lazy_import('fitz')
+Entrez = lazy_import('Bio.Entrez')
 
 # Pubpeer constants
+PUBPEER_SITE = 'https://pubpeer.com'
+PUBPEER_IMAGE_SITE = 'https://images.pubpeer.com'
 PUBPEER_BASE_URL = 'https://www.pubpeer.com/search?q='
 PUBPEER_IMG_PATH = r'Data\Blot data\Pubpeer'
 PUBPEER_PUBLICATION_URL = 'https://www.pubpeer.com/publications/'
 
+# Pubpeer page elements
+PUBPEER_COOKIE_BUTTON = ('body > div.cc-window.cc-floating.cc-type-info.cc-theme-classic.cc-bottom.cc-right.'
+                         'cc-color-override-1019874493 > div > a')
+PUBPEER_FOOTER_BUTTON = '#page-wrapper > div.extension-installer.container > div > div > span > i'
+PUBPEER_MORE_BUTTON = ('#page-wrapper > div.wrapper.wrapper-content > div > div > div.col-md-12.publication-list > '
+                       'div > div.recent-comments > div.publication-list > div.text-center > button')
+PUBPEER_PUBLICATION_LINKS = 'a[href^="/publications"]'
+
 # Pubmed constants
+EUTILS_URL = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/'
+# The tool name Entrez sends with its requests
+EUTILS_TOOL = 'biopython'
 PUBMED_IMG_PATH = r'Data\Blot data\Pubmed'
 PUBMED_TEMP_PDF_PATH = r'Data\Blot data\Pubmed\PDFs'
 
+# Embedded images in these formats are written as they are instead of being re-encoded
+RAW_IMAGE_FORMATS = ('jpeg', 'png')
+
+# The stores the extraction processes opened, by their root
+_stores = {}
+
 # Selenium constants
 CHROME_PATH = r'C:\Program Files\Google\Chrome\Application\chrome.exe'
 CHROMEDRIVER_PATH = fr'{CHROME_PATH[:-11]}\chromedriver.exe'
 
 # Other constants
-HEADER = {'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64; rv:27.0) Gecko/20100101 Firefox/27.0'}
 SECRETS = r'ForgeryDetector\secrets.env'
 
 
 class DownloadManager():
-    def __init__(self, headless=None, threads=None, webbrowser_path=None, driver_path=None):
+    def __init__(self, headless=None, threads=None, webbrowser_path=None, driver_path=None, fetcher=None):
         if headless is None:
             self.headless = True
+        else:
+            self.headless = headless
 
         if threads is None:
             self.threads = 8
@@ -55,23 +82,41 @@ class DownloadManager():
         else:
             self.driver = driver_path
 
-        self.PubMed = DownloadManager.PubMed(threads=self.threads)
-        self.PubPeer = DownloadManager.PubPeer(headless=self.headless, threads=self.threads)
+        # Both databases share one fetcher so that its connections and rate limits are shared too
+        if fetcher is None:
+            self.fetcher = HttpFetcher(threads=self.threads)
+        else:
+            self.fetcher = fetcher
+
+        self.PubMed = DownloadManager.PubMed(threads=self.threads, fetcher=self.fetcher)
+        self.PubPeer = DownloadManager.PubPeer(headless=self.headless, threads=self.threads, fetcher=self.fetcher)
 
     class PubMed():
         class ArticleType(Enum):
             PMC = 1
             DOI = 2
 
-        def __init__(self, threads):
+        def __init__(self, threads, fetcher=None):
             # Load environment in order to read the environment variables in the .env file
             load_dotenv(SECRETS)
-            Entrez.email = getenv('EntrezMail')
-            Entrez.api_key = getenv('EntrezAPI')
+
+            # Sent with every E-utility request by _eutils, so Biopython isn't loaded for them
+            self.email = getenv('EntrezMail')
+            self.api_key = getenv('EntrezAPI')
 
             # Loads threads
             self.threads = threads
 
+            if fetcher is None:
+                self.fetcher = HttpFetcher(threads=threads)
+            else:
+                self.fetcher = fetcher
+
+            # NCBI allows 10 instead of 3 requests per second with an API key
+            if self.api_key:
+                for host in HOST_RATES:
+                    self.fetcher.rates[host] = 10.0
+
             # Create some needed folders if they don't already exist
             if not path.exists(PUBMED_TEMP_PDF_PATH):
                 mkdir(PUBMED_TEMP_PDF_PATH)
@@ -97,11 +142,11 @@ class DownloadManager():
                 count (int): Returns the amount of records found.
             """
             # Send query and return found articles as dictionary
-            result = Entrez.read(Entrez.esearch(db=db, retmax=retmax, datetype=datetype, mindate=mindate, maxdate=maxdate, term=term, usehistory=usehistory), validate=False)
+            result = Entrez.read(self._eutils('esearch', db=db, retmax=retmax, datetype=datetype, mindate=mindate, maxdate=maxdate, term=term, usehistory=usehistory), validate=False)
             count = result["Count"]
 
             # Fetch the results using the found articles from the previous line
-            handle = Entrez.efetch(db=db, rettype="full", retmode="xml", retstart=0, retmax=1, webenv=result["WebEnv"], query_key=result["QueryKey"])
+            handle = self._eutils('efetch', db=db, rettype="full", retmode="xml", retstart=0, retmax=1, webenv=result["WebEnv"], query_key=result["QueryKey"])
 
             # Parse the results and get count
             records = Entrez.read(handle, validate=False)
@@ -126,13 +171,15 @@ class DownloadManager():
                 tuple(list[str], ArticleType): Returns a tuple containing
                 a list of article URLs and the type of the articles.
             """
-            handle = Entrez.esearch(db=db, retmax=retmax, datetype=datetype, mindate=mindate, maxdate=maxdate, term=term, usehistory=usehistory)
+            handle = self._eutils('esearch', db=db, retmax=retmax, datetype=datetype, mindate=mindate, maxdate=maxdate, term=term, usehistory=usehistory)
             records = Entrez.read(handle, validate=False)
 
-            # get a list of Pubmed IDs for all articles
-            idlist = ','.join(records['IdList'])
-            handle = Entrez.efetch("pmc", id=idlist, retmode="xml")
-            records = Entrez.read(handle, validate=False)
+            # get a list of Pubmed IDs for all articles, fetched in parts so the URLs stay short
+            ids = list(records['IdList'])
+            records = []
+            for start in range(0, len(ids), 200):
+                handle = self._eutils('efetch', db='pmc', id=','.join(ids[start:start + 200]), retmode='xml')
+                records.extend(Entrez.read(handle, validate=False))
 
             pmc_articles = []
             dois = []
@@ -151,6 +198,114 @@ class DownloadManager():
 
             return (pmc_articles, self.ArticleType.PMC), (dois, self.ArticleType.DOI)
 
+        def iter_links(self, db, datetype, mindate, maxdate, term, article_type=None, page_size=None, max_records=None):
+            """Gets the URLs of articles given a list of parameters, one page at
+            a time. The search is posted on the History server and the pages
+            are fetched from there with retstart/retmax. Only one page is held
+            at a time, so memory use does not depend on the size of the search.
+            A page of full PMC articles can be several megabytes, hence the small
+            default page size.
+
+            Args:
+                db (str): Which database to search in.
+                datetype (str): What type of date to use.
+                mindate (str): Minimum date.
+                maxdate (str): Maximum date.
+                term (str): Which term to search for.
+                article_type (ArticleType, optional): Which links to yield. Defaults to None (PMC).
+                page_size (int, optional): How many records to fetch per request. Defaults to None (100).
+                max_records (int, optional): Stop after this many records. Defaults to None (all).
+
+            Yields:
+                tuple(str, str): The URL and the ID of an article, like the items returned by get_links.
+            """
+            if article_type is None:
+                article_type = self.ArticleType.PMC
+
+            if page_size is None:
+                page_size = 100
+
+            # Only post the search on the History server, the IDs are fetched per page
+            search = Entrez.read(self._eutils('esearch', db=db, retmax=0, datetype=datetype, mindate=mindate, maxdate=maxdate,
+                                              term=term, usehistory='y'), validate=False)
+            count = int(search['Count'])
+
+            if max_records is not None:
+                count = min(count, max_records)
+
+            for retstart in range(0, count, page_size):
+                handle = self._eutils('efetch', db=db, retmode='xml', retstart=retstart, retmax=min(page_size, count - retstart),
+                                      webenv=search['WebEnv'], query_key=search['QueryKey'])
+
+                try:
+                    yield from self._parse_links(handle, article_type)
+                finally:
+                    handle.close()
+
+        def _eutils(self, utility, **params):
+            """Calls an E-utility through the fetcher, so the searches share
+            its connections, retries and NCBI rate limit with the downloads.
+            The email and API key are sent the way Entrez sends them.
+
+            Args:
+                utility (str): The E-utility, e.g. 'esearch' or 'efetch'.
+                **params: Its parameters, the same as for Entrez.esearch and Entrez.efetch.
+
+            Returns:
+                io.BytesIO: The response, which Entrez.read and iterparse can read.
+            """
+            params = {key: value for key, value in params.items() if value is not None}
+            params.setdefault('tool', EUTILS_TOOL)
+
+            if self.email:
+                params.setdefault('email', self.email)
+            if self.api_key:
+                params.setdefault('api_key', self.api_key)
+
+            body = self.fetcher.fetch(f'{EUTILS_URL}{utility}.fcgi?{urllib.parse.urlencode(params)}')
+            if body is None:
+                raise IOError(f'The {utility} request failed.')
+
+            return io.BytesIO(body)
+
+        def _parse_links(self, handle, article_type):
+            """Parses the article links out of an efetch response while it is
+            being read. Every article is cleared after it has been parsed.
+
+            Args:
+                handle (file): The efetch response.
+                article_type (ArticleType): Which links to yield.
+
+            Yields:
+                tuple(str, str): The URL and the ID of an article.
+            """
+            id_type = 'pmc' if article_type == self.ArticleType.PMC else 'doi'
+            depth = 0
+            root = None
+
+            for event, element in iterparse(handle, events=('start', 'end')):
+                if event == 'start':
+                    if root is None:
+                        root = element
+                    depth += 1
+                    continue
+
+                depth -= 1
+
+                # Only the articles directly below the root are records
+                if depth != 1 or element.tag != 'article':
+                    continue
+
+                for article_id in element.iterfind('front/article-meta/article-id'):
+                    if article_id.get('pub-id-type') == id_type and article_id.text:
+                        if article_type == self.ArticleType.PMC:
+                            yield f'http://www.ncbi.nlm.nih.gov/pmc/articles/{article_id.text}/pdf/', article_id.text
+                        else:
+                            yield f'http://dx.doi.org/{article_id.text}', article_id.text
+
+                # Drop the parsed article so memory stays flat
+                root.clear()
+
         def show_articles(self, articles):
             """Print articles.
 
@@ -166,13 +321,25 @@ class DownloadManager():
                     for index, article in enumerate(articles[0], start=1):
                         print(F'Paper {index} with ID {article[1]}: {article[0]}')
 
-        def download(self, articles, path=None, rm=None):
+        @metrics.timed('download_seconds', source='pubmed', stage='download')
+        def download(self, articles, path=None, rm=None, store=None, processes=None, min_size=None, manifest=None, img_path=None):
             """Given a list of article URLs, the articles are
             downloaded and the images extracted from said articles.
 
             Args:
                 articles (list[str]): A list of article URLs.
-                rm (bool, optional): If True then remove the folder with the downloaded papers. Defaults to None.
+                path (str, optional): Where to save the PDFs. Defaults to None.
+                rm (bool, optional): If True then remove the downloaded papers once their images have been
+                extracted. Defaults to None.
+                store (ImageStore, optional): If given the images are added to the store and only
+                images that are new to the store are saved in the image folder. Defaults to None.
+                processes (int, optional): If given the PDFs are kept in memory and their images are
+                extracted by this many processes (see extract_images_parallel). Defaults to None.
+                min_size (int, optional): Used with processes, see extract_images_parallel. Defaults to None.
+                manifest (JobManifest, optional): If given, articles whose images were extracted in an
+                earlier run are skipped, and PDFs that were downloaded but not extracted are not
+                downloaded again. Defaults to None.
+                img_path (str, optional): Where to save the extracted images. Defaults to None.
             """
             if rm is None:
                 rm = True
@@ -180,84 +347,372 @@ class DownloadManager():
             if path is None:
                 path = PUBMED_TEMP_PDF_PATH
 
+            if img_path is None:
+                img_path = PUBMED_IMG_PATH
+
             if isinstance(articles, tuple):
                 article_list = articles[0]
             else:
                 print(f'Expected type <class \'tuple\'>, but got {type(articles)} instead.')
+                return
+
+            # The index of an article in the search stays part of its file name
+            indexed_articles = list(enumerate(article_list, start=1))
+            if manifest is not None:
+                todo = set(manifest.todo('article', [article_id for _, (_, article_id) in indexed_articles], 'extract'))
+                indexed_articles = [(index, article) for index, article in indexed_articles if article[1] in todo]
+
+            if processes is not None:
+                self._download_in_memory([article for _, article in indexed_articles], processes, min_size, store, manifest, img_path)
+                return
 
             pdf_paths = []
-            downloads_iterable = []
-            for index, (url, article_id) in enumerate(article_list, start=1):
-                downloads_iterable.append((url, fr'{path}\Paper_{index}_{article_id}.pdf'))
-                pdf_paths.append([fr'{path}\Paper_{index}_{article_id}.pdf'])
+            pending = []
+            for index, (url, article_id) in indexed_articles:
+                pdf_path = fr'{path}\Paper_{index}_{article_id}.pdf'
+
+                # A PDF from a run that stopped (or failed) before extracting it is still on disk
+                job = None if manifest is None else manifest.get('article', article_id)
+                downloaded = job is not None and (job['stage'], job['state']) in [('download', 'done'), ('extract', 'failed')]
+                if downloaded and os.path.exists(pdf_path):
+                    pdf_paths.append((pdf_path, article_id))
+                else:
+                    pending.append((url, pdf_path, article_id))
+
+            # Failed downloads are None and skipped instead of stopping the others
+            downloaded = self.fetcher.fetch_many([(url, pdf_path) for url, pdf_path, _ in pending])
+            succeeded = [(pdf_path, article_id) for (_, pdf_path, article_id), result in zip(pending, downloaded) if result is not None]
+            failed = [article_id for (_, _, article_id), result in zip(pending, downloaded) if result is None]
+            pdf_paths += succeeded
+            metrics.count('download_articles_total', len(succeeded), source='pubmed', result='ok')
+            metrics.count('download_articles_total', len(failed), source='pubmed', result='failed')
+
+            if manifest is not None:
+                manifest.mark_many('article', [article_id for _, article_id in succeeded], 'download', source='pubmed')
+                manifest.mark_many('article', failed, 'download', 'failed', source='pubmed')
+
+            with ThreadPool(self.threads) as tp:
+                extracted = tp.starmap(self._extract_article, [(pdf_path, article_id, store, manifest, img_path) for pdf_path, article_id in pdf_paths])
 
-            try:
-                with ThreadPool(self.threads) as tp:
-                    tp.starmap(urllib.request.urlretrieve, downloads_iterable)
-            except Exception as e:
-                print(f'Exception occurred during urlretrieve: {e}')
+            if rm:
+                # Only remove the papers whose images were extracted, the others are needed by the next run
+                for (pdf_path, _), image_paths in zip(pdf_paths, extracted):
+                    if image_paths is not None and os.path.exists(pdf_path):
+                        os.remove(pdf_path)
+
+        def _extract_article(self, pdf_path, article_id, store=None, manifest=None, img_path=None):
+            """Extracts the images of a downloaded article and records them in the manifest.
 
+            Args:
+                pdf_path (str): The path of the PDF.
+                article_id (str): The ID of the article.
+                store (ImageStore, optional): See extract_images. Defaults to None.
+                manifest (JobManifest, optional): The manifest to record the article and its images in. Defaults to None.
+                img_path (str, optional): Where to save the images. Defaults to None.
+
+            Returns:
+                list[str]: The paths of the extracted images, or None if they could not be extracted.
+            """
             try:
-                with ThreadPool(self.threads) as tp:
-                    tp.starmap(self.extract_images, pdf_paths)
+                if not os.path.exists(pdf_path):
+                    raise FileNotFoundError(f'File not found: {pdf_path}')
+
+                image_paths = self.extract_images(pdf_path, img_path, store)
             except Exception as e:
                 print(f'Exception occurred during extract_images: {e}')
+                if manifest is not None:
+                    manifest.mark('article', article_id, 'extract', 'failed', source='pubmed', error=str(e))
+                return None
 
-            if rm:
-                # Remove the folder with the papers since they are not needed anymore
-                rmtree(path)
+            # The images are recorded before the article, so the article is only done once they are
+            if manifest is not None:
+                manifest.mark_many('image', [os.path.basename(image_path) for image_path in image_paths], 'extract',
+                                   source='pubmed', article=article_id)
+                manifest.mark('article', article_id, 'extract', source='pubmed', result=len(image_paths))
+
+            return image_paths
+
+        def _download_in_memory(self, article_list, processes, min_size=None, store=None, manifest=None, img_path=None):
+            """Downloads the articles into memory and extracts their images in
+            a process pool. The articles are handled in chunks, and the next
+            chunk is downloaded while the current one is being extracted.
+
+            Args:
+                article_list (list[tuple(str, str)]): The (url, article ID) pairs.
+                processes (int): The amount of extraction processes.
+                min_size (int, optional): See extract_images_parallel. Defaults to None.
+                store (ImageStore, optional): See extract_images_parallel. Defaults to None.
+                manifest (JobManifest, optional): The manifest to record the articles and images in. Defaults to None.
+                img_path (str, optional): Where to save the images. Defaults to None.
+
+            Returns:
+                list[str]: The paths of the extracted images.
+            """
+            if img_path is None:
+                img_path = PUBMED_IMG_PATH
+
+            chunk = processes * 2
+            image_paths = []
+            pending = None
+            pending_ids = None
+
+            with Pool(processes) as pool:
+                for start in range(0, len(article_list), chunk):
+                    part = article_list[start:start + chunk]
+                    pdfs = self.fetcher.fetch_many([(url, None) for url, _ in part])
+                    metrics.count('download_articles_total', sum(pdf is not None for pdf in pdfs), source='pubmed', result='ok')
+                    metrics.count('download_articles_total', sum(pdf is None for pdf in pdfs), source='pubmed', result='failed')
+                    tasks = [(pdf, article_id, img_path, min_size, None if store is None else store.root)
+                             for pdf, (_, article_id) in zip(pdfs, part) if pdf is not None]
+
+                    if manifest is not None:
+                        manifest.mark_many('article', [article_id for pdf, (_, article_id) in zip(pdfs, part) if pdf is not None],
+                                           'download', source='pubmed')
+                        manifest.mark_many('article', [article_id for pdf, (_, article_id) in zip(pdfs, part) if pdf is None],
+                                           'download', 'failed', source='pubmed')
+
+                    if pending is not None:
+                        image_paths += self._collect_images(pending.get(), store, img_path, manifest, pending_ids)
+                    pending = pool.starmap_async(_extract_pdf, tasks)
+                    pending_ids = [article_id for _, article_id, *_ in tasks]
+
+                if pending is not None:
+                    image_paths += self._collect_images(pending.get(), store, img_path, manifest, pending_ids)
+
+            return image_paths
+
+        @metrics.timed('download_seconds', source='pubmed', stage='extract')
+        def extract_images_parallel(self, pdfs, path=None, min_size=None, processes=None, store=None):
+            """Extracts the images of several PDFs in a process pool, since
+            decoding images in PyMuPDF holds the GIL. The PDFs can be given as
+            bytes straight from the downloader, so they never have to be
+            written to disk. Every image is written as soon as it has been
+            read; JPEG and PNG streams are written as they are embedded, and
+            images smaller than min_size are skipped before being decoded.
+            With a store the processes add every image to it as soon as it
+            has been read, and only the ones that are new to the store are
+            copied to the image folder.
+
+            Args:
+                pdfs (iterable[tuple(bytes or str, str)]): The PDFs (as bytes or paths) and their article IDs.
+                path (str, optional): Where to save the images. Defaults to None.
+                min_size (int, optional): Images narrower or lower than this are skipped. Defaults to None (64).
+                processes (int, optional): The amount of processes. Defaults to None (the amount of CPUs).
+                store (ImageStore, optional): If given the images are added to the store and only
+                images that are new to the store are kept, named after their hash. Defaults to None.
+
+            Returns:
+                list[str]: The paths of the extracted images.
+            """
+            if path is None:
+                path = PUBMED_IMG_PATH
+
+            image_paths = []
+
+            with Pool(processes) as pool:
+                tasks = ((pdf, article_id, path, min_size, None if store is None else store.root) for pdf, article_id in pdfs)
+                for images in pool.imap_unordered(_extract_pdf_star, tasks):
+                    image_paths += self._collect_images([images], store, path)
+
+            return image_paths
 
         @staticmethod
-        def extract_images(pdf_path, path=None):
+        def _collect_images(results, store=None, path=None, manifest=None, article_ids=None):
+            """Gathers the images of the extraction processes and, if a store
+            is given, copies the ones that are new to the store to the image folder.
+
+            Args:
+                results (list[list[tuple(str or tuple(str, bool), str, int, int)]]): The (image, article ID,
+                page, xref) of the images of every PDF, where the image is its path, or its hash and
+                whether it was new if the processes added it to the store.
+                store (ImageStore, optional): The store the images were added to. Defaults to None.
+                path (str, optional): Where the new images of the store are saved. Defaults to None.
+                manifest (JobManifest, optional): The manifest to record the images in. Defaults to None.
+                article_ids (list[str], optional): The article of every PDF, which are marked as extracted
+                in the manifest. Defaults to None.
+
+            Returns:
+                list[str]: The paths of the images that are handed on.
+            """
+            if path is None:
+                path = PUBMED_IMG_PATH
+
+            image_paths = []
+
+            for pdf_index, images in enumerate(results):
+                metrics.count('download_images_total', len(images), source='pubmed')
+                handed_on = []
+
+                for image, article_id, page, xref in images:
+                    if store is None:
+                        handed_on.append((image, article_id))
+                        continue
+
+                    blob_hash, new = image
+                    if new:
+                        handed_on.append((store.export(blob_hash, path), article_id))
+
+                if manifest is not None:
+                    for image_path, article_id in handed_on:
+                        manifest.mark('image', os.path.basename(image_path), 'extract', source='pubmed', article=article_id)
+                    if article_ids is not None:
+                        manifest.mark('article', article_ids[pdf_index], 'extract', source='pubmed', result=len(handed_on))
+
+                image_paths += [image_path for image_path, _ in handed_on]
+
+            return image_paths
+
+        @metrics.timed('download_seconds', source='pubmed', stage='download_article')
+        def download_article(self, url, article_id, index=None, path=None):
+            """Downloads a single article. Unlike download, this does not
+            extract the images, which makes it usable as one step of a
+            larger pipeline.
+
+            Args:
+                url (str): The URL of the article PDF.
+                article_id (str): The ID of the article.
+                index (int, optional): The index of the article in the search. Defaults to None.
+                path (str, optional): The folder to save the PDF in. Defaults to None.
+
+            Returns:
+                str: The path of the downloaded PDF, or None if the download failed.
+            """
+            if index is None:
+                index = 1
+
+            if path is None:
+                path = PUBMED_TEMP_PDF_PATH
+
+            return self.fetcher.fetch(url, fr'{path}\Paper_{index}_{article_id}.pdf')
+
+        @staticmethod
+        @metrics.timed('download_seconds', source='pubmed', stage='extract')
+        def extract_images(pdf_path, path=None, store=None):
             """Extracts images from a PDF given a path.
 
             Args:
                 path (str): Path of the PDF file.
+                store (ImageStore, optional): If given the images are added to the store and only
+                images that are new to the store are saved, named after their hash. Defaults to None.
+
+            Returns:
+                list[str]: The paths of the extracted images.
             """
             if path is None:
                 path = PUBMED_IMG_PATH
 
             article_id = pdf_path[-11:-4]
+            image_paths = []
 
-            if path.exists(pdf_path):
+            if os.path.exists(pdf_path):
                 with fitz.open(filename=pdf_path, filetype='pdf') as pdf:
-                    xrefs = set()
+                    xrefs = {}
 
                     for page_index in range(pdf.pageCount):
                         for image in pdf.get_page_images(page_index):
-                            # The XREF unique identifier is added to the set
+                            # The XREF unique identifier is used as the key
                             # in order to not have duplicates.
-                            xrefs.add(image[0])
+                            xrefs.setdefault(image[0], page_index + 1)
+
+                    metrics.count('download_images_total', len(xrefs), source='pubmed')
 
-                    # A pixmap is an object specific to PyMuPDF (Fitz)
-                    # and represents a rectangular square of pixels.
-                    pixmaps = [fitz.Pixmap(pdf, xref) for xref in xrefs]
+                    if store is not None:
+                        for xref, page in xrefs.items():
+                            data = fitz.Pixmap(pdf, xref).tobytes('png')
+                            blob_hash, _, new = store.put(data, 'png', 'pubmed', article_id, page, xref)
 
-                    for index, pixmap in enumerate(pixmaps, start=1):
-                        pixmap.save(fr'{path}\Pubmed_{article_id}_{index}.png')
+                            # Images seen before (logos, reused figures) are not handed on again
+                            if new:
+                                image_paths.append(store.export(blob_hash, path))
+
+                        return image_paths
+
+                    for index, xref in enumerate(xrefs, start=1):
+                        # A pixmap is an object specific to PyMuPDF (Fitz)
+                        # and represents a rectangular square of pixels.
+                        # Only one is kept in memory at a time.
+                        image_path = fr'{path}\Pubmed_{article_id}_{index}.png'
+                        fitz.Pixmap(pdf, xref).save(image_path)
+                        image_paths.append(image_path)
             else:
                 print(f'File not found: {pdf_path}')
-                return
+
+            return image_paths
 
     class PubPeer():
-        def __init__(self, threads, headless):
+        def __init__(self, threads, headless, fetcher=None, site=None, timeout=None, image_site=None):
             # Check image folder existence
             if not path.exists(PUBPEER_IMG_PATH):
                 mkdir(PUBPEER_IMG_PATH)
 
-            # Set options for Selenium
-            self.opts = Options()
-            self.opts.add_experimental_option('excludeSwitches', ['enable-logging'])  # Disable annoying messages
-            self.opts.headless = headless
-            self.opts.binary_location = CHROME_PATH
-
-            # Set the location of the webdriver
+            # The browsers are only started once a page has to be visited with one
+            self.headless = headless
             self.chrome_driver = CHROMEDRIVER_PATH
-            self.driver = webdriver.Chrome(options=self.opts, executable_path=self.chrome_driver)
 
             # Get threads
             self.threads = threads
 
+            if fetcher is None:
+                self.fetcher = HttpFetcher(threads=threads)
+            else:
+                self.fetcher = fetcher
+
+            # The site can be changed to test against a local copy
+            if site is None:
+                self.site = PUBPEER_SITE
+            else:
+                self.site = site
+
+            # Only images hosted here are downloaded
+            if image_site is None:
+                self.image_site = PUBPEER_IMAGE_SITE
+            else:
+                self.image_site = image_site
+
+            # How long to wait for a page or an element before giving up
+            if timeout is None:
+                self.timeout = 10
+            else:
+                self.timeout = timeout
+
+            # Every browser that has been started, the first one is the main driver
+            self.drivers = []
+
+        @property
+        def driver(self):
+            """The main browser, which is started the first time it is used."""
+            if not self.drivers:
+                self._start_driver()
+
+            return self.drivers[0]
+
+        def _start_driver(self):
+            """Starts a new browser and adds it to the drivers.
+
+            Returns:
+                webdriver.Chrome: The browser.
+            """
+            from selenium import webdriver
+            from selenium.webdriver.chrome.options import Options
+
+            # Set options for Selenium
+            opts = Options()
+            opts.add_experimental_option('excludeSwitches', ['enable-logging'])  # Disable annoying messages
+            opts.headless = self.headless
+            opts.binary_location = CHROME_PATH
+
+            driver = webdriver.Chrome(options=opts, executable_path=self.chrome_driver)
+            self.drivers.append(driver)
+            return driver
+
+        def close(self):
+            """Quits every browser that has been started."""
+            for driver in self.drivers:
+                driver.quit()
+
+            self.drivers = []
+
+        @metrics.timed('download_seconds', source='pubpeer', stage='search')
         def get_soup(self, term, pages=None):
             """Given a search term, get the HTML code (soups) of
             the result.
@@ -278,83 +733,203 @@ class DownloadManager():
                 return
 
             term = re.sub(' ', '+', term)
-            url = f'{PUBPEER_BASE_URL}{term}'
+            url = f'{self.site}/search?q={term}'
 
             # Maximize the window size to ensure scrolling to the bottom works
             self.driver.maximize_window()
 
-            # Get content of website and wait 1 sec so that it can all be loaded
+            # Get content of website and wait until it has been loaded
             self.driver.get(url)
-            timer.sleep(2)
-
-            # Accept cookie disclaimer
-            self.driver.find_element_by_css_selector('body > div.cc-window.cc-floating.cc-type-info.cc-theme'
-                                                     '-classic.cc-bottom.cc-right.cc-color-override-1019874493 > '
-                                                     'div > a').click()
-            timer.sleep(1)
+            self._wait_ready(self.driver)
 
-            # Remove footer
-            self.driver.find_element_by_css_selector('#page-wrapper > div.extension-installer.container > div > div > span > i').click()
-            timer.sleep(1)
+            # Accept cookie disclaimer and remove footer
+            self._click(PUBPEER_COOKIE_BUTTON)
+            self._click(PUBPEER_FOOTER_BUTTON)
 
             self._scroll_bottom()
             self._click_more_btn(pages)
 
             # Parse content
+            from bs4 import BeautifulSoup
+
             soup = BeautifulSoup(self.driver.page_source, "html.parser")
             return soup
 
-        def _soupify(self, articles):
+        @metrics.timed('download_seconds', source='pubpeer', stage='visit')
+        def _soupify(self, articles, mode=None, browsers=None):
             """Creates a strained soup object that filters through
             all tags and only keeps img tags as these are the only
             ones that are of interest. This is a private function
             only to be used in the context of the download function.
 
+            The publications are visited concurrently, either by a pool of
+            browsers or, in 'http' mode, by plain HTTP requests for pages
+            that don't need JavaScript to show their images.
+
             Args:
                 articles (list[str]): List with one article
+                mode (str, optional): Either 'browser' or 'http'. Defaults to None ('browser').
+                browsers (int, optional): How many browsers to use in 'browser' mode. Defaults to None (4).
 
             Returns:
                 list[BeautifulSoup]: List of BeautifulSoup objects
-                that only contain img links.
+                that only contain img links. None for the pages that
+                could not be visited, which does not stop the others.
             """
-            # Get only img tags
-            img_filter = SoupStrainer('img')
-            soups = []
+            if mode is None:
+                mode = 'browser'
+
+            if browsers is None:
+                browsers = 4
 
-            for article in articles:
-                # Get content
-                self.driver.get(article)
-                timer.sleep(1)
-                soups.append(BeautifulSoup(self.driver.page_source, "html.parser", parse_only=img_filter))
+            from bs4 import BeautifulSoup, SoupStrainer
 
-            return soups
+            # Get only img tags
+            img_filter = SoupStrainer('img')
 
-        def download(self, articles):
+            if mode == 'http':
+                pages = self.fetcher.fetch_many([(article, None) for article in articles])
+                return [None if page is None else BeautifulSoup(page, "html.parser", parse_only=img_filter) for page in pages]
+
+            # Start the extra browsers that are needed and lend them out one per publication
+            while len(self.drivers) < min(browsers, max(1, len(articles))):
+                self._start_driver()
+
+            pool = Queue()
+            for driver in self.drivers:
+                pool.put(driver)
+
+            def visit(article):
+                driver = pool.get()
+                try:
+                    # Get content
+                    driver.get(article)
+                    self._wait_ready(driver)
+                    return BeautifulSoup(driver.page_source, "html.parser", parse_only=img_filter)
+                except Exception as e:
+                    print(f'Exception occurred while visiting {article}: {e}')
+                    return None
+                finally:
+                    pool.put(driver)
+
+            with ThreadPool(len(self.drivers)) as tp:
+                return tp.map(visit, articles)
+
+        @metrics.timed('download_seconds', source='pubpeer', stage='download')
+        def download(self, articles, store=None, mode=None, browsers=None, manifest=None):
             """Downloads images from articles given a list of article URLs.
 
+            The images are named after the publication they are in, so that
+            downloading more publications later never overwrites them.
+
             Args:
                 articles (list[str]): List of article URLs.
+                store (ImageStore, optional): If given the images are added to the store and only
+                images that are new to the store are saved, named after their hash. Defaults to None.
+                mode (str, optional): How to visit the publications, see _soupify. Defaults to None.
+                browsers (int, optional): How many browsers to use, see _soupify. Defaults to None.
+                manifest (JobManifest, optional): If given, publications whose images were all downloaded
+                in an earlier run are skipped. Defaults to None.
             """
-            soups = self._soupify(articles)
+            if manifest is not None:
+                articles = manifest.todo('article', articles, 'extract')
+
+            soups = self._soupify(articles, mode, browsers)
+            failed = [article for article, soup in zip(articles, soups) if soup is None]
+            soups = [(article, soup) for article, soup in zip(articles, soups) if soup is not None]
+            articles = [article for article, _ in soups]
             images = []
+            image_articles = []
 
             # Get all img tags, extract image links and save to list
-            for soup in soups:
-                soup_images = soup.findAll('img')
+            for article, soup in soups:
+                soup_images = soup.find_all('img')
 
                 for image in soup_images:
-                    if re.match('https://images.pubpeer.com', image['src']):
+                    if image.get('src', '').startswith(self.image_site):
                         images.append(image)
+                        image_articles.append(article)
 
-            # Create iterable for the starmap function
-            downloads_iterable = [(image['src'], fr'{PUBPEER_IMG_PATH}/Pubpeer_{index}.jpg') for index, image in enumerate(images, start=1)]
+            metrics.count('download_articles_total', len(articles), source='pubpeer', result='ok')
+            metrics.count('download_articles_total', len(failed), source='pubpeer', result='failed')
+            metrics.count('download_images_total', len(images), source='pubpeer')
 
-            # Download the images
-            try:
+            if manifest is not None:
+                manifest.mark_many('article', failed, 'download', 'failed', source='pubpeer')
+                manifest.mark_many('article', articles, 'download', source='pubpeer')
+
+            if store is not None:
                 with ThreadPool(self.threads) as tp:
-                    tp.starmap(urllib.request.urlretrieve, downloads_iterable)
-            except HTTPError:
-                return HTTPError
+                    results = tp.starmap(self._store_image, [(image['src'], article, store) for image, article in zip(images, image_articles)])
+            else:
+                # Create iterable for the starmap function
+                downloads_iterable = []
+                numbers = {}
+                for image, article in zip(images, image_articles):
+                    numbers[article] = numbers.get(article, 0) + 1
+                    downloads_iterable.append((image['src'], fr'{PUBPEER_IMG_PATH}/Pubpeer_{self._publication_id(article)}_{numbers[article]}.jpg'))
+
+                # Download the images
+                results = [(result is not None, result) for result in self.fetcher.fetch_many(downloads_iterable)]
+
+            if manifest is not None:
+                self._record(manifest, articles, image_articles, results)
+
+        def _store_image(self, url, article, store):
+            """Downloads an image into the store and saves it to the image
+            folder if the store has not seen it before.
+
+            Args:
+                url (str): The URL of the image.
+                article (str): The URL of the publication the image is in.
+                store (ImageStore): The store to add the image to.
+
+            Returns:
+                bool: True if the image was downloaded.
+                str: The path of the image in the image folder, or None if it was not saved there.
+            """
+            data = self.fetcher.fetch(url)
+            if data is None:
+                return False, None
+
+            ext = path.splitext(urllib.parse.urlparse(url).path)[1] or '.jpg'
+            blob_hash, _, new = store.put(data, ext, 'pubpeer', article, url=url)
+
+            if new:
+                return True, store.export(blob_hash, PUBPEER_IMG_PATH)
+
+            return True, None
+
+        @staticmethod
+        def _record(manifest, articles, image_articles, results):
+            """Records the downloaded images in the manifest. A publication is
+            only done once all of its images have been downloaded.
+
+            Args:
+                manifest (JobManifest): The manifest.
+                articles (list[str]): The publications that were visited.
+                image_articles (list[str]): The publication of every image.
+                results (list[tuple(bool, str)]): Whether every image was downloaded, and where it was
+                saved in the image folder (None if it was not).
+            """
+            failed = set()
+            counts = {}
+
+            for article, (downloaded, image_path) in zip(image_articles, results):
+                if not downloaded:
+                    failed.add(article)
+                elif image_path is not None:
+                    manifest.mark('image', os.path.basename(image_path), 'extract', source='pubpeer', article=article)
+                    counts[article] = counts.get(article, 0) + 1
+
+            manifest.mark_many('article', [article for article in articles if article in failed], 'extract', 'failed', source='pubpeer')
+            manifest.mark_many('article', [(article, counts.get(article, 0)) for article in articles if article not in failed],
+                               'extract', source='pubpeer')
+
+        @staticmethod
+        def _publication_id(article):
+            """Returns the last part of a publication URL, e.g. the hash PubPeer gives every publication."""
+            return urllib.parse.urlparse(article).path.rstrip('/').split('/')[-1]
 
         def _click_more_btn(self, pages=None):
             """Clicks the "Load more" button on Pubpeer's site.
@@ -376,23 +951,66 @@ class DownloadManager():
                 print('n can not be 0 or below.')
                 return
 
+            from selenium.webdriver.support.ui import WebDriverWait
+            from selenium.common.exceptions import TimeoutException
+
             for page_num in range(0, pages):
+                results = len(self.driver.find_elements_by_css_selector(PUBPEER_PUBLICATION_LINKS))
                 self._scroll_bottom()
 
-                # Wait a little bit to allow the site to load
-                timer.sleep(1)
+                # Click "load more" button as soon as it can be clicked
+                if not self._click(PUBPEER_MORE_BUTTON):
+                    return
 
-                # For some reason I need to scroll to the bottom twice
-                # because otherwise it won't actually scroll to the bottom
-                # in all iterations after the first.
-                self._scroll_bottom()
+                # Wait until the new results have been added to the page
+                try:
+                    WebDriverWait(self.driver, self.timeout).until(
+                        lambda driver: len(driver.find_elements_by_css_selector(PUBPEER_PUBLICATION_LINKS)) > results)
+                except TimeoutException:
+                    print('No more results were loaded.')
+                    return
 
-                # Click "load more" button
-                self.driver.find_element_by_css_selector("#page-wrapper > div.wrapper.wrapper-content > div > div > "
-                                                         "div.col-md-12.publication-list > div > div.recent-comments > "
-                                                         "div.publication-list > div.text-center > button").click()
                 print(f'Clicked "Load more" button. Location is now page {page_num+1}.')
 
+        def _wait_ready(self, driver):
+            """Waits until the browser has finished loading the page.
+
+            Args:
+                driver (webdriver.Chrome): The browser.
+            """
+            from selenium.webdriver.support.ui import WebDriverWait
+            from selenium.common.exceptions import TimeoutException
+
+            try:
+                WebDriverWait(driver, self.timeout).until(
+                    lambda driver: driver.execute_script('return document.readyState') == 'complete')
+            except TimeoutException:
+                print(f'The page {driver.current_url} did not finish loading.')
+
+        def _click(self, selector):
+            """Clicks an element as soon as it can be clicked.
+
+            Args:
+                selector (str): The CSS selector of the element.
+
+            Returns:
+                bool: True if the element was clicked.
+            """
+            from selenium.webdriver.common.by import By
+            from selenium.webdriver.support import expected_conditions
+            from selenium.webdriver.support.ui import WebDriverWait
+            from selenium.common.exceptions import TimeoutException
+
+            try:
+                element = WebDriverWait(self.driver, self.timeout).until(
+                    expected_conditions.element_to_be_clickable((By.CSS_SELECTOR, selector)))
+            except TimeoutException:
+                print(f'Could not find the element \'{selector}\'.')
+                return False
+
+            element.click()
+            return True
+
         def _scroll_bottom(self):
             """Scrolls to the bottom of the page using a simple javascript function."""
             self.driver.execute_script("window.scrollTo(0, document.body.scrollHeight);")
@@ -412,7 +1030,7 @@ class DownloadManager():
 
             for link in soup_links:
                 if link[0:13] == '/publications':
-                    articles.append(f'https://pubpeer.com{link}')
+                    articles.append(f'{self.site}{link}')
 
             return articles
 
@@ -424,3 +1042,107 @@ class DownloadManager():
             """
             for index, paper in enumerate(articles, start=1):
                 print(f'Paper {index}: {paper}')
+
+
+def _extract_pdf(pdf, article_id, path=None, min_size=None, store_root=None):
+    """Extracts the images of one PDF. This lives outside of the classes so
+    that it can be sent to the processes of extract_images_parallel.
+
+    Args:
+        pdf (bytes or str): The PDF, as bytes or as a path.
+        article_id (str): The ID of the article.
+        path (str, optional): Where to save the images. Defaults to None.
+        min_size (int, optional): Images narrower or lower than this are skipped. Defaults to None (64).
+        store_root (str, optional): If given the images are added to the ImageStore at this root
+        instead of being saved. Defaults to None.
+
+    Returns:
+        list[tuple(str or tuple(str, bool), str, int, int)]: The (image path, article ID, page, xref) of
+        every image, or its (hash, whether it was new) instead of the path if it was added to the store.
+    """
+    if path is None:
+        path = PUBMED_IMG_PATH
+
+    if min_size is None:
+        min_size = 64
+
+    # Every process opens a store once and keeps it for the next PDFs
+    store = None
+    if store_root is not None:
+        if store_root not in _stores:
+            _stores[store_root] = ImageStore(store_root)
+        store = _stores[store_root]
+
+    images = []
+    seen = set()
+
+    try:
+        if isinstance(pdf, bytes):
+            document = fitz.open(stream=pdf, filetype='pdf')
+        else:
+            document = fitz.open(filename=pdf, filetype='pdf')
+    except Exception as e:
+        print(f'Could not open the PDF of {article_id}: {e}')
+        return images
+
+    with document:
+        for page_index in range(document.pageCount):
+            for xref, smask, width, height, *_ in document.get_page_images(page_index):
+                # The size is known from the PDF itself, so small images are never decoded
+                if xref in seen or width < min_size or height < min_size:
+                    continue
+                seen.add(xref)
+
+                try:
+                    data, ext = _image_stream(document, xref, smask)
+                except Exception as e:
+                    print(f'Could not extract image {xref} of {article_id}: {e}')
+                    continue
+
+                # Only the hash is sent back, so no more than one image is held at a time
+                if store is not None:
+                    blob_hash, _, new = store.put(data, ext, 'pubmed', article_id, page_index + 1, xref)
+                    images.append(((blob_hash, new), article_id, page_index + 1, xref))
+                    continue
+
+                image_path = fr'{path}\Pubmed_{article_id}_{len(images) + 1}.{ext}'
+                with open(image_path, 'wb') as file:
+                    file.write(data)
+                images.append((image_path, article_id, page_index + 1, xref))
+
+    return images
+
+
+def _extract_pdf_star(args):
+    """Unpacks the arguments for _extract_pdf, since imap only passes one."""
+    return _extract_pdf(*args)
+
+
+def _image_stream(document, xref, smask):
+    """Returns the encoded bytes of an embedded image. JPEG and PNG streams
+    are returned as they are stored in the PDF; anything else, and images
+    with a transparency mask, are converted to PNG.
+
+    Args:
+        document (fitz.Document): The PDF.
+        xref (int): The xref of the image.
+        smask (int): The xref of the transparency mask of the image, 0 if it has none.
+
+    Returns:
+        bytes: The encoded image.
+        str: The file extension of the image.
+    """
+    if smask == 0:
+        image = document.extract_image(xref)
+        if image and image['ext'] in RAW_IMAGE_FORMATS:
+            return image['image'], 'jpg' if image['ext'] == 'jpeg' else image['ext']
+
+    pixmap = fitz.Pixmap(document, xref)
+    if smask:
+        pixmap = fitz.Pixmap(pixmap, fitz.Pixmap(document, smask))
+
+    # PNG can't hold CMYK
+    if pixmap.n - pixmap.alpha > 3:
+        pixmap = fitz.Pixmap(fitz.csRGB, pixmap)
+
+    return pixmap.tobytes('png'), 'png'
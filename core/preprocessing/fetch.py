@@ -0,0 +1,292 @@
+# System modules
+import os
+import time
+import random
+import http.client
+from queue import LifoQueue, Empty
+from threading import BoundedSemaphore, Lock
+from urllib.parse import urljoin, urlsplit
+from multiprocessing.pool import ThreadPool
+
+# Custom
+from ForgeryDetector.core import metrics
+
+# Other constants
+HEADER = {'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64; rv:27.0) Gecko/20100101 Firefox/27.0'}
+
+# NCBI allows 3 requests per second without an API key
+HOST_RATES = {'www.ncbi.nlm.nih.gov': 3.0, 'eutils.ncbi.nlm.nih.gov': 3.0}
+
+# Status codes that are worth trying again
+RETRY_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+
+
+class TokenBucket():
+    """Allows at most `rate` requests per second on average, with bursts of
+    at most `capacity` requests."""
+
+    def __init__(self, rate, capacity=None):
+        if capacity is None:
+            capacity = max(1.0, rate)
+
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = Lock()
+
+    def acquire(self):
+        """Takes a token, waiting until one is available."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait = (1 - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+
+class HttpFetcher():
+    """Downloads files over pooled keep-alive connections. Every host gets
+    its own connection pool, a limit on concurrent requests and a token
+    bucket for its request rate. Failed requests are retried with
+    exponential backoff and interrupted downloads resume where they
+    stopped.
+    """
+
+    def __init__(self, threads=None, per_host=None, rates=None, default_rate=None,
+                 retries=None, backoff=None, timeout=None, headers=None):
+        if threads is None:
+            self.threads = 8
+        else:
+            self.threads = threads
+
+        if per_host is None:
+            self.per_host = 4
+        else:
+            self.per_host = per_host
+
+        if rates is None:
+            self.rates = dict(HOST_RATES)
+        else:
+            self.rates = rates
+
+        # Requests per second for hosts without their own rate, None means unlimited
+        self.default_rate = default_rate
+
+        if retries is None:
+            self.retries = 4
+        else:
+            self.retries = retries
+
+        if backoff is None:
+            self.backoff = 0.5
+        else:
+            self.backoff = backoff
+
+        if timeout is None:
+            self.timeout = 30
+        else:
+            self.timeout = timeout
+
+        if headers is None:
+            self.headers = dict(HEADER)
+        else:
+            self.headers = headers
+
+        self.lock = Lock()
+        self.pools = {}
+        self.limits = {}
+        self.buckets = {}
+
+    def fetch(self, url, dest=None):
+        """Downloads a URL. If a destination is given the body is streamed
+        to '<dest>.part' and renamed once it is complete. A '.part' file
+        left behind by an earlier attempt is resumed with a Range request.
+
+        Args:
+            url (str): The URL to download.
+            dest (str, optional): Where to save the file. Defaults to None, which returns the body.
+
+        Returns:
+            bytes or str: The body, or the destination path. None if every attempt failed.
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                return self._fetch(url, dest)
+            except Exception as e:
+                host = urlsplit(url).hostname
+                if attempt == self.retries:
+                    print(f'Exception occurred while fetching {url}: {e}')
+                    metrics.count('http_failures_total', host=host)
+                    return None
+
+                metrics.count('http_retries_total', host=host)
+
+                # Wait longer after every failure, with some jitter so retries don't line up
+                delay = getattr(e, 'retry_after', None) or self.backoff * 2 ** attempt
+                time.sleep(delay * (1 + random.random() / 2))
+
+    def fetch_many(self, downloads):
+        """Downloads several URLs concurrently. A URL that fails does not
+        stop the others.
+
+        Args:
+            downloads (list[tuple(str, str)]): The (url, destination) pairs. The destination can be None.
+
+        Returns:
+            list: The result of fetch for every download, in the same order.
+        """
+        downloads = list(downloads)
+
+        if not downloads:
+            return []
+
+        with ThreadPool(min(self.threads, len(downloads))) as tp:
+            return tp.starmap(self.fetch, downloads)
+
+    def close(self):
+        """Closes every pooled connection."""
+        with self.lock:
+            for pool in self.pools.values():
+                while True:
+                    try:
+                        pool.get_nowait().close()
+                    except Empty:
+                        break
+
+    def _fetch(self, url, dest, redirects=None):
+        """Makes one attempt at downloading a URL, following redirects.
+        See fetch for the arguments."""
+        if redirects is None:
+            redirects = 5
+
+        for _ in range(redirects + 1):
+            result, location = self._request(url, dest)
+            if location is None:
+                return result
+            url = location
+
+        raise IOError(f'Too many redirects for {url}')
+
+    def _request(self, url, dest):
+        """Sends a single request for a URL.
+
+        Args:
+            url (str): The URL to download.
+            dest (str): Where to save the file, or None to return the body.
+
+        Returns:
+            bytes or str: The body or the destination path, None if the server refused.
+            str: The URL to go to next if the server redirected, otherwise None.
+        """
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        target = parts.path or '/'
+        if parts.query:
+            target += f'?{parts.query}'
+
+        headers = dict(self.headers)
+        offset = 0
+        if dest is not None and os.path.exists(f'{dest}.part'):
+            offset = os.path.getsize(f'{dest}.part')
+            headers['Range'] = f'bytes={offset}-'
+
+        limit, bucket = self._host(parts.hostname)
+        with limit:
+            if bucket is not None:
+                with metrics.timer('http_rate_limit_seconds', host=parts.hostname):
+                    bucket.acquire()
+
+            connection = self._connection(key)
+            try:
+                with metrics.timer('http_request_seconds', host=parts.hostname):
+                    connection.request('GET', target, headers=headers)
+                    response = connection.getresponse()
+                metrics.count('http_requests_total', host=parts.hostname, status=response.status)
+
+                if response.status in (301, 302, 303, 307, 308) and response.getheader('Location'):
+                    response.read()
+                    self._release(key, connection, response)
+                    connection = None
+                    return None, urljoin(url, response.getheader('Location'))
+
+                if response.status in RETRY_STATUSES:
+                    response.read()
+                    error = IOError(f'HTTP {response.status}')
+                    retry_after = response.getheader('Retry-After')
+                    error.retry_after = float(retry_after) if retry_after and retry_after.isdigit() else None
+                    raise error
+
+                if response.status == 416 and offset:
+                    # The partial file is already complete
+                    response.read()
+                    result = self._finish(dest)
+                elif response.status not in (200, 206):
+                    response.read()
+                    print(f'HTTP {response.status} for {url}')
+                    self._release(key, connection, response)
+                    connection = None
+                    return None, None
+                elif dest is None:
+                    result = response.read()
+                    metrics.count('http_bytes_total', len(result), host=parts.hostname)
+                else:
+                    # A 200 response means the server ignored the Range header, so start over
+                    mode = 'ab' if response.status == 206 else 'wb'
+                    with open(f'{dest}.part', mode) as file:
+                        for block in iter(lambda: response.read(1 << 16), b''):
+                            file.write(block)
+                            metrics.count('http_bytes_total', len(block), host=parts.hostname)
+                    result = self._finish(dest)
+
+                self._release(key, connection, response)
+                connection = None
+                return result, None
+            finally:
+                # A connection in an unknown state is never reused
+                if connection is not None:
+                    connection.close()
+
+    @staticmethod
+    def _finish(dest):
+        """Renames a completed '.part' file to its destination."""
+        os.replace(f'{dest}.part', dest)
+        return dest
+
+    def _host(self, hostname):
+        """Returns the concurrency limit and the token bucket of a host."""
+        with self.lock:
+            if hostname not in self.limits:
+                self.limits[hostname] = BoundedSemaphore(self.per_host)
+
+                rate = self.rates.get(hostname, self.default_rate)
+                self.buckets[hostname] = None if rate is None else TokenBucket(rate)
+
+            return self.limits[hostname], self.buckets[hostname]
+
+    def _connection(self, key):
+        """Takes a connection from the pool of a host, or opens a new one."""
+        with self.lock:
+            pool = self.pools.setdefault(key, LifoQueue())
+
+        try:
+            return pool.get_nowait()
+        except Empty:
+            scheme, netloc = key
+            if scheme == 'https':
+                return http.client.HTTPSConnection(netloc, timeout=self.timeout)
+            return http.client.HTTPConnection(netloc, timeout=self.timeout)
+
+    def _release(self, key, connection, response):
+        """Puts a connection back in its pool if the server keeps it open."""
+        if response.will_close:
+            connection.close()
+        else:
+            self.pools[key].put(connection)
@@ -0,0 +1,146 @@
+# External modules
+import cv2
+import numpy as np
+
+# Custom
+from ForgeryDetector.core import metrics
+from ForgeryDetector.core.preprocessing.utils import ImageUtilities
+
+# The amount of samples every lane profile is resampled to
+PROFILE_LENGTH = 64
+
+
+class LaneProfiler():
+    """Splits blot strips and chunks into their lanes and turns every lane
+    into a 1-D intensity profile along it, i.e. where its bands are and how
+    strong they are. Profiles are a few dozen numbers, so thousands of lanes
+    can be compared with ImageMatcher.profile_similarity before any 2-D
+    matching is done.
+
+    Lanes are expected to run from top to bottom and to be separated by
+    columns without bands, as in Test_data/Strips/strip_1.png.
+    """
+
+    def __init__(self, length=None, threshold=None, min_width=None, min_gap=None):
+        if length is None:
+            self.length = PROFILE_LENGTH
+        else:
+            self.length = length
+
+        # The fraction of the contrast range above which a column belongs to a lane
+        if threshold is None:
+            self.threshold = 0.1
+        else:
+            self.threshold = threshold
+
+        if min_width is None:
+            self.min_width = 5
+        else:
+            self.min_width = min_width
+
+        if min_gap is None:
+            self.min_gap = 3
+        else:
+            self.min_gap = min_gap
+
+    def segment(self, image):
+        """Finds the lanes of a strip or chunk.
+
+        Every column is scored by the contrast between its dark and light
+        pixels, which stays low in the gaps between lanes whatever the
+        brightness of the background is.
+
+        Args:
+            image (numpy.ndarray): The strip or chunk.
+
+        Returns:
+            list[tuple(int, int, int, int)]: The (x, y, w, h) box of every lane, from left to right.
+            A chunk without gaps is a single lane.
+        """
+        gray = ImageUtilities.to_gray(image)
+        height, width = gray.shape
+
+        contrast = (np.percentile(gray, 90, axis=0) - np.percentile(gray, 10, axis=0)).astype(np.float32)
+        smoothing = max(3, width // 100)
+        contrast = cv2.blur(contrast[None], (smoothing, 1))[0]
+
+        baseline = np.percentile(contrast, 5)
+        if contrast.max() - baseline < 1:
+            return [(0, 0, width, height)]
+
+        inside = contrast > baseline + self.threshold * (contrast.max() - baseline)
+
+        # The starts and ends of the runs of lane columns
+        edges = np.flatnonzero(np.diff(np.concatenate([[0], inside.astype(np.int8), [0]])))
+        runs = [[int(start), int(end)] for start, end in zip(edges[::2], edges[1::2])]
+
+        # Faint stretches within a lane can split it, short gaps are closed again
+        merged = []
+        for start, end in runs:
+            if merged and start - merged[-1][1] < self.min_gap:
+                merged[-1][1] = end
+            else:
+                merged.append([start, end])
+
+        lanes = [(start, 0, end - start, height) for start, end in merged if end - start >= self.min_width]
+        if not lanes:
+            return [(0, 0, width, height)]
+
+        return lanes
+
+    def profiles(self, image, lanes=None):
+        """Returns the profile of every lane of a strip or chunk: the mean
+        darkness of every row of the middle half of the lane, resampled to
+        the profile length.
+
+        Args:
+            image (numpy.ndarray): The strip or chunk.
+            lanes (list[tuple(int, int, int, int)], optional): The boxes of the lanes.
+            Defaults to None, which uses segment.
+
+        Returns:
+            numpy.ndarray: The (lanes, length) float32 profiles.
+        """
+        gray = ImageUtilities.to_gray(image)
+
+        if lanes is None:
+            lanes = self.segment(gray)
+
+        profiles = np.empty((len(lanes), self.length), dtype=np.float32)
+        samples = np.linspace(0, 1, self.length)
+
+        for index, (x, y, w, h) in enumerate(lanes):
+            # The edges of a lane are often cut off or mixed with the gap next to it
+            middle = gray[y:y + h, x + w // 4:x + w - w // 4]
+            darkness = 255 - middle.mean(axis=1)
+            profiles[index] = np.interp(samples, np.linspace(0, 1, len(darkness)), darkness)
+
+        return profiles
+
+    @metrics.timed('lane_profiler_seconds', function='profile_chunks')
+    def profile_chunks(self, chunks):
+        """Segments and profiles every chunk.
+
+        Args:
+            chunks (list[numpy.ndarray] or ChunkArchive): The chunks, e.g. the crops of ImageCropper.
+
+        Returns:
+            tuple(numpy.ndarray, numpy.ndarray, numpy.ndarray): The (N, length) profiles of all
+            lanes, the index of the chunk every lane belongs to and the (N, 4) boxes of the lanes.
+        """
+        profiles, owners, boxes = [], [], []
+
+        for index, chunk in enumerate(chunks):
+            gray = ImageUtilities.to_gray(chunk)
+            lanes = self.segment(gray)
+
+            profiles.append(self.profiles(gray, lanes))
+            owners.extend([index] * len(lanes))
+            boxes.extend(lanes)
+
+        metrics.count('lane_profiles_total', len(boxes))
+
+        if not profiles:
+            return np.empty((0, self.length), dtype=np.float32), np.empty(0, dtype=int), np.empty((0, 4), dtype=int)
+
+        return np.concatenate(profiles), np.array(owners), np.array(boxes, dtype=int).reshape(-1, 4)
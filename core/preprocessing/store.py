@@ -0,0 +1,183 @@
+# System modules
+import os
+import time
+import sqlite3
+import hashlib
+from shutil import copyfile
+from threading import Lock
+
+# The default location of the store
+IMAGE_STORE_PATH = r'Data\Blot data\Store'
+
+
+class ImageStore():
+    """Stores harvested images by the hash of their content. An image that
+    is already in the store is not written again; only a manifest row that
+    links it to the new article is added. The manifest maps every source,
+    article, page and xref (or URL) to the blob it produced.
+
+    Several processes can open the same store, e.g. the extraction
+    processes of PubMed.extract_images_parallel. Only one of them sees an
+    image as new.
+    """
+
+    def __init__(self, root=None):
+        if root is None:
+            root = IMAGE_STORE_PATH
+
+        self.root = root
+        self.blob_path = os.path.join(root, 'blobs')
+        os.makedirs(self.blob_path, exist_ok=True)
+
+        # The downloaders write to the store from several threads
+        self.lock = Lock()
+        self.connection = sqlite3.connect(os.path.join(root, 'manifest.db'), check_same_thread=False)
+
+        with self.lock, self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS blobs '
+                                    '(hash TEXT PRIMARY KEY, ext TEXT, size INTEGER, added REAL)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS sources '
+                                    '(hash TEXT, source TEXT, article TEXT, page INTEGER, xref INTEGER, url TEXT)')
+
+            # NULLs never collide in a UNIQUE constraint, so the missing fields are compared as empty
+            self.connection.execute('CREATE UNIQUE INDEX IF NOT EXISTS sources_unique ON sources '
+                                    "(hash, source, IFNULL(article, ''), IFNULL(page, -1), IFNULL(xref, -1), IFNULL(url, ''))")
+            self.connection.execute('CREATE INDEX IF NOT EXISTS sources_hash ON sources (hash)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS sources_article ON sources (source, article)')
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute('SELECT COUNT(*) FROM blobs').fetchone()[0]
+
+    def __contains__(self, blob_hash):
+        with self.lock:
+            return self.connection.execute('SELECT 1 FROM blobs WHERE hash = ?', (blob_hash,)).fetchone() is not None
+
+    def close(self):
+        """Closes the connection to the manifest."""
+        self.connection.close()
+
+    def put(self, data, ext, source, article=None, page=None, xref=None, url=None):
+        """Adds an image to the store.
+
+        Args:
+            data (bytes): The encoded image.
+            ext (str): The file extension of the image, e.g. 'png'.
+            source (str): Where the image comes from, e.g. 'pubmed' or 'pubpeer'.
+            article (str, optional): The ID or URL of the article. Defaults to None.
+            page (int, optional): The page of the PDF the image is on. Defaults to None.
+            xref (int, optional): The xref of the image within the PDF. Defaults to None.
+            url (str, optional): The URL the image was downloaded from. Defaults to None.
+
+        Returns:
+            str: The hash of the image.
+            str: The path of the blob.
+            bool: True if the image was not in the store yet.
+        """
+        ext = ext.lstrip('.').lower()
+        blob_hash = hashlib.sha256(data).hexdigest()
+        blob_path = self.path(blob_hash, ext)
+
+        with self.lock:
+            new = self.connection.execute('SELECT 1 FROM blobs WHERE hash = ?', (blob_hash,)).fetchone() is None
+
+            if new:
+                os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+
+                # Write to a temporary file first so that a crash never leaves half a blob behind,
+                # named after the process since another one may be writing the same blob
+                part_path = f'{blob_path}.{os.getpid()}.part'
+                with open(part_path, 'wb') as file:
+                    file.write(data)
+                os.replace(part_path, blob_path)
+
+            with self.connection:
+                if new:
+                    # Another process may have added the image in the meantime, then it is not new here
+                    cursor = self.connection.execute('INSERT OR IGNORE INTO blobs VALUES (?, ?, ?, ?)',
+                                                     (blob_hash, ext, len(data), time.time()))
+                    new = cursor.rowcount == 1
+                self.connection.execute('INSERT OR IGNORE INTO sources VALUES (?, ?, ?, ?, ?, ?)',
+                                        (blob_hash, source, article, page, xref, url))
+
+        return blob_hash, blob_path, new
+
+    def put_file(self, file_path, source, article=None, page=None, xref=None, url=None):
+        """Adds an image file to the store. See put for the arguments."""
+        with open(file_path, 'rb') as file:
+            data = file.read()
+
+        return self.put(data, os.path.splitext(file_path)[1], source, article, page, xref, url)
+
+    def path(self, blob_hash, ext=None):
+        """Returns the path of a blob. The blobs are spread over folders named
+        after the first two characters of their hash to keep folders small.
+
+        Args:
+            blob_hash (str): The hash of the blob.
+            ext (str, optional): The extension of the blob. Defaults to None, which looks it up.
+
+        Returns:
+            str: The path of the blob.
+        """
+        if ext is None:
+            with self.lock:
+                row = self.connection.execute('SELECT ext FROM blobs WHERE hash = ?', (blob_hash,)).fetchone()
+            if row is None:
+                return None
+            ext = row[0]
+
+        return os.path.join(self.blob_path, blob_hash[:2], f'{blob_hash}.{ext}')
+
+    def sources(self, blob_hash):
+        """Returns every place an image has been found.
+
+        Args:
+            blob_hash (str): The hash of the image.
+
+        Returns:
+            list[tuple(str, str, int, int, str)]: The (source, article, page, xref, url) of every occurrence.
+        """
+        with self.lock:
+            return self.connection.execute('SELECT source, article, page, xref, url FROM sources WHERE hash = ?',
+                                           (blob_hash,)).fetchall()
+
+    def blobs(self, source=None, article=None):
+        """Returns the hashes of the images in the store.
+
+        Args:
+            source (str, optional): Only images from this source. Defaults to None.
+            article (str, optional): Only images from this article. Defaults to None.
+
+        Returns:
+            list[str]: The hashes of the images.
+        """
+        query = 'SELECT DISTINCT hash FROM sources WHERE 1 = 1'
+        parameters = []
+
+        if source is not None:
+            query += ' AND source = ?'
+            parameters.append(source)
+
+        if article is not None:
+            query += ' AND article = ?'
+            parameters.append(article)
+
+        with self.lock:
+            return [row[0] for row in self.connection.execute(query, parameters)]
+
+    def export(self, blob_hash, folder):
+        """Copies a blob into a folder, named after its hash. This is how new
+        images are handed to the next stage (e.g. the classifier's folder).
+
+        Args:
+            blob_hash (str): The hash of the blob.
+            folder (str): The folder to copy the blob into.
+
+        Returns:
+            str: The path of the copy.
+        """
+        blob_path = self.path(blob_hash)
+        export_path = os.path.join(folder, os.path.basename(blob_path))
+        copyfile(blob_path, export_path)
+        return export_path
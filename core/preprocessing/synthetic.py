@@ -0,0 +1,271 @@
+# System modules
+import os
+import json
+from collections import namedtuple
+
+# External modules
+import cv2
+import numpy as np
+
+# Custom
+from ForgeryDetector.core.lazy import lazy_import
+
+fitz = lazy_import('fitz')
+
+# A region that was copied from the source box (x, y, w, h) to the target box, and how it was changed
+SyntheticCopy = namedtuple('SyntheticCopy', ['source', 'target', 'transform'])
+
+# A generated figure with the boxes of its panels and the copies that were made in it
+SyntheticFigure = namedtuple('SyntheticFigure', ['image', 'panels', 'copies'])
+
+# The ways a copied region can be changed before it is pasted
+TRANSFORMS = ('paste', 'flip', 'scale')
+
+
+class BlotGenerator():
+    """Generates western blot figures with known duplicated regions, so the
+    cropper and the matchers can be measured without downloading anything.
+    Every figure consists of bright blot panels on a dark background, which
+    is what ImageCropper expects, and regions are copied between (or within)
+    the panels as they are, mirrored, or rescaled.
+    """
+
+    def __init__(self, seed=None):
+        self.random = np.random.default_rng(seed)
+
+    def blot(self, width, height, lanes=None):
+        """Draws a single blot: dark bands in evenly spaced lanes on a light
+        background with some noise.
+
+        Args:
+            width (int): The width of the blot.
+            height (int): The height of the blot.
+            lanes (int, optional): The amount of lanes. Defaults to None (a random amount from 4 to 12).
+
+        Returns:
+            numpy.ndarray: The (height, width) grayscale blot.
+        """
+        if lanes is None:
+            lanes = int(self.random.integers(4, 13))
+
+        x = np.arange(width, dtype=np.float32)
+        y = np.arange(height, dtype=np.float32)[:, None]
+        darkness = np.zeros((height, width), dtype=np.float32)
+        lane_width = width / lanes
+
+        for lane in range(lanes):
+            centre = (lane + 0.5) * lane_width
+            half = lane_width * self.random.uniform(0.3, 0.42)
+
+            # Bands have flat tops horizontally and soft edges vertically
+            across = 0.5 - 0.5 * np.tanh((np.abs(x - centre) - half) / max(2.0, half / 3))
+
+            for _ in range(int(self.random.integers(1, 4))):
+                row = self.random.uniform(0.15, 0.85) * height
+                thickness = self.random.uniform(0.03, 0.08) * height + 1
+                along = np.exp(-0.5 * ((y - row) / thickness) ** 2)
+                darkness += self.random.uniform(60, 190) * along * across
+
+        background = self.random.uniform(200, 240)
+        noise = self.random.normal(0, 4, (height, width))
+        return np.clip(background - darkness + noise, 0, 255).astype(np.uint8)
+
+    def negative(self, width, height):
+        """Draws an image that is not a blot: smooth color gradients with a
+        few filled shapes, like a photo or a chart.
+
+        Args:
+            width (int): The width of the image.
+            height (int): The height of the image.
+
+        Returns:
+            numpy.ndarray: The (height, width, 3) color image.
+        """
+        corners = self.random.uniform(0, 255, (2, 2, 3)).astype(np.float32)
+        image = cv2.resize(corners, (width, height), interpolation=cv2.INTER_LINEAR)
+
+        for _ in range(int(self.random.integers(3, 9))):
+            centre = (int(self.random.integers(0, width)), int(self.random.integers(0, height)))
+            radius = int(self.random.integers(4, max(5, min(width, height) // 4)))
+            cv2.circle(image, centre, radius, self.random.uniform(0, 255, 3).tolist(), -1)
+
+        return np.clip(image + self.random.normal(0, 6, image.shape), 0, 255).astype(np.uint8)
+
+    def figure(self, width=None, height=None, panels=None, copies=None, transforms=None, margin=None):
+        """Draws a figure of blot panels stacked from top to bottom and copies
+        regions around in it.
+
+        Args:
+            width (int, optional): The width of the figure. Defaults to None (512).
+            height (int, optional): The height of the figure. Defaults to None (the width).
+            panels (int, optional): The amount of panels. Defaults to None (3).
+            copies (int, optional): The amount of copied regions. Defaults to None (1).
+            transforms (list[str], optional): The transforms to choose from for each copy,
+            see TRANSFORMS. Defaults to None (all of them).
+            margin (int, optional): The dark space around the panels. Defaults to None (8).
+
+        Returns:
+            SyntheticFigure: The (height, width, 3) figure, the (x, y, w, h) box of every
+            panel and the copies.
+        """
+        if width is None:
+            width = 512
+
+        if height is None:
+            height = width
+
+        if panels is None:
+            panels = 3
+
+        if copies is None:
+            copies = 1
+
+        if transforms is None:
+            transforms = TRANSFORMS
+
+        if margin is None:
+            margin = 8
+
+        image = np.zeros((height, width), dtype=np.uint8)
+        panel_height = (height - margin * (panels + 1)) // panels
+        boxes = []
+
+        for index in range(panels):
+            box = (margin, margin + index * (panel_height + margin), width - 2 * margin, panel_height)
+            image[box[1]:box[1] + box[3], box[0]:box[0] + box[2]] = self.blot(box[2], box[3])
+            boxes.append(box)
+
+        made = []
+        for _ in range(copies):
+            copy = self._copy(image, boxes, transforms[int(self.random.integers(len(transforms)))], made)
+            if copy is not None:
+                made.append(copy)
+
+        return SyntheticFigure(cv2.cvtColor(image, cv2.COLOR_GRAY2BGR), boxes, made)
+
+    def corpus(self, folder, count, negatives=None, truth_path=None, **figure):
+        """Writes figures to a folder together with a JSON file that
+        describes their panels and copies.
+
+        Args:
+            folder (str): The folder to write to.
+            count (int): The amount of figures.
+            negatives (int, optional): The amount of images that are not blots, which
+            are named 'other_<n>.png'. Defaults to None (0).
+            truth_path (str, optional): Where to write the JSON file. Defaults to None ('truth.json' in the folder).
+            **figure: The arguments of figure.
+
+        Returns:
+            dict[str, SyntheticFigure]: The figure of every written blot, by path.
+        """
+        if negatives is None:
+            negatives = 0
+
+        if truth_path is None:
+            truth_path = os.path.join(folder, 'truth.json')
+
+        os.makedirs(folder, exist_ok=True)
+        figures = {}
+
+        for index in range(count):
+            image_path = os.path.join(folder, f'blot_{index}.png')
+            figures[image_path] = self.figure(**figure)
+            cv2.imwrite(image_path, figures[image_path].image)
+
+        for index in range(negatives):
+            width = figure.get('width') or 512
+            cv2.imwrite(os.path.join(folder, f'other_{index}.png'), self.negative(width, figure.get('height') or width))
+
+        truth = {os.path.basename(image_path): {'panels': synthetic.panels, 'copies': [copy._asdict() for copy in synthetic.copies]}
+                 for image_path, synthetic in figures.items()}
+        with open(truth_path, 'w') as file:
+            json.dump(truth, file, indent=2)
+
+        return figures
+
+    @staticmethod
+    def pdf(images, pdf_path=None):
+        """Puts images in a PDF, one per page, the way figures are embedded
+        in articles.
+
+        Args:
+            images (list[numpy.ndarray]): The images.
+            pdf_path (str, optional): Where to save the PDF. Defaults to None, which returns it as bytes.
+
+        Returns:
+            bytes or str: The PDF, or its path.
+        """
+        document = fitz.open()
+
+        for image in images:
+            height, width = image.shape[:2]
+            page = document.new_page(width=width, height=height)
+            page.insert_image(fitz.Rect(0, 0, width, height), stream=cv2.imencode('.png', image)[1].tobytes())
+
+        if pdf_path is None:
+            data = document.write()
+            document.close()
+            return data
+
+        document.save(pdf_path)
+        document.close()
+        return pdf_path
+
+    def _copy(self, image, boxes, transform, made, attempts=None):
+        """Copies a random region of a panel to a free spot in a panel.
+
+        Args:
+            image (numpy.ndarray): The grayscale figure, which is changed in place.
+            boxes (list[tuple(int, int, int, int)]): The boxes of the panels.
+            transform (str): How to change the region, see TRANSFORMS.
+            made (list[SyntheticCopy]): The copies so far, which are not overwritten.
+            attempts (int, optional): How often to look for a free spot. Defaults to None (50).
+
+        Returns:
+            SyntheticCopy: The copy, or None if there was no room for it.
+        """
+        if attempts is None:
+            attempts = 50
+
+        taken = [box for copy in made for box in (copy.source, copy.target)]
+
+        for _ in range(attempts):
+            panel = boxes[int(self.random.integers(len(boxes)))]
+            w = int(self.random.integers(max(8, panel[2] // 8), max(9, panel[2] // 3)))
+            h = int(self.random.integers(max(8, panel[3] // 4), max(9, panel[3] * 2 // 3)))
+            source = self._place(panel, w, h)
+
+            region = image[source[1]:source[1] + h, source[0]:source[0] + w]
+            if transform == 'flip':
+                region = cv2.flip(region, 1)
+            elif transform == 'scale':
+                factor = self.random.choice([-1, 1]) * self.random.uniform(0.1, 0.25) + 1
+                region = cv2.resize(region, (max(4, int(round(w * factor))), max(4, int(round(h * factor)))),
+                                    interpolation=cv2.INTER_LINEAR)
+
+            target_panel = boxes[int(self.random.integers(len(boxes)))]
+            if region.shape[1] > target_panel[2] or region.shape[0] > target_panel[3]:
+                continue
+
+            target = self._place(target_panel, region.shape[1], region.shape[0])
+            if any(self._overlaps(target, box) for box in [source, *taken]) or self._overlaps(source, target):
+                continue
+            if any(self._overlaps(source, box) for box in taken):
+                continue
+
+            image[target[1]:target[1] + target[3], target[0]:target[0] + target[2]] = region
+            return SyntheticCopy(source, target, transform)
+
+        return None
+
+    def _place(self, panel, w, h):
+        """Returns a random box of the given size inside a panel."""
+        x = panel[0] + int(self.random.integers(0, panel[2] - w + 1))
+        y = panel[1] + int(self.random.integers(0, panel[3] - h + 1))
+        return x, y, w, h
+
+    @staticmethod
+    def _overlaps(first, second):
+        """Returns True if two (x, y, w, h) boxes overlap."""
+        return (first[0] < second[0] + second[2] and second[0] < first[0] + first[2] and
+                first[1] < second[1] + second[3] and second[1] < first[1] + first[3])
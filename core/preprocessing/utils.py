@@ -1,5 +1,4 @@
 import cv2
-from matplotlib import pyplot as plt
 
 
 class ImageUtilities():
@@ -29,6 +28,21 @@ class ImageUtilities():
 
         return cv2.imread(path, flag)
 
+    @staticmethod
+    def to_gray(image):
+        """Converts a colored image to grayscale, and leaves grayscale images as they are.
+
+        Args:
+            image (numpy.ndarray): The BGR or grayscale image.
+
+        Returns:
+            numpy.ndarray: The grayscale image.
+        """
+        if len(image.shape) == 3:
+            return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+        return image
+
     def save(self, image, path):
         """Saves an image.
 
@@ -59,5 +73,8 @@ class ImageUtilities():
         Args:
             image (numpy.ndarray): The image to show.
         """
+        # Matplotlib is slow to import and only needed here
+        from matplotlib import pyplot as plt
+
         plt.imshow(image)
         plt.show()
@@ -0,0 +1,606 @@
+# System modules
+import os
+import json
+import time
+import socket
+import sqlite3
+import argparse
+from abc import ABC, abstractmethod
+from threading import Lock
+from collections import namedtuple
+from multiprocessing import Pool
+
+# Custom
+from ForgeryDetector.core import metrics
+
+# The default location of the queue
+WORK_QUEUE_PATH = r'Data\Blot data\work.db'
+
+# A job as a worker leases it
+Job = namedtuple('Job', ['id', 'task', 'payload', 'attempts'])
+
+
+class WorkQueue(ABC):
+    """What Worker and submit_folder need from a work queue. Other backends,
+    e.g. for a queue shared between machines, subclass it and implement
+    these methods the way SqliteQueue documents them.
+    """
+
+    def put(self, task, payload, shard=None):
+        """Adds a job. See put_many."""
+        return self.put_many(task, [payload], shard)[0]
+
+    @abstractmethod
+    def put_many(self, task, payloads, shard=None):
+        """Adds jobs and returns their IDs."""
+
+    @abstractmethod
+    def lease(self, worker, count=None, lease_seconds=None, tasks=None, shards=None):
+        """Leases jobs that are ready to a worker and returns them as Jobs."""
+
+    @abstractmethod
+    def extend(self, job_id, worker, lease_seconds=None):
+        """Extends the lease of a job, False if the worker no longer holds it."""
+
+    @abstractmethod
+    def complete(self, job_id, worker, result=None):
+        """Stores the result of a job, False if the worker no longer held the lease."""
+
+    @abstractmethod
+    def fail(self, job_id, worker, error=None):
+        """Records that a job failed, False if the worker no longer held the lease."""
+
+    @abstractmethod
+    def next_ready(self, tasks=None, shards=None):
+        """Returns the seconds until a job can be leased, or None if every job is finished."""
+
+    @abstractmethod
+    def results(self, task=None, state=None):
+        """Returns the finished jobs."""
+
+    @abstractmethod
+    def counts(self):
+        """Returns how many jobs there are in every state."""
+
+    @abstractmethod
+    def wait(self, poll=None, timeout=None):
+        """Waits until no job is pending or leased."""
+
+
+class SqliteQueue(WorkQueue):
+    """A work queue kept in a SQLite file, so any amount of worker processes
+    on the same machine can share it without running a server.
+
+    Workers lease jobs for a while. A job whose worker does not complete it
+    before the lease runs out (because the worker crashed or hung) is leased
+    to another worker, and a job that fails is retried after a growing delay
+    until it has failed max_attempts times. Jobs can be given a shard, so
+    that a worker (or a machine) only takes the jobs of its own shards.
+
+    """
+
+    def __init__(self, path=None, max_attempts=None, retry_delay=None):
+        if path is None:
+            path = WORK_QUEUE_PATH
+
+        if max_attempts is None:
+            self.max_attempts = 3
+        else:
+            self.max_attempts = max_attempts
+
+        # The first retry waits this many seconds, every next one twice as long
+        if retry_delay is None:
+            self.retry_delay = 5.0
+        else:
+            self.retry_delay = retry_delay
+
+        self.path = path
+
+        # Other processes write to the same file, so a busy database is waited for
+        self.lock = Lock()
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+
+        with self.lock:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS jobs '
+                                    '(id INTEGER PRIMARY KEY, task TEXT, payload TEXT, shard INTEGER, state TEXT, '
+                                    'attempts INTEGER, worker TEXT, lease_until REAL, available REAL, result TEXT, '
+                                    'error TEXT, created REAL, finished REAL)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS jobs_ready ON jobs (state, shard, available)')
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute('SELECT COUNT(*) FROM jobs').fetchone()[0]
+
+    def __getstate__(self):
+        # Workers in other processes open their own connection to the same file
+        return {'path': self.path, 'max_attempts': self.max_attempts, 'retry_delay': self.retry_delay}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'], state['max_attempts'], state['retry_delay'])
+
+    def close(self):
+        """Closes the connection to the queue."""
+        self.connection.close()
+
+    def put_many(self, task, payloads, shard=None):
+        """Adds jobs in one transaction.
+
+        Args:
+            task (str): What to do, e.g. 'classify' (see Worker).
+            payloads (iterable[dict]): What to do it on, one job each. Has to be JSON serializable.
+            shard (int or function, optional): The shard of the jobs, or a function that gives the
+            shard of a payload. Defaults to None (shard 0).
+
+        Returns:
+            list[int]: The IDs of the jobs.
+        """
+        if shard is None:
+            shard = 0
+
+        now = time.time()
+        rows = [(task, json.dumps(payload), shard(payload) if callable(shard) else shard, 'pending', 0, now, now)
+                for payload in payloads]
+
+        with self.lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                first = self.connection.execute('SELECT IFNULL(MAX(id), 0) FROM jobs').fetchone()[0] + 1
+                self.connection.executemany('INSERT INTO jobs (task, payload, shard, state, attempts, available, created) '
+                                            'VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+                self.connection.execute('COMMIT')
+            except Exception:
+                self.connection.execute('ROLLBACK')
+                raise
+
+        metrics.count('work_jobs_total', len(rows), task=task, result='queued')
+        return list(range(first, first + len(rows)))
+
+    def lease(self, worker, count=None, lease_seconds=None, tasks=None, shards=None):
+        """Leases jobs that are ready to a worker. A job is ready when it is
+        pending and its retry delay has passed, or when the lease of the
+        worker that had it has run out.
+
+        Args:
+            worker (str): The name of the worker.
+            count (int, optional): The maximum amount of jobs. Defaults to None (1).
+            lease_seconds (float, optional): How long the worker has to complete the jobs. Defaults to None (300).
+            tasks (list[str], optional): Only these tasks. Defaults to None (all of them).
+            shards (list[int], optional): Only jobs of these shards. Defaults to None (all of them).
+
+        Returns:
+            list[Job]: The leased jobs.
+        """
+        if count is None:
+            count = 1
+
+        if lease_seconds is None:
+            lease_seconds = 300.0
+
+        now = time.time()
+        query = ('SELECT id, task, payload, attempts FROM jobs WHERE '
+                 '((state = \'pending\' AND available <= ?) OR (state = \'leased\' AND lease_until < ?))')
+        parameters = [now, now]
+
+        for column, values in [('task', tasks), ('shard', shards)]:
+            if values is not None:
+                values = list(values)
+                query += f' AND {column} IN ({", ".join("?" * len(values))})'
+                parameters += values
+
+        query += ' ORDER BY id LIMIT ?'
+        parameters.append(count)
+
+        with self.lock:
+            # Taking the write lock first makes sure no other worker leases the same jobs
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                # A job whose workers keep dying (e.g. on a corrupt image) is given up on like a failing one
+                self.connection.execute('UPDATE jobs SET state = \'failed\', error = \'The lease ran out too often.\', finished = ? '
+                                        'WHERE state = \'leased\' AND lease_until < ? AND attempts >= ?',
+                                        (now, now, self.max_attempts))
+                rows = self.connection.execute(query, parameters).fetchall()
+                self.connection.executemany('UPDATE jobs SET state = \'leased\', worker = ?, lease_until = ?, '
+                                            'attempts = attempts + 1 WHERE id = ?',
+                                            [(worker, now + lease_seconds, job_id) for job_id, _, _, _ in rows])
+                self.connection.execute('COMMIT')
+            except Exception:
+                self.connection.execute('ROLLBACK')
+                raise
+
+        return [Job(job_id, task, json.loads(payload), attempts + 1) for job_id, task, payload, attempts in rows]
+
+    def extend(self, job_id, worker, lease_seconds=None):
+        """Extends the lease of a job that is taking long.
+
+        Args:
+            job_id (int): The ID of the job.
+            worker (str): The worker that leased the job.
+            lease_seconds (float, optional): How long from now the lease lasts. Defaults to None (300).
+
+        Returns:
+            bool: False if the worker no longer holds the lease.
+        """
+        if lease_seconds is None:
+            lease_seconds = 300.0
+
+        return self._update(job_id, worker, 'lease_until = ?', [time.time() + lease_seconds])
+
+    def complete(self, job_id, worker, result=None):
+        """Stores the result of a job.
+
+        Args:
+            job_id (int): The ID of the job.
+            worker (str): The worker that leased the job.
+            result (optional): The result. Has to be JSON serializable. Defaults to None.
+
+        Returns:
+            bool: False if the worker no longer held the lease, in which case the result is dropped.
+        """
+        return self._update(job_id, worker, 'state = \'done\', result = ?, error = NULL, finished = ?',
+                            [json.dumps(result), time.time()])
+
+    def fail(self, job_id, worker, error=None):
+        """Records that a job failed. It is retried later unless it has
+        failed max_attempts times.
+
+        Args:
+            job_id (int): The ID of the job.
+            worker (str): The worker that leased the job.
+            error (str, optional): What went wrong. Defaults to None.
+
+        Returns:
+            bool: False if the worker no longer held the lease.
+        """
+        now = time.time()
+        return self._update(job_id, worker,
+                            'state = CASE WHEN attempts >= ? THEN \'failed\' ELSE \'pending\' END, '
+                            'available = ? + ? * (1 << (attempts - 1)), error = ?, finished = ?',
+                            [self.max_attempts, now, self.retry_delay, error, now])
+
+    def next_ready(self, tasks=None, shards=None):
+        """Returns how long it is until a job can be leased: a pending job
+        whose retry delay passes, or a leased job whose lease runs out.
+
+        Args:
+            tasks (list[str], optional): Only these tasks. Defaults to None (all of them).
+            shards (list[int], optional): Only jobs of these shards. Defaults to None (all of them).
+
+        Returns:
+            float: The seconds until then, 0 or less if a job is ready now. None if no job
+            is pending or leased, i.e. every job is finished.
+        """
+        query = ('SELECT MIN(CASE WHEN state = \'pending\' THEN available ELSE lease_until END) FROM jobs '
+                 'WHERE state IN (\'pending\', \'leased\')')
+        parameters = []
+
+        for column, values in [('task', tasks), ('shard', shards)]:
+            if values is not None:
+                values = list(values)
+                query += f' AND {column} IN ({", ".join("?" * len(values))})'
+                parameters += values
+
+        with self.lock:
+            earliest = self.connection.execute(query, parameters).fetchone()[0]
+
+        return None if earliest is None else earliest - time.time()
+
+    def results(self, task=None, state=None):
+        """Returns the finished jobs.
+
+        Args:
+            task (str, optional): Only jobs of this task. Defaults to None.
+            state (str, optional): Either 'done' or 'failed'. Defaults to None ('done').
+
+        Returns:
+            list[tuple(int, dict, object)]: The ID, payload and result of every job, or the
+            error instead of the result for failed jobs.
+        """
+        if state is None:
+            state = 'done'
+
+        query = 'SELECT id, payload, result, error FROM jobs WHERE state = ?'
+        parameters = [state]
+
+        if task is not None:
+            query += ' AND task = ?'
+            parameters.append(task)
+
+        with self.lock:
+            rows = self.connection.execute(query + ' ORDER BY id', parameters).fetchall()
+
+        return [(job_id, json.loads(payload), error if state == 'failed' else json.loads(result))
+                for job_id, payload, result, error in rows]
+
+    def counts(self):
+        """Counts the jobs by state.
+
+        Returns:
+            dict[str, int]: The amount of 'pending', 'leased', 'done' and 'failed' jobs.
+        """
+        with self.lock:
+            rows = self.connection.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall()
+
+        return {'pending': 0, 'leased': 0, 'done': 0, 'failed': 0, **dict(rows)}
+
+    def wait(self, poll=None, timeout=None):
+        """Waits until every job is done or has failed for good.
+
+        Args:
+            poll (float, optional): How often to check, in seconds. Defaults to None (1).
+            timeout (float, optional): How long to wait at most. Defaults to None (forever).
+
+        Returns:
+            bool: True if every job is finished, False if the timeout passed first.
+        """
+        if poll is None:
+            poll = 1.0
+
+        start = time.time()
+        while True:
+            counts = self.counts()
+            if counts['pending'] == 0 and counts['leased'] == 0:
+                return True
+
+            if timeout is not None and time.time() - start > timeout:
+                return False
+
+            time.sleep(poll)
+
+    def _update(self, job_id, worker, assignments, parameters):
+        """Updates a job, but only if the worker still holds its lease."""
+        with self.lock:
+            cursor = self.connection.execute(f'UPDATE jobs SET {assignments} WHERE id = ? AND worker = ? AND state = \'leased\'',
+                                             [*parameters, job_id, worker])
+            return cursor.rowcount == 1
+
+
+class Worker():
+    """Takes jobs from a queue and runs them until the queue is empty (or
+    forever). Start as many workers as there are cores, on as many machines
+    as share the queue; every one of them leases its own jobs.
+
+    The tasks are functions that take the payload of a job and return its
+    result. By default there are three:
+        'classify': {'images': [paths]} -> {'probabilities': [...]}
+        'crop': {'image': path, 'path': folder or None, 'filters': {...}} -> {'boxes': [...]}
+        'match': {'image': path, 'threshold': 0.95, 'min_area': 100} -> {'boxes': [...], 'matches': [...]}
+    The classifier, cropper and matcher are only created once a job needs them.
+    """
+
+    def __init__(self, queue, tasks=None, name=None, shards=None, lease_seconds=None, batch=None, poll=None,
+                 classifier=None, cropper=None, matcher=None):
+        if name is None:
+            name = f'{socket.gethostname()}-{os.getpid()}'
+
+        if not isinstance(queue, WorkQueue):
+            raise ValueError(f'The queue has to be a WorkQueue, not {type(queue).__name__}.')
+
+        if lease_seconds is None:
+            self.lease_seconds = 300.0
+        else:
+            self.lease_seconds = lease_seconds
+
+        if batch is None:
+            self.batch = 1
+        else:
+            self.batch = batch
+
+        if poll is None:
+            self.poll = 1.0
+        else:
+            self.poll = poll
+
+        self.queue = queue
+        self.name = name
+        self.shards = shards
+        self._classifier = classifier
+        self._cropper = cropper
+        self._matcher = matcher
+
+        self.tasks = {'classify': self.classify, 'crop': self.crop, 'match': self.match}
+        if tasks is not None:
+            self.tasks.update(tasks)
+
+    def run(self, stop_when_empty=None, max_jobs=None):
+        """Runs jobs until every job of the worker's tasks and shards is
+        finished. While the only jobs left are waiting for a retry, or are
+        leased by other workers, the worker waits for them, since they may
+        still come back.
+
+        Args:
+            stop_when_empty (bool, optional): If False the worker keeps waiting for new jobs. Defaults to None (True).
+            max_jobs (int, optional): Stop after this many jobs. Defaults to None.
+
+        Returns:
+            int: The amount of jobs that were run.
+        """
+        if stop_when_empty is None:
+            stop_when_empty = True
+
+        ran = 0
+        while max_jobs is None or ran < max_jobs:
+            jobs = self.queue.lease(self.name, self.batch if max_jobs is None else min(self.batch, max_jobs - ran),
+                                    self.lease_seconds, list(self.tasks), self.shards)
+
+            if not jobs:
+                wait = self.queue.next_ready(list(self.tasks), self.shards)
+                if wait is None and stop_when_empty:
+                    break
+
+                # Polling keeps an eye on the jobs other workers finish (or put) in the meantime
+                time.sleep(self.poll if wait is None else min(max(wait, 0.01), self.poll))
+                continue
+
+            for index, job in enumerate(jobs):
+                # The jobs later in the batch were leased at the same time, so their leases are
+                # extended before every job, otherwise they could run out while waiting their turn
+                if index > 0:
+                    held = [self.queue.extend(other.id, self.name, self.lease_seconds) for other in jobs[index:]]
+                    if not held[0]:
+                        print(f'The lease of {job.task} job {job.id} ran out before it was started.')
+                        continue
+
+                self.run_job(job)
+                ran += 1
+
+        return ran
+
+    def run_job(self, job):
+        """Runs a single job and hands its result (or its error) to the queue.
+
+        Args:
+            job (Job): The job.
+
+        Returns:
+            bool: True if the job succeeded.
+        """
+        try:
+            with metrics.timer('work_job_seconds', task=job.task):
+                result = self.tasks[job.task](job.payload)
+        except Exception as e:
+            print(f'Exception occurred during {job.task} job {job.id}: {e}')
+            self.queue.fail(job.id, self.name, f'{type(e).__name__}: {e}')
+            metrics.count('work_jobs_total', task=job.task, result='failed')
+            return False
+
+        if not self.queue.complete(job.id, self.name, result):
+            print(f'The lease of {job.task} job {job.id} ran out before it was done, so its result was dropped.')
+            metrics.count('work_jobs_total', task=job.task, result='expired')
+            return False
+
+        metrics.count('work_jobs_total', task=job.task, result='done')
+        return True
+
+    @property
+    def classifier(self):
+        if self._classifier is None:
+            from ForgeryDetector.core.classifying.classify import ImageClassifier
+            self._classifier = ImageClassifier()
+        return self._classifier
+
+    @property
+    def cropper(self):
+        if self._cropper is None:
+            from ForgeryDetector.core.preprocessing.crop import ImageCropper
+            self._cropper = ImageCropper()
+        return self._cropper
+
+    @property
+    def matcher(self):
+        if self._matcher is None:
+            from ForgeryDetector.core.classifying.match import ImageMatcher
+            self._matcher = ImageMatcher()
+        return self._matcher
+
+    def classify(self, payload):
+        """Predicts the blot probability of a batch of images."""
+        return {'probabilities': [float(probability) for probability in self.classifier.predict(payload['images'])]}
+
+    def crop(self, payload):
+        """Finds the panels of an image and optionally saves them."""
+        import cv2
+
+        image = cv2.imread(payload['image'])
+        if image is None:
+            raise FileNotFoundError(f'Could not read \'{payload["image"]}\'.')
+
+        crops = self.cropper.crop_panels(image, **payload.get('filters', {}))
+        if payload.get('path') is not None:
+            self.cropper.save_crops(crops, payload['path'], os.path.splitext(os.path.basename(payload['image']))[0], 'png')
+
+        return {'boxes': [box for box, _ in crops]}
+
+    def match(self, payload):
+        """Crops the panels of a figure and looks for each of them elsewhere
+        in the figure, the way the match stage of Pipeline does."""
+        import cv2
+
+        image = cv2.imread(payload['image'], cv2.IMREAD_GRAYSCALE)
+        if image is None:
+            raise FileNotFoundError(f'Could not read \'{payload["image"]}\'.')
+
+        crops = self.cropper.crop_panels(image, payload.get('min_area', 100))
+        matches = self.matcher.match_crops(image, crops, threshold=payload.get('threshold', 0.95))
+
+        return {'boxes': [box for box, _ in crops], 'matches': matches}
+
+
+def submit_folder(queue, task, folder, batch_size=None, shards=None, **options):
+    """Splits the images of a folder into jobs and adds them to a queue.
+
+    Args:
+        queue (WorkQueue): The queue.
+        task (str): Either 'classify', 'crop' or 'match'.
+        folder (str): The folder with the images.
+        batch_size (int, optional): How many images a 'classify' job gets. Defaults to None (32).
+        shards (int, optional): Spreads the jobs round-robin over this many shards. Defaults to None (1).
+        **options: Added to the payload of every job, e.g. threshold=0.9 for 'match'.
+
+    Returns:
+        list[int]: The IDs of the jobs.
+    """
+    if batch_size is None:
+        batch_size = 32
+
+    if shards is None:
+        shards = 1
+
+    image_paths = [os.path.join(folder, image_file) for image_file in sorted(os.listdir(folder))
+                   if os.path.isfile(os.path.join(folder, image_file))]
+
+    if task == 'classify':
+        payloads = [{'images': image_paths[start:start + batch_size], **options} for start in range(0, len(image_paths), batch_size)]
+    else:
+        payloads = [{'image': image_path, **options} for image_path in image_paths]
+
+    job_ids = []
+    for shard in range(shards):
+        job_ids += queue.put_many(task, payloads[shard::shards], shard)
+
+    return job_ids
+
+
+def run_workers(queue, processes=None, **worker):
+    """Runs one worker per process until every job in the queue is finished.
+
+    Args:
+        queue (SqliteQueue): The queue, which every process opens again.
+        processes (int, optional): The amount of processes. Defaults to None (the amount of CPUs).
+        **worker: The arguments of Worker, e.g. shards=[0, 1].
+
+    Returns:
+        int: The amount of jobs that were run.
+    """
+    if processes is None:
+        processes = os.cpu_count()
+
+    with Pool(processes) as pool:
+        return sum(pool.map(_run_worker, [(queue, worker)] * processes))
+
+
+def _run_worker(args):
+    """Runs a worker. This lives outside of the classes so that it can be
+    sent to the processes of run_workers.
+
+    Args:
+        args (tuple(SqliteQueue, dict)): The queue and the arguments of Worker.
+
+    Returns:
+        int: The amount of jobs the worker ran.
+    """
+    queue, worker = args
+    return Worker(queue, **worker).run()
+
+
+if __name__ == '__main__':
+    # e.g. python -m ForgeryDetector.core.work "Data\Blot data\work.db" --processes 8 --shards 0 1
+    parser = argparse.ArgumentParser(description='Runs workers on a work queue.')
+    parser.add_argument('queue', nargs='?', default=WORK_QUEUE_PATH, help='The path of the queue.')
+    parser.add_argument('--processes', type=int, default=None, help='The amount of worker processes.')
+    parser.add_argument('--shards', type=int, nargs='*', default=None, help='Only take jobs of these shards.')
+    parser.add_argument('--batch', type=int, default=None, help='How many jobs a worker leases at once.')
+    args = parser.parse_args()
+
+    ran = run_workers(SqliteQueue(args.queue), args.processes, shards=args.shards, batch=args.batch)
+    print(f'Ran {ran} jobs.')